@@ -0,0 +1,54 @@
+import json
+import platform
+import subprocess
+import sys
+import time
+from typing import Dict, List, Optional
+
+import numpy as np
+
+
+def environment_info() -> Dict:
+    try:
+        commit = subprocess.run(
+            ['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        'timestamp': time.time(),
+        'git_commit': commit,
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'platform': platform.platform(),
+        'processor': platform.processor(),
+    }
+
+
+def summarize(samples: List[float]) -> Dict:
+    samples = np.asarray(samples, dtype=np.float64)
+    if samples.size == 0:
+        return {'n': 0}
+    return {
+        'n': int(samples.size),
+        'mean': float(samples.mean()),
+        'min': float(samples.min()),
+        'p50': float(np.percentile(samples, 50)),
+        'p99': float(np.percentile(samples, 99)),
+        'max': float(samples.max()),
+    }
+
+
+def emit(benchmark: str, results: List[Dict], output: Optional[str] = None) -> Dict:
+    report = {
+        'benchmark': benchmark,
+        'environment': environment_info(),
+        'results': results,
+    }
+    text = json.dumps(report, indent=2)
+    if output is None or output == '-':
+        sys.stdout.write(text + '\n')
+    else:
+        with open(output, 'w') as f:
+            f.write(text + '\n')
+    return report
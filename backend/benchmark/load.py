@@ -0,0 +1,173 @@
+import argparse
+import asyncio
+import json
+import socket
+import struct
+import subprocess
+import sys
+import time
+from typing import Dict, List, Optional
+from urllib.parse import urlencode, urlparse
+
+import websockets
+
+from benchmark.common import emit, summarize
+from streaming.compression import create_codec
+
+
+# usage : python -m benchmark.load --spawn-server --clients 50 --simulator sph_system --shared
+#
+# Opens many concurrent websocket clients against a running server.py
+# (or one started with --spawn-server) and reports frames/sec, frame
+# latency (from the frame 'timestamp' written by the server) and bytes/frame.
+# --param compression=shuffle-zlib --no-deflate compares application level codecs
+# against websocket permessage-deflate. With --param ack_window=N the clients ack every
+# message with "ok" once received, as the server's flow control expects.
+
+
+def frame_timestamp(message) -> Optional[float]:
+    if isinstance(message, bytes):
+        header_len, = struct.unpack_from('<I', message, 0)
+        header = json.loads(message[4:4+header_len])
+    else:
+        header = json.loads(message)
+    return header.get('timestamp')
+
+
+async def run_client(url: str, duration: float, stats: Dict, codec=None, deflate: bool = True, ack: bool = False) -> None:
+    try:
+        compression = 'deflate' if deflate else None
+        async with websockets.connect(url, max_size=None, compression=compression) as ws:
+            stats['n_connected'] += 1
+            end_time = time.time() + duration
+            while True:
+                timeout = end_time - time.time()
+                if timeout <= 0:
+                    break
+                try:
+                    message = await asyncio.wait_for(ws.recv(), timeout=timeout)
+                except asyncio.TimeoutError:
+                    break
+                received_at = time.time()
+                stats['n_frames'] += 1
+                stats['frame_bytes'].append(len(message))
+                if codec is not None:
+                    message = codec.decompress(message)
+                timestamp = frame_timestamp(message)
+                if timestamp is not None:
+                    stats['latencies'].append(received_at - timestamp)
+                if ack:
+                    await ws.send('ok')
+            await ws.send('close')
+    except (OSError, websockets.exceptions.WebSocketException) as e:
+        stats['errors'].append(repr(e))
+
+
+async def run_load(
+    urls: List[str], duration: float, connect_interval: float, codec=None, deflate: bool = True, ack: bool = False,
+) -> Dict:
+    stats = {
+        'n_connected': 0,
+        'n_frames': 0,
+        'frame_bytes': [],
+        'latencies': [],
+        'errors': [],
+    }
+    tasks = []
+    start = time.time()
+    for url in urls:
+        tasks.append(asyncio.create_task(run_client(url, duration, stats, codec, deflate, ack)))
+        if connect_interval > 0:
+            await asyncio.sleep(connect_interval)
+    await asyncio.gather(*tasks)
+    elapsed = time.time() - start
+    frame_bytes = stats['frame_bytes']
+    return {
+        'n_clients': len(urls),
+        'n_connected': stats['n_connected'],
+        'n_errors': len(stats['errors']),
+        'errors': stats['errors'][:10],
+        'duration': elapsed,
+        'n_frames': stats['n_frames'],
+        'frames_per_second': stats['n_frames'] / elapsed,
+        'frames_per_second_per_client': stats['n_frames'] / elapsed / max(1, stats['n_connected']),
+        'latency': summarize(stats['latencies']),
+        'bytes_per_frame': summarize(frame_bytes),
+        'bytes_per_second': sum(frame_bytes) / elapsed,
+    }
+
+
+def wait_for_port(host: str, port: int, timeout: float) -> None:
+    end_time = time.time() + timeout
+    while time.time() < end_time:
+        try:
+            with socket.create_connection((host, port), timeout=0.5):
+                return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f'server did not start on {host}:{port}')
+
+
+def spawn_server(host: str, port: int) -> subprocess.Popen:
+    process = subprocess.Popen(
+        # WS_DEFLATE_* settings (streaming/deflate.py) are taken from the environment
+        [sys.executable, 'run_server.py', '--host', host, '--port', str(port), '--log-level', 'warning'],
+        stdout=subprocess.DEVNULL,
+    )
+    wait_for_port(host, port, timeout=30)
+    return process
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='websocket load generator for server.py')
+    parser.add_argument('--url', default='ws://localhost:8000', help='server base url')
+    parser.add_argument('--spawn-server', action='store_true', help='start a local server.py for the run')
+    parser.add_argument('--simulator', default='ideal_gas_system')
+    parser.add_argument('--clients', type=int, default=10)
+    parser.add_argument('--duration', type=float, default=10.0)
+    parser.add_argument('--connect-interval', type=float, default=0.01, help='seconds between client connects')
+    parser.add_argument('--frame-format', default='json')
+    parser.add_argument('--shared', action='store_true', help='all clients join one session')
+    parser.add_argument('--param', action='append', default=[], help='extra query parameter key=value')
+    parser.add_argument('--no-deflate', action='store_true', help='do not offer websocket permessage-deflate')
+    parser.add_argument('--output', default=None, help='json output file (default : stdout)')
+    args = parser.parse_args(args)
+
+    query = {'frame_format': args.frame_format}
+    if args.shared:
+        query['simulator_id'] = 1
+    for param in args.param:
+        key, value = param.split('=', 1)
+        query[key] = value
+    url = f'{args.url.rstrip("/")}/simulate/{args.simulator}?{urlencode(query)}'
+    level = query.get('compression_level')
+    codec = create_codec(query.get('compression'), int(level) if level is not None else None)
+    # with flow control on the server stops sending once ack_window messages are not acked
+    ack = int(query.get('ack_window', 0)) > 0
+
+    server_process = None
+    if args.spawn_server:
+        parsed = urlparse(args.url)
+        server_process = spawn_server(parsed.hostname, parsed.port or 8000)
+    try:
+        result = asyncio.run(run_load(
+            [url] * args.clients, args.duration, args.connect_interval, codec, not args.no_deflate, ack,
+        ))
+    finally:
+        if server_process is not None:
+            server_process.terminate()
+            server_process.wait()
+    result = {
+        'url': url,
+        'simulator': args.simulator,
+        'frame_format': args.frame_format,
+        'shared': args.shared,
+        'permessage_deflate': not args.no_deflate,
+        'ack': ack,
+        **result,
+    }
+    return emit('load', [result], args.output)
+
+
+if __name__ == '__main__':
+    main()
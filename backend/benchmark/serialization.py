@@ -0,0 +1,91 @@
+import argparse
+import itertools
+import sys
+import time
+from typing import Dict, List
+
+from streaming.compression import CompressedFrameEncoder, create_codec
+from streaming.frame import FrameFormat, create_frame_encoder
+from benchmark.common import emit, summarize
+from benchmark.simulators import QUICK_SWEEPS, SWEEPS, create_simulator
+
+
+# usage : python -m benchmark.serialization [--quick] [--output results.json]
+
+# (frame format, keyframe interval)
+ENCODINGS = [
+    (FrameFormat.JSON, 0),
+    (FrameFormat.BINARY, 0),
+    (FrameFormat.COMPACT, 0),
+    (FrameFormat.COMPACT, 10),
+]
+# codecs of streaming/compression.py, shuffle-* only apply to the binary formats
+COMPRESSIONS = ['none', 'zlib', 'shuffle-zlib']
+
+
+def bench_encoding(simulator, encoding, dt: float, n_frames: int, compression: str = 'none') -> Dict:
+    encoder = create_frame_encoder(*encoding)
+    codec = create_codec(compression)
+    if codec is not None:
+        encoder = CompressedFrameEncoder(encoder, codec)
+    encode_times = []
+    frame_sizes = []
+    for _ in range(n_frames):
+        # step between frames so that delta encoders see changing data
+        simulator.update(dt=dt)
+        start = time.perf_counter()
+        frame = encoder.encode(simulator, 0)
+        encode_times.append(time.perf_counter() - start)
+        frame_sizes.append(len(frame))
+    return {
+        'encode_time': summarize(encode_times),
+        'bytes_per_frame': summarize(frame_sizes),
+    }
+
+
+def run(sweeps: Dict[str, List[int]], dt: float, n_frames: int, compressions: List[str]) -> List[Dict]:
+    results = []
+    for name, sizes in sweeps.items():
+        for size in sizes:
+            simulator = create_simulator(name, size)
+            for encoding, compression in itertools.product(ENCODINGS, compressions):
+                if compression.startswith('shuffle-') and encoding[0] == FrameFormat.JSON:
+                    continue
+                result = bench_encoding(simulator, encoding, dt, n_frames, compression)
+                results.append({
+                    'simulator': name,
+                    'size': size,
+                    'frame_format': encoding[0].value,
+                    'keyframe_interval': encoding[1],
+                    'compression': compression,
+                    **result,
+                })
+                print(
+                    f'{name} size={size} {encoding[0].value}/{encoding[1]}/{compression} : '
+                    f'{1000*result["encode_time"]["mean"]:.3f} ms/frame, '
+                    f'{result["bytes_per_frame"]["mean"]:.0f} bytes/frame',
+                    file=sys.stderr, flush=True,
+                )
+    return results
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='frame encoding cost per frame format')
+    parser.add_argument('--simulator', action='append', choices=list(SWEEPS), help='default : all')
+    parser.add_argument('--sizes', type=int, nargs='+', help='override the size sweep')
+    parser.add_argument('--quick', action='store_true', help='smaller sweep')
+    parser.add_argument('--dt', type=float, default=0.005)
+    parser.add_argument('--frames', type=int, default=20)
+    parser.add_argument('--compression', action='append', help=f'default : {COMPRESSIONS}')
+    parser.add_argument('--output', default=None, help='json output file (default : stdout)')
+    args = parser.parse_args(args)
+
+    sweeps = QUICK_SWEEPS if args.quick else SWEEPS
+    names = args.simulator or list(sweeps)
+    sweeps = {name: args.sizes or sweeps[name] for name in names}
+    compressions = args.compression or COMPRESSIONS
+    return emit('serialization', run(sweeps, args.dt, args.frames, compressions), args.output)
+
+
+if __name__ == '__main__':
+    main()
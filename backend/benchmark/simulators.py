@@ -0,0 +1,132 @@
+import argparse
+import resource
+import sys
+import time
+import tracemalloc
+from typing import Dict, List
+
+from simulator.ideal_gas import IdealGasSystem
+from simulator.sph import SPHSystem
+from simulator.wave import Wave2DSystem
+from benchmark.common import emit, summarize
+
+
+# usage : python -m benchmark.simulators [--quick] [--output results.json]
+
+SWEEPS = {
+    'ideal_gas_system': [100, 1000, 10000, 100000],
+    'wave_2d_system': [50, 200, 500, 1000],
+    'sph_system': [500, 2000, 5000, 20000],
+}
+QUICK_SWEEPS = {
+    'ideal_gas_system': [100, 10000],
+    'wave_2d_system': [50, 500],
+    'sph_system': [500, 2000],
+}
+
+
+def create_simulator(name: str, size: int, seed: int = 0):
+    # fixed seed : every run steps the same trajectory
+    if name == 'ideal_gas_system':
+        return IdealGasSystem(
+            n_particles=size,
+            xmin=-10, xmax=10, ymin=-10, ymax=10, zmin=-10, zmax=10,
+            seed=seed,
+        )
+    if name == 'wave_2d_system':
+        return Wave2DSystem(
+            n_grid_x=size,
+            n_grid_z=size,
+            dx=0.25,
+            dz=0.25,
+            source_position=(size//2, size//2),
+            seed=seed,
+        )
+    if name == 'sph_system':
+        return SPHSystem(n_particles=size, seed=seed)
+    raise ValueError(f'unknown simulator : {name}')
+
+
+def bench_steps(simulator, dt: float, n_steps: int) -> Dict:
+    step_times = []
+    for _ in range(n_steps):
+        start = time.perf_counter()
+        simulator.update(dt=dt)
+        step_times.append(time.perf_counter() - start)
+    return summarize(step_times)
+
+
+def bench_step_memory(simulator, dt: float, n_steps: int) -> Dict:
+    # memory allocated by a step on top of the simulator state (numpy reports to tracemalloc)
+    tracemalloc.start()
+    try:
+        peaks = []
+        retained_blocks_per_step = []
+        for _ in range(n_steps):
+            before = tracemalloc.take_snapshot()
+            base, _ = tracemalloc.get_traced_memory()
+            if hasattr(tracemalloc, 'reset_peak'):
+                tracemalloc.reset_peak()
+            else:
+                # python 3.8 has no reset_peak, clearing the traces resets the peak
+                tracemalloc.clear_traces()
+                base = 0
+            simulator.update(dt=dt)
+            _, peak = tracemalloc.get_traced_memory()
+            after = tracemalloc.take_snapshot()
+            peaks.append(peak - base)
+            retained_blocks_per_step.append(sum(
+                max(0, stat.count_diff) for stat in after.compare_to(before, 'lineno')
+            ))
+    finally:
+        tracemalloc.stop()
+    return {
+        'peak_temporary_bytes': summarize(peaks),
+        'retained_blocks': summarize(retained_blocks_per_step),
+    }
+
+
+def run(sweeps: Dict[str, List[int]], dt: float, n_steps: int, n_warmup: int) -> List[Dict]:
+    results = []
+    for name, sizes in sweeps.items():
+        for size in sizes:
+            start = time.perf_counter()
+            simulator = create_simulator(name, size)
+            init_time = time.perf_counter() - start
+            for _ in range(n_warmup):
+                simulator.update(dt=dt)
+            step_time = bench_steps(simulator, dt, n_steps)
+            memory = bench_step_memory(simulator, dt, max(1, min(n_steps, 5)))
+            results.append({
+                'simulator': name,
+                'size': size,
+                'dt': dt,
+                'init_time': init_time,
+                'step_time': step_time,
+                'steps_per_second': 1.0 / step_time['mean'] if step_time['mean'] > 0 else None,
+                **memory,
+                'max_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+            })
+            print(f'{name} size={size} : {1000*step_time["mean"]:.3f} ms/step', file=sys.stderr, flush=True)
+    return results
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='per step cost of the simulators')
+    parser.add_argument('--simulator', action='append', choices=list(SWEEPS), help='default : all')
+    parser.add_argument('--sizes', type=int, nargs='+', help='override the size sweep')
+    parser.add_argument('--quick', action='store_true', help='smaller sweep')
+    parser.add_argument('--dt', type=float, default=0.005)
+    parser.add_argument('--steps', type=int, default=20)
+    parser.add_argument('--warmup', type=int, default=3)
+    parser.add_argument('--output', default=None, help='json output file (default : stdout)')
+    args = parser.parse_args(args)
+
+    sweeps = QUICK_SWEEPS if args.quick else SWEEPS
+    names = args.simulator or list(sweeps)
+    sweeps = {name: args.sizes or sweeps[name] for name in names}
+    return emit('simulators', run(sweeps, args.dt, args.steps, args.warmup), args.output)
+
+
+if __name__ == '__main__':
+    main()
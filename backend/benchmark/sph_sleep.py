@@ -0,0 +1,75 @@
+import argparse
+import sys
+import time
+from typing import Dict, List
+
+from simulator.sph import SPHSystem
+from streaming.executor import _run_steps
+from benchmark.common import emit, summarize
+
+
+# usage : python -m benchmark.sph_sleep [--particles 1000] [--steps 3000] [--output results.json]
+#
+# Steps an SPH tank until it settles, like a session does (stable substeps of step_dt),
+# and checks that sleeping pays off : at the end at least --min-asleep of the particles
+# sleep, and the awake set of the last window is smaller than the one of the first.
+# Exits with status 1 otherwise.
+
+
+def run(n_particles: int, n_steps: int, dt: float, window: int, sleep_velocity=None, seed: int = 0) -> List[Dict]:
+    simulator = SPHSystem(n_particles=n_particles, seed=seed, sleep_velocity=sleep_velocity)
+    results = []
+    for start_step in range(0, n_steps, window):
+        step_times = []
+        n_awake = []
+        for _ in range(min(window, n_steps - start_step)):
+            start = time.perf_counter()
+            _run_steps(simulator, dt, 1)
+            step_times.append(time.perf_counter() - start)
+            n_awake.append(int((~simulator._asleep).sum()))
+        results.append({
+            'steps': start_step + len(step_times),
+            'step_time': summarize(step_times),
+            'n_awake': summarize(n_awake),
+        })
+        print(
+            f'steps {start_step + len(step_times)} : {1000*results[-1]["step_time"]["mean"]:.2f} ms/step, '
+            f'{n_awake[-1]} of {n_particles} awake',
+            file=sys.stderr, flush=True,
+        )
+    return results
+
+
+def check(results: List[Dict], n_particles: int, min_asleep: float) -> List[str]:
+    errors = []
+    n_awake = int(results[-1]['n_awake']['min'])
+    if n_particles - n_awake < min_asleep * n_particles:
+        errors.append(f'{n_particles - n_awake} of {n_particles} particles asleep, expected at least {min_asleep:.0%}')
+    if len(results) > 1 and not results[-1]['n_awake']['mean'] < results[0]['n_awake']['mean']:
+        errors.append('the awake set did not shrink')
+    return errors
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='sleeping particles of a settling SPH tank')
+    parser.add_argument('--particles', type=int, default=1000)
+    parser.add_argument('--steps', type=int, default=3000)
+    parser.add_argument('--dt', type=float, default=0.005)
+    parser.add_argument('--window', type=int, default=500, help='steps per reported window')
+    parser.add_argument('--sleep-velocity', type=float, default=None, help='default : the simulator\'s')
+    parser.add_argument('--min-asleep', type=float, default=0.5, help='fraction of particles asleep at the end')
+    parser.add_argument('--output', default=None, help='json output file (default : stdout)')
+    args = parser.parse_args(args)
+
+    results = run(args.particles, args.steps, args.dt, args.window, args.sleep_velocity)
+    errors = check(results, args.particles, args.min_asleep)
+    report = emit('sph_sleep', [{'n_particles': args.particles, 'dt': args.dt, 'windows': results, 'errors': errors}], args.output)
+    for error in errors:
+        print(f'check failed : {error}', file=sys.stderr)
+    if errors:
+        sys.exit(1)
+    return report
+
+
+if __name__ == '__main__':
+    main()
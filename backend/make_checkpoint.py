@@ -0,0 +1,44 @@
+import argparse
+import os
+import sys
+import time
+
+from server import checkpoints_dir, create_simulator
+from simulator.registry import SIMULATORS, get_spec, parse_config
+
+
+# usage : python make_checkpoint.py sph_system settled --steps 2000 --param seed=0
+#
+# Runs a simulator offline and saves its state into CHECKPOINTS_DIR/<name>.ckpt,
+# sessions then start from it with /simulate/<simulator>?checkpoint=<name>.
+
+
+def main(args=None):
+    simulators = [name for name, spec in SIMULATORS.items() if spec.checkpointable]
+    parser = argparse.ArgumentParser(description='save a simulator checkpoint')
+    parser.add_argument('simulator', choices=simulators)
+    parser.add_argument('name', help='checkpoint name (file in CHECKPOINTS_DIR)')
+    parser.add_argument('--steps', type=int, default=2000)
+    parser.add_argument('--dt', type=float, default=0.005)
+    parser.add_argument('--from-checkpoint', default=None, help='continue from an existing checkpoint')
+    parser.add_argument('--param', action='append', default=[], help='simulator parameter key=value (e.g. seed=0)')
+    args = parser.parse_args(args)
+
+    # sessions restore the checkpoint into a simulator of the same config
+    config = parse_config(get_spec(args.simulator), dict(param.split('=', 1) for param in args.param))
+    target_simulator = create_simulator(args.simulator, config, args.from_checkpoint)
+    start = time.time()
+    for step in range(1, args.steps + 1):
+        target_simulator.update(dt=args.dt)
+        if step % 100 == 0:
+            print(f'step {step}/{args.steps} : {time.time() - start:.1f} s', file=sys.stderr, flush=True)
+    os.makedirs(checkpoints_dir, exist_ok=True)
+    path = os.path.join(checkpoints_dir, args.name + '.ckpt')
+    blob = target_simulator.checkpoint()
+    with open(path, 'wb') as f:
+        f.write(blob)
+    print(f'saved {len(blob)} bytes into {path}')
+
+
+if __name__ == '__main__':
+    main()
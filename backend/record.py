@@ -0,0 +1,50 @@
+import argparse
+import os
+import sys
+import time
+
+from server import create_simulator, recordings_dir
+from simulator.registry import SIMULATORS, get_spec, parse_config
+from simulator.recording import OPTIONAL_FIELDS, SimulationRecorder
+
+
+# usage : python record.py sph_system sph_run --steps 4000 --dt 0.005 --every 4 --extra densities --param n_particles=5000
+#
+# Runs a simulator offline and records its states into RECORDINGS_DIR/<name>,
+# to be streamed with /simulate/replay?recording=<name>.
+
+
+def main(args=None):
+    recordable = [name for name in SIMULATORS if name != 'replay']
+    parser = argparse.ArgumentParser(description='record a simulation run for replay')
+    parser.add_argument('simulator', choices=recordable)
+    parser.add_argument('name', help='recording name (directory in RECORDINGS_DIR)')
+    parser.add_argument('--steps', type=int, default=2000)
+    parser.add_argument('--dt', type=float, default=0.005)
+    parser.add_argument('--every', type=int, default=1, help='record every n-th step')
+    parser.add_argument('--extra', action='append', default=[], choices=list(OPTIONAL_FIELDS), help='extra arrays to record')
+    parser.add_argument('--chunk-size', type=int, default=256, help='frames per chunk file')
+    parser.add_argument('--param', action='append', default=[], help='simulator parameter key=value')
+    args = parser.parse_args(args)
+
+    config = parse_config(get_spec(args.simulator), dict(param.split('=', 1) for param in args.param))
+    target_simulator = create_simulator(args.simulator, config)
+    recorder = SimulationRecorder(
+        os.path.join(recordings_dir, args.name), args.simulator, args.extra, args.chunk_size,
+    )
+    start = time.time()
+    try:
+        recorder.record(target_simulator)
+        for step in range(1, args.steps + 1):
+            target_simulator.update(dt=args.dt)
+            if step % args.every == 0:
+                recorder.record(target_simulator)
+            if step % 100 == 0:
+                print(f'step {step}/{args.steps} : {time.time() - start:.1f} s', file=sys.stderr, flush=True)
+    finally:
+        recorder.close()
+    print(f'recorded {recorder.n_frames} frames into {os.path.join(recordings_dir, args.name)}')
+
+
+if __name__ == '__main__':
+    main()
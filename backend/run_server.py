@@ -0,0 +1,29 @@
+import argparse
+
+import uvicorn
+
+from streaming.deflate import DeflateWebSocketProtocol
+
+
+# usage : WS_DEFLATE_LEVEL=1 WS_DEFLATE_WINDOW_BITS=12 python run_server.py --host 0.0.0.0
+#
+# Starts uvicorn with server:app and the permessage-deflate settings of
+# streaming/deflate.py (uvicorn's own --ws options only switch deflate on or off).
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='simulation streaming server with tunable permessage-deflate')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--reload', action='store_true')
+    parser.add_argument('--log-level', default='info')
+    args = parser.parse_args(args)
+    uvicorn.run(
+        'server:app', host=args.host, port=args.port, workers=args.workers, reload=args.reload,
+        log_level=args.log_level, ws=DeflateWebSocketProtocol,
+    )
+
+
+if __name__ == '__main__':
+    main()
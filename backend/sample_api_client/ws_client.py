@@ -2,9 +2,71 @@ import websocket
 from threading import Thread
 import time
 import json
+import struct
+import sys
 
 import numpy as np
 
+
+def decode_binary_frame(message: bytes):
+    # uint32 header length + json header + raw field buffers (see server streaming/frame.py)
+    header_len, = struct.unpack_from('<I', message, 0)
+    header = json.loads(message[4:4+header_len])
+    data_start = 4 + header_len
+    arrays = {}
+    for field in header['fields']:
+        arrays[field['name']] = np.frombuffer(
+            message,
+            dtype=np.dtype(field['dtype']),
+            count=int(np.prod(field['shape'])),
+            offset=data_start+field['offset'],
+        ).reshape(field['shape'])
+    return header, arrays
+
+
+class CompactFrameDecoder():
+    # static frame once, then int16 keyframes and int8 (patched) or int16 deltas (see server streaming/frame.py)
+
+    def __init__(self):
+        self.static_states = {}
+        self._keyframe_id = None
+        self._keyframe_qs = {}
+        self._quantization = {}
+
+    def decode(self, header, arrays):
+        frame_type = header['frame_type']
+        if frame_type == 'static':
+            self.static_states = {**header, **arrays}
+            return None
+        if frame_type == 'keyframe':
+            self._keyframe_id = header['keyframe_id']
+            self._keyframe_qs = arrays
+            self._quantization = header['quantization']
+            qs = arrays
+        elif header['keyframe_id'] == self._keyframe_id:
+            qs = {}
+            for key, d in arrays.items():
+                if '.patch_' in key:
+                    continue
+                d = d.astype(np.int32) << header.get('delta_shift', {}).get(key, 0)
+                if key + '.patch_index' in arrays:
+                    # int8 deltas that didn't fit
+                    d.ravel()[arrays[key + '.patch_index']] = arrays[key + '.patch_delta']
+                qs[key] = self._keyframe_qs[key].astype(np.int32) + d
+        else:
+            # missed the keyframe this delta refers to
+            return None
+        states = {}
+        for key, q in qs.items():
+            params = self._quantization[key]
+            states[key] = (q.astype(np.float64) + 32768) * np.array(params['scale']) + np.array(params['min'])
+        if 'heights' in states:
+            # wave : rebuild the grid positions from the static x/z coordinates
+            gx, gz = np.meshgrid(self.static_states['grid_x'], self.static_states['grid_z'], indexing='ij')
+            states['positions'] = np.stack([gx, states['heights'], gz], axis=-1).reshape((-1, 3))
+        return states
+
+
 class WebsocketClient():
 
     def __init__(self, host_addr):
@@ -16,19 +78,40 @@ class WebsocketClient():
             on_close   = self.on_close,
         )
         self.ws.on_open = self.on_open
+        self._compact_decoder = CompactFrameDecoder()
+        self._n_frames = 0
+        self._n_bytes = 0
+        self._decode_time = 0.0
 
     def on_message(self, ws, message):
         # print("receive : {}".format(message))
-        message = json.loads(message)
-        print(message.keys())
-        print(f'time : {message["time"]}')
-        print(np.array(message['positions'])[0, 0])
+        start = time.perf_counter()
+        if isinstance(message, bytes):
+            header, arrays = decode_binary_frame(message)
+            if 'frame_type' in header:
+                arrays = self._compact_decoder.decode(header, arrays)
+                if arrays is None:
+                    return
+            positions = arrays['positions']
+        else:
+            header = json.loads(message)
+            positions = np.array(header['positions'])
+        self._decode_time += time.perf_counter() - start
+        self._n_frames += 1
+        self._n_bytes += len(message)
+        print(header.keys())
+        print(f'time : {header["time"]}')
+        print(positions[0, 0])
 
     def on_error(self, ws, error):
         print(error)
 
     def on_close(self, ws, close_status_code, close_msg):
         print(f'close : {close_msg}')
+        if self._n_frames > 0:
+            print(f'frames : {self._n_frames}')
+            print(f'bytes/frame : {self._n_bytes/self._n_frames:.1f}')
+            print(f'decode time/frame : {1000*self._decode_time/self._n_frames:.3f} ms')
 
     def on_open(self, ws):
         self._running = True
@@ -48,5 +131,11 @@ class WebsocketClient():
         self.ws.run_forever()
 
 
-ws_client = WebsocketClient("ws://localhost:8000/simulate/ideal_gas_system")
+# usage : python ws_client.py [json|binary|compact] [simulator] [keyframe_interval]
+frame_format = sys.argv[1] if len(sys.argv) > 1 else 'json'
+simulator = sys.argv[2] if len(sys.argv) > 2 else 'ideal_gas_system'
+keyframe_interval = sys.argv[3] if len(sys.argv) > 3 else 0
+ws_client = WebsocketClient(
+    f"ws://localhost:8000/simulate/{simulator}?frame_format={frame_format}&keyframe_interval={keyframe_interval}"
+)
 ws_client.run_forever()
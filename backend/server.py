@@ -1,26 +1,27 @@
 import asyncio
-from datetime import datetime
-from email.errors import MessageError
-from enum import Enum
-from typing import Optional, List
-import time
-from threading import Thread
-import json
+from typing import Dict, Optional, List, Tuple
+import math
+import os
 
 from fastapi import FastAPI, WebSocket, WebSocketDisconnect
+from fastapi.responses import PlainTextResponse
 
-from simulator.ideal_gas import IdealGasSystem
-from simulator.wave import Wave2DSystem
-from simulator.sph import SPHSystem
+from simulator.registry import (
+    SIMULATORS, Param, SimulatorSpec, get_spec, parse_config, register,
+    create_simulator as registry_create_simulator,
+)
+from streaming.broker import BrokerClient, FeedSubscriber
+from streaming.compression import create_codec
+from streaming.executor import create_step_executor
+from streaming.frame import FrameFormat
+from streaming.metrics import ACTIVE_SESSIONS, ACTIVE_SUBSCRIBERS, REGISTRY, merge_expositions
+from streaming.pool import SimulatorPool
+from streaming.session import SessionLimitError, SessionManager, Subscriber
+from streaming.view import StreamView, parse_roi
 
 
 app = FastAPI()
 
-class SimulatorList(Enum):
-    IDEAL_GAS_SYSTEM = 'ideal_gas_system'
-    WAVE_2D_SYSTEM = 'wave_2d_system'
-    SPH_SYSTEM = 'sph_system'
-
 class ConnectionManager:
     def __init__(self):
         self.active_connections: List[WebSocket] = []
@@ -31,6 +32,8 @@ class ConnectionManager:
         print(len(self.active_connections))
 
     def disconnect(self, websocket: WebSocket):
+        if websocket not in self.active_connections:
+            return
         self.active_connections.remove(websocket)
         print(len(self.active_connections))
 
@@ -42,49 +45,206 @@ class ConnectionManager:
             await connection.send_text(message)
 
 
+# runtime messages of replay sessions : "seek <recorded time>", "speed <playback speed>"
+PLAYBACK_CONTROLS = ('seek', 'speed')
+
+
 class WSMessageHandler:
 
-    def __init__(self, websocket, simulator, connection_manager, min_dt, max_dt):
+    def __init__(self, websocket, session, subscriber, connection_manager):
+        # session : the SimulationSession, or the Feed relaying to it in front mode
         self._ws = websocket
-        self._simulator = simulator
+        self._session = session
+        self._subscriber = subscriber
         self._connection_manager = connection_manager
         self._is_connected = True
-        self._max_dt = max_dt
-        self._min_dt = min_dt
 
     async def message_send_task(self) -> None:
-        prev_dt = cur_dt = datetime.now()
-        while self._is_connected:
-            cur_dt = datetime.now()
-            dt = (cur_dt - prev_dt).total_seconds()
-            dt = min(self._max_dt, dt)
-            # print(f'dt : {dt}')
-            self._simulator.update(dt=dt)
-            states = self._simulator.get_states()
-            states['simulator_id'] = id(self._simulator)
-            await self._ws.send_json(states)
-            prev_dt = cur_dt
-            wait_time = self._min_dt-(datetime.now()-cur_dt).total_seconds()
-            wait_time = max(0, wait_time)
-            await asyncio.sleep(wait_time)
+        # frames are stepped and encoded by the shared session, only sending happens here
+        await self._subscriber.send_task()
 
     async def message_receive_task(self) -> None:
         while self._is_connected:
             msg_received = await self._ws.receive_text()
+            if msg_received == 'ok':
+                # frame acknowledgement
+                self._subscriber.ack()
+                continue
             print(f'received msg : {msg_received}')
+            command, _, value = msg_received.partition(' ')
+            is_feed_control = command == 'min_dt' and isinstance(self._subscriber, FeedSubscriber)
+            if command in PLAYBACK_CONTROLS or is_feed_control:
+                try:
+                    value = float(value)
+                    if not math.isfinite(value):
+                        raise ValueError(f'{command} needs a finite value : {value}')
+                    if is_feed_control:
+                        # a front relays the frame interval of its fastest client
+                        self._subscriber.min_dt = max(0.0, value)
+                    else:
+                        self._session.control(command, value)
+                except ValueError as e:
+                    print(f'invalid control : {e}')
+                continue
             if msg_received == 'close':
                 print('received close message')
                 self._connection_manager.disconnect(self._ws)
                 self._is_connected = False
+                self._subscriber.close()
                 break
 
+    async def run(self) -> None:
+        tasks = [
+            asyncio.create_task(self.message_send_task()),
+            asyncio.create_task(self.message_receive_task()),
+        ]
+        try:
+            # a disconnect ends the receive task, a failed send or a session stop the send task :
+            # whichever ends first, the other one is cancelled
+            done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                task.result()
+        except (WebSocketDisconnect, Exception) as e:
+            print(e)
+            # await manager.broadcast(f"Client #{client_id} left the chat")
+        finally:
+            for task in tasks:
+                task.cancel()
+
     @property
     def is_connected(self) -> bool:
         return self._is_connected
 
 
 manager = ConnectionManager()
-g_simulators = {}
+# front mode : SIMULATION_WORKERS=/tmp/simulation-0.sock,/tmp/simulation-1.sock relays every
+# client to the simulation worker (worker.py) owning its session, nothing is simulated here
+simulation_workers = [path for path in os.environ.get('SIMULATION_WORKERS', '').split(',') if path]
+broker_client = BrokerClient(simulation_workers) if simulation_workers else None
+# MAX_SESSIONS : admission limit on concurrent sessions (0 : none), new sessions beyond it evict
+# the longest idle one or are refused with close code 1013. A shared session without subscribers
+# is kept SESSION_IDLE_TIMEOUT seconds for clients reconnecting with the same simulator_id.
+session_manager = SessionManager(
+    max_sessions=int(os.environ.get('MAX_SESSIONS', 64)),
+    idle_timeout=float(os.environ.get('SESSION_IDLE_TIMEOUT', 30)),
+)
+g_background_tasks = []
+# warm instances per simulator and config, SIMULATOR_POOL_SIZE idle instances at most per config.
+# SIMULATOR_POOL_PREFILL=sph_system,wave_2d_system builds default configs in the background at startup
+simulator_pool = SimulatorPool(max_idle=int(os.environ.get('SIMULATOR_POOL_SIZE', 2)))
+# bounds of the stepping options of a session (step_dt, max_substeps, max_dt)
+MAX_STEP_DT = 1.0
+MAX_SUBSTEPS = 1000
+MAX_LOOP_DT = 10.0
+# step executor backend per simulator : inline / thread / process / batch
+# (each simulator declares a default, STEP_EXECUTOR overrides it for all and
+# STEP_EXECUTOR_<SIMULATOR> per type)
+step_executor_workers = int(os.environ['STEP_EXECUTOR_WORKERS']) if 'STEP_EXECUTOR_WORKERS' in os.environ else None
+g_step_executors = {}
+
+
+def get_step_executor(simulator: str):
+    name = os.environ.get(
+        f'STEP_EXECUTOR_{simulator.upper()}',
+        os.environ.get('STEP_EXECUTOR', get_spec(simulator).step_executor),
+    )
+    if name not in g_step_executors:
+        g_step_executors[name] = create_step_executor(name, step_executor_workers)
+    return g_step_executors[name]
+
+
+# recordings made with record.py, replayed with /simulate/replay?recording=<name>
+recordings_dir = os.environ.get('RECORDINGS_DIR', 'recordings')
+# checkpoints made with make_checkpoint.py, sessions start from them with ?checkpoint=<name>
+checkpoints_dir = os.environ.get('CHECKPOINTS_DIR', 'checkpoints')
+
+
+def find_data_path(directory: str, name: Optional[str], suffix: str = '') -> Optional[str]:
+    # only plain names inside directory
+    if not name or os.path.basename(name) != name or name in ('.', '..'):
+        return None
+    path = os.path.join(directory, name + suffix)
+    return path if os.path.exists(path) else None
+
+
+def recording_path(recording: Optional[str]) -> Optional[str]:
+    return find_data_path(recordings_dir, recording)
+
+
+def checkpoint_path(checkpoint: Optional[str]) -> Optional[str]:
+    return find_data_path(checkpoints_dir, checkpoint, '.ckpt')
+
+
+def create_replay(recording: Optional[str] = None, playback_speed: float = 1.0, start_time: float = 0.0):
+    from simulator.recording import ReplaySystem
+    path = recording_path(recording)
+    if path is None:
+        raise ValueError(f'recording not found : {recording}')
+    return ReplaySystem(path, speed=playback_speed, start_time=start_time)
+
+
+register(SimulatorSpec(
+    'replay',
+    create_replay,
+    {
+        # recording name in RECORDINGS_DIR, playback speed relative to the recorded time
+        # and the recorded time to start from (clients change both while streaming with
+        # "seek <time>" and "speed <playback speed>" messages)
+        'recording': Param(str),
+        'playback_speed': Param(float, 1.0),
+        'start_time': Param(float, 0.0),
+    },
+    pooled=False,
+    checkpointable=False,
+    # replays only read memory mapped frames
+    step_executor='inline',
+))
+
+
+def restore_checkpoint(target_simulator, checkpoint: str) -> None:
+    path = checkpoint_path(checkpoint)
+    if path is None:
+        raise ValueError(f'checkpoint not found : {checkpoint}')
+    with open(path, 'rb') as f:
+        target_simulator.restore(f.read())
+
+
+def create_simulator(simulator: str, config: Optional[Dict] = None, checkpoint: Optional[str] = None):
+    # fresh instance outside the pool (record.py, make_checkpoint.py)
+    target_simulator = registry_create_simulator(simulator, config)
+    if checkpoint is not None:
+        restore_checkpoint(target_simulator, checkpoint)
+    return target_simulator
+
+
+def acquire_simulator(simulator: str, config: Dict, checkpoint: Optional[str] = None):
+    target_simulator = simulator_pool.acquire(simulator, config)
+    if checkpoint is not None:
+        restore_checkpoint(target_simulator, checkpoint)
+    return target_simulator
+
+
+@app.on_event("startup")
+async def prefill_simulator_pool():
+    for simulator in filter(None, os.environ.get('SIMULATOR_POOL_PREFILL', '').split(',')):
+        spec = get_spec(simulator)
+        g_background_tasks.append(asyncio.create_task(simulator_pool.prefill(simulator, parse_config(spec, {}))))
+
+
+@app.on_event("startup")
+async def start_session_expiry():
+    g_background_tasks.append(asyncio.create_task(session_manager.run_expiry()))
+
+
+@app.on_event("shutdown")
+async def shutdown_sessions():
+    for task in g_background_tasks:
+        task.cancel()
+    await session_manager.close()
+    if broker_client is not None:
+        await broker_client.close()
+    for step_executor in g_step_executors.values():
+        step_executor.shutdown()
 
 
 @app.get("/")
@@ -92,43 +252,270 @@ async def get():
     return 'simulator ready'
 
 
+def count_sessions_by_simulator():
+    counts = {(simulator,): 0 for simulator in SIMULATORS}
+    for session in session_manager.sessions.values():
+        counts[(session.simulator_type,)] += 1
+    return counts
+
+
+def count_subscribers_by_simulator():
+    counts = {(simulator,): 0 for simulator in SIMULATORS}
+    for session in session_manager.sessions.values():
+        counts[(session.simulator_type,)] += session.n_subscribers
+    return counts
+
+
+ACTIVE_SESSIONS.set_callback(count_sessions_by_simulator)
+ACTIVE_SUBSCRIBERS.set_callback(count_subscribers_by_simulator)
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def get_metrics():
+    if broker_client is None:
+        text = REGISTRY.render()
+    else:
+        # front mode : the metrics of this front (fan out, sends to its clients) and the ones
+        # of every simulation worker (steps, encoding), samples labelled with their process
+        expositions = {f'front-{os.getpid()}': REGISTRY.render()}
+        for index, path in enumerate(broker_client.socket_paths):
+            try:
+                expositions[f'worker-{index}'] = (await broker_client.request(path, {'type': 'metrics'}))['metrics']
+            except (OSError, TypeError) as e:
+                print(f'metrics of simulation worker {path} unavailable : {e}')
+        text = merge_expositions(expositions)
+    return PlainTextResponse(text, media_type='text/plain; version=0.0.4')
+
+
+def process_rss_bytes() -> Optional[int]:
+    # resident memory of the server process (linux only)
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def sessions_stats() -> Dict:
+    # sessions with their memory footprint (see SimulationSession.memory_footprint)
+    return {
+        'sessions': [session.stats() for session in session_manager.sessions.values()],
+        **session_manager.stats(),
+        'n_connections': len(manager.active_connections),
+        'process_rss_bytes': process_rss_bytes(),
+    }
+
+
+@app.get("/sessions")
+async def get_sessions():
+    if broker_client is None:
+        return sessions_stats()
+    # front mode : the sessions of every simulation worker
+    workers = []
+    for path in broker_client.socket_paths:
+        try:
+            workers.append({'socket': path, **await broker_client.request(path, {'type': 'sessions'})})
+        except (OSError, TypeError) as e:
+            workers.append({'socket': path, 'error': str(e)})
+    return {'n_connections': len(manager.active_connections), **broker_client.stats(), 'workers': workers}
+
+
+async def remove_session(session_id: int) -> Dict:
+    for session in list(session_manager.sessions.values()):
+        if session.session_id == session_id:
+            await session_manager.remove(session)
+            return {'session_id': session_id, 'expired': True}
+    return {'session_id': session_id, 'expired': False}
+
+
+@app.delete("/sessions/{session_id}")
+async def expire_session(session_id: int):
+    # stops the session right away, its clients are disconnected
+    if broker_client is None:
+        return await remove_session(session_id)
+    # front mode : the session id tells which simulation worker owns it
+    path = broker_client.worker_socket_path(session_id)
+    try:
+        return await broker_client.request(path, {'type': 'expire', 'session_id': session_id})
+    except OSError as e:
+        return {'session_id': session_id, 'expired': False, 'error': str(e)}
+
+
+@app.get("/simulators")
+async def get_simulators():
+    # registered simulators and the query parameters they accept
+    return {
+        'simulators': [
+            {
+                'name': spec.name,
+                'params': {
+                    name: {'type': param.type.__name__, 'default': param.default, 'min': param.min, 'max': param.max}
+                    for name, param in spec.params.items()
+                },
+                'checkpointable': spec.checkpointable,
+            }
+            for spec in SIMULATORS.values()
+        ],
+        'pool': simulator_pool.stats(),
+    }
+
+
 @app.websocket("/simulate/{simulator}")
 async def ws_simulate(
     websocket: WebSocket,
-    simulator: SimulatorList,
+    simulator: str,
     simulator_id: Optional[int] = None,
     min_dt: Optional[float] = 0.005,
     max_dt:Optional[float] = 0.1,
+    frame_format: FrameFormat = FrameFormat.JSON,
+    send_queue_size: Optional[int] = 4,
+    step_dt: Optional[float] = 0.005,
+    max_substeps: Optional[int] = 20,
+    keyframe_interval: Optional[int] = 0,
+    ack_window: Optional[int] = 0,
+    checkpoint: Optional[str] = None,
+    max_particles: Optional[int] = 0,
+    roi: Optional[str] = None,
+    grid_stride: Optional[int] = 1,
+    compression: Optional[str] = None,
+    compression_level: Optional[int] = None,
 ):
-    print(f'simulator_id : {simulator_id}')
-    global g_simulators
+    # min_dt : minimum interval between frames sent to this client
+    # max_dt : maximum wall clock time simulated per loop iteration
+    # step_dt, max_substeps : fixed physics timestep and substep cap per iteration
+    # (a step longer than the simulator's max_stable_dt() is split into stable substeps when it runs)
+    # (step_dt, max_substeps and max_dt are taken from the client creating the session)
+    # keyframe_interval : frame_format=compact only, send deltas between keyframes when > 1
+    # ack_window : flow control, at most ack_window messages not yet acked with "ok" (0 : off)
+    # simulator parameters (GET /simulators lists them, e.g. n_particles, seed, recording for replay)
+    # are query parameters too, sessions are only shared between clients asking for the same ones
+    # checkpoint : start from a checkpoint in CHECKPOINTS_DIR instead of the initial state
+    # (shared sessions are only joined by clients asking for the same checkpoint)
+    # max_particles, roi, grid_stride : level of detail of this client's frames, at most max_particles
+    # particles (0 : all), only what is inside roi="x_min,y_min,z_min,x_max,y_max,z_max",
+    # every grid_stride-th wave grid point
+    # compression, compression_level : application level codec of the frames (zlib, shuffle-zlib,
+    # lz4 and shuffle-lz4 when installed), compressed frames are binary messages. shuffle-* codecs
+    # need frame_format=binary or compact. Servers started with run_server.py don't negotiate
+    # permessage-deflate for them (deflate settings : streaming/deflate.py).
+    # frame_format=diagnostics : small json summaries of the simulator's diagnostics (energies,
+    # pressure, density histograms, ...) instead of its states, see streaming/diagnostics.py
+    options = {name: value for name, value in locals().items() if name not in ('websocket', 'simulator')}
+    if broker_client is not None:
+        await relay_simulation(websocket, simulator, options)
+    else:
+        await serve_simulation(websocket, simulator, options)
+
+
+def session_key(simulator: str, config: Dict, simulator_id: Optional[int], checkpoint: Optional[str] = None):
+    # connections with the same simulator, simulator_id, config and checkpoint share one session
+    if simulator_id is None:
+        return None
+    return SimulatorPool.key(simulator, config) + (checkpoint, simulator_id)
+
+
+def parse_options(simulator: str, query_params, options: Dict) -> Tuple[Dict, StreamView, Optional[object]]:
+    # simulator config, view and codec of a client (ValueError : invalid options)
+    spec = get_spec(simulator)
+    config = parse_config(spec, query_params)
+    if not 0 < options['step_dt'] <= MAX_STEP_DT:
+        raise ValueError(f'step_dt must be in (0, {MAX_STEP_DT}] : {options["step_dt"]}')
+    if not 1 <= options['max_substeps'] <= MAX_SUBSTEPS:
+        raise ValueError(f'max_substeps must be in [1, {MAX_SUBSTEPS}] : {options["max_substeps"]}')
+    if not 0 < options['max_dt'] <= MAX_LOOP_DT:
+        raise ValueError(f'max_dt must be in (0, {MAX_LOOP_DT}] : {options["max_dt"]}')
+    checkpoint = options['checkpoint']
+    if checkpoint is not None and (not spec.checkpointable or checkpoint_path(checkpoint) is None):
+        raise ValueError(f'checkpoint not found : {checkpoint}')
+    view = StreamView(max(0, options['max_particles']), parse_roi(options['roi']), max(1, options['grid_stride']))
+    if options['frame_format'] == FrameFormat.DIAGNOSTICS:
+        # reductions cover the whole simulation
+        view = StreamView()
+    codec = create_codec(options['compression'], options['compression_level'])
+    if codec is not None and codec.name.startswith('shuffle-') and options['frame_format'] in (FrameFormat.JSON, FrameFormat.DIAGNOSTICS):
+        raise ValueError(f'{codec.name} needs a binary frame format')
+    return config, view, codec
+
+
+def create_subscriber(websocket, simulator: str, options: Dict, view: StreamView, codec, subscriber_class=Subscriber):
+    return subscriber_class(
+        websocket, options['frame_format'], max(1, options['send_queue_size']), options['min_dt'],
+        options['keyframe_interval'], simulator, options['ack_window'], view,
+        (codec.name, codec.level) if codec is not None else None,
+    )
+
+
+async def relay_simulation(websocket: WebSocket, simulator: str, options: Dict):
+    # front mode : the session lives in the simulation worker its key maps to. This front
+    # subscribes to it through a feed shared by its clients with the same session and
+    # encoding, and fans the frames out to them (streaming/broker.py)
+    await manager.connect(websocket)
+    try:
+        config, view, codec = parse_options(simulator, websocket.query_params, options)
+    except ValueError as e:
+        print(f'invalid options : {e}')
+        manager.disconnect(websocket)
+        await websocket.close(code=1008)
+        return
+    subscriber = create_subscriber(websocket, simulator, options, view, codec)
+    hello = {
+        'type': 'subscribe',
+        'simulator': simulator,
+        # the worker paces the feed by min_dt only, flow control stays between the front and its clients
+        'options': {**options, 'frame_format': options['frame_format'].value, 'ack_window': 0},
+        'query': dict(websocket.query_params),
+    }
+    key = session_key(simulator, config, options['simulator_id'], options['checkpoint'])
+    feed = broker_client.subscribe(key, subscriber, hello)
+    try:
+        await WSMessageHandler(websocket, feed, subscriber, manager).run()
+    finally:
+        manager.disconnect(websocket)
+        await asyncio.shield(broker_client.unsubscribe(feed, subscriber))
+    if feed.close_code not in (None, 1000):
+        # the worker refused the session (1008, 1013) or it failed
+        try:
+            await websocket.close(code=feed.close_code)
+        except RuntimeError:
+            # the client is gone already
+            pass
+
+
+async def serve_simulation(websocket, simulator: str, options: Dict, feed: bool = False):
+    # websocket : a client connection, or a BrokerConnection of a front's feed (worker.py)
+    print(f'simulator_id : {options["simulator_id"]}')
     await manager.connect(websocket)
     try:
-        if simulator == SimulatorList.IDEAL_GAS_SYSTEM:
-            ig_simulator = IdealGasSystem(
-                n_particles=100,
-                xmin=-10, xmax=10, ymin=-10, ymax=10, zmin=-10, zmax=10,
-            )
-            target_simulator = g_simulators[id(ig_simulator)] = ig_simulator
-        elif simulator == SimulatorList.WAVE_2D_SYSTEM:
-            target_simulator = Wave2DSystem(
-                n_grid_x=50,
-                n_grid_z=50,
-                dx=0.25,
-                dz=0.25,
-            )
-            g_simulators[id(target_simulator)] = target_simulator
-        elif simulator == SimulatorList.SPH_SYSTEM:
-            target_simulator = SPHSystem(n_particles=500)
-            g_simulators[id(target_simulator)] = target_simulator
-
-        message_handler = WSMessageHandler(websocket, target_simulator, manager, min_dt, max_dt)
-
-        L = await asyncio.gather(
-            message_handler.message_send_task(),
-            message_handler.message_receive_task(),
+        config, view, codec = parse_options(simulator, websocket.query_params, options)
+    except ValueError as e:
+        print(f'invalid options : {e}')
+        manager.disconnect(websocket)
+        await websocket.close(code=1008)
+        return
+    subscriber = create_subscriber(websocket, simulator, options, view, codec, FeedSubscriber if feed else Subscriber)
+    checkpoint = options['checkpoint']
+    try:
+        session = await session_manager.join(
+            session_key(simulator, config, options['simulator_id'], checkpoint), simulator,
+            lambda: acquire_simulator(simulator, config, checkpoint),
+            get_step_executor(simulator),
+            subscriber, options['step_dt'], options['max_substeps'], options['max_dt'],
+            release=lambda target_simulator: simulator_pool.release(simulator, config, target_simulator),
         )
-    except (WebSocketDisconnect, Exception) as e:
+    except SessionLimitError as e:
         print(e)
         manager.disconnect(websocket)
-        # await manager.broadcast(f"Client #{client_id} left the chat")
+        # try again later
+        await websocket.close(code=1013)
+        return
+    except (OSError, ValueError) as e:
+        print(f'simulator creation failed : {e}')
+        manager.disconnect(websocket)
+        await websocket.close(code=1008)
+        return
+    try:
+        await WSMessageHandler(websocket, session, subscriber, manager).run()
+    finally:
+        manager.disconnect(websocket)
+        # runs to the end even when the connection handler itself is cancelled
+        await asyncio.shield(session_manager.detach(session, subscriber))
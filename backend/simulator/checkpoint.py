@@ -0,0 +1,39 @@
+import io
+import json
+from typing import Dict
+
+import numpy as np
+
+
+# Checkpoint blob : an uncompressed .npz archive (no pickled objects) holding the
+# state arrays of a simulator, its class name and the state of its random generator.
+
+SIMULATOR_KEY = '__simulator__'
+RNG_STATE_KEY = '__rng_state__'
+
+
+def save_checkpoint(simulator_name: str, states: Dict, rng: np.random.Generator) -> bytes:
+    arrays = {key: np.asarray(value) for key, value in states.items()}
+    arrays[SIMULATOR_KEY] = np.array(simulator_name)
+    arrays[RNG_STATE_KEY] = np.array(json.dumps(rng.bit_generator.state))
+    buf = io.BytesIO()
+    np.savez(buf, **arrays)
+    return buf.getvalue()
+
+
+def load_checkpoint(blob: bytes, simulator_name: str, rng: np.random.Generator) -> Dict:
+    # returns the state arrays and restores the generator state
+    with np.load(io.BytesIO(blob), allow_pickle=False) as archive:
+        arrays = {key: archive[key] for key in archive.files}
+    saved_name = str(arrays.pop(SIMULATOR_KEY))
+    if saved_name != simulator_name:
+        raise ValueError(f'checkpoint of {saved_name} can not be restored into {simulator_name}')
+    rng.bit_generator.state = json.loads(str(arrays.pop(RNG_STATE_KEY)))
+    return arrays
+
+
+def copy_state(target: np.ndarray, value: np.ndarray, name: str) -> None:
+    # in place, other objects may hold views of the target (e.g. IdealGasBatch)
+    if target.shape != value.shape:
+        raise ValueError(f'checkpoint {name} has shape {value.shape}, expected {target.shape}')
+    np.copyto(target, value)
@@ -1,6 +1,30 @@
-from typing import Dict
+import math
+from typing import Dict, List, Optional
 import numpy as np
 
+from simulator.checkpoint import copy_state, load_checkpoint, save_checkpoint
+
+# contact cell ids are int64 linear indices on a grid of cells one diameter wide over the box
+MAX_GRID_CELLS = 2**62
+
+
+def reflect(ps: np.ndarray, vs: np.ndarray, lo: np.ndarray, hi: np.ndarray, mask: Optional[np.ndarray] = None) -> np.ndarray:
+    # fold positions that went past a wall back inside and flip their velocity, in place
+    # (lo, hi and mask broadcast against ps). Returns the momentum per unit mass given
+    # to the walls (2|v| per flipped component), summed over the last two axes.
+    over = ps >= hi
+    if mask is not None:
+        over &= mask
+    np.subtract(hi, ps - hi, out=ps, where=over)
+    np.negative(vs, out=vs, where=over)
+    under = ps <= lo
+    if mask is not None:
+        under &= mask
+    np.add(lo, lo - ps, out=ps, where=under)
+    np.negative(vs, out=vs, where=under)
+    over |= under
+    return 2 * np.abs(vs, out=np.zeros_like(vs), where=over).sum(axis=(-2, -1))
+
 
 class IdealGasSystem:
 
@@ -13,7 +37,20 @@ class IdealGasSystem:
         ymax: float = 1.0,
         zmin: float = -1.0,
         zmax: float = 1.0,
+        particle_radius: float = 0.0,
+        particle_mass: float = 1.0,
+        seed: Optional[int] = None,
     ):
+        # particle_radius > 0 : particles collide as elastic hard spheres
+        if particle_radius > 0:
+            # the contact grid spans the box plus one cell of margin on each side, counted in
+            # floats so that a tiny radius can not overflow the count itself
+            extents = [xmax - xmin, ymax - ymin, zmax - zmin]
+            n_grid_cells = math.prod(e / (2 * particle_radius) + 3 for e in extents)
+            if n_grid_cells > MAX_GRID_CELLS:
+                raise ValueError(
+                    f'{n_grid_cells:.3g} contact grid cells, at most {MAX_GRID_CELLS} : use a larger particle_radius'
+                )
         self._n_particles = n_particles
         self._xmin = xmin
         self._xmax = xmax
@@ -21,53 +58,303 @@ class IdealGasSystem:
         self._ymax = ymax
         self._zmin = zmin
         self._zmax = zmax
+        self._particle_radius = particle_radius
+        self._particle_mass = particle_mass
+        self._rng = np.random.default_rng(seed)
         self.init()
 
     def init(self):
         # positions
         self._ps = np.zeros((self._n_particles, 3))
-        self._ps[:, 0] = np.random.uniform(
+        self._ps[:, 0] = self._rng.uniform(
             self._xmin, self._xmax, self._n_particles,
         )
-        self._ps[:, 1] = np.random.uniform(
+        self._ps[:, 1] = self._rng.uniform(
             self._ymin, self._ymax, self._n_particles,
         )
-        self._ps[:, 2] = np.random.uniform(
+        self._ps[:, 2] = self._rng.uniform(
             self._zmin, self._zmax, self._n_particles,
         )
         # velocities
-        self._vs = 6*np.random.randn(self._n_particles, 3)
+        self._vs = 6*self._rng.standard_normal((self._n_particles, 3))
         # time
         self._t = 0.0
+        self._n_collisions = 0
+        # momentum given to the walls per unit wall area since init
+        self._wall_momentum = 0.0
 
     def update(self, dt: float) -> None:
         self._t += dt
         self._ps += dt * self._vs
-        # x reflection
-        particle_indices = np.where(self._ps[:, 0] >= self._xmax)[0]
-        self._ps[particle_indices, 0] = self._xmax - (self._ps[particle_indices, 0] - self._xmax)
-        self._vs[particle_indices, 0] = -self._vs[particle_indices, 0]
-        particle_indices = np.where(self._ps[:, 0] <= self._xmin)[0]
-        self._ps[particle_indices, 0] = self._xmin + (self._xmin - self._ps[particle_indices, 0])
-        self._vs[particle_indices, 0] = -self._vs[particle_indices, 0]
-        # y reflection
-        particle_indices = np.where(self._ps[:, 1] >= self._ymax)[0]
-        self._ps[particle_indices, 1] = self._ymax - (self._ps[particle_indices, 1] - self._ymax)
-        self._vs[particle_indices, 1] = -self._vs[particle_indices, 1]
-        particle_indices = np.where(self._ps[:, 1] <= self._ymin)[0]
-        self._ps[particle_indices, 1] = self._ymin + (self._ymin - self._ps[particle_indices, 1])
-        self._vs[particle_indices, 1] = -self._vs[particle_indices, 1]
-        # z reflection
-        particle_indices = np.where(self._ps[:, 2] >= self._zmax)[0]
-        self._ps[particle_indices, 2] = self._zmax - (self._ps[particle_indices, 2] - self._zmax)
-        self._vs[particle_indices, 2] = -self._vs[particle_indices, 2]
-        particle_indices = np.where(self._ps[:, 2] <= self._zmin)[0]
-        self._ps[particle_indices, 2] = self._zmin + (self._zmin - self._ps[particle_indices, 2])
-        self._vs[particle_indices, 2] = -self._vs[particle_indices, 2]
+        # sphere centers bounce one radius away from the walls
+        r = self._particle_radius
+        wall_momentum = reflect(
+            self._ps, self._vs,
+            np.array([self._xmin, self._ymin, self._zmin]) + r,
+            np.array([self._xmax, self._ymax, self._zmax]) - r,
+        )
+        self._wall_momentum += self._particle_mass * float(wall_momentum) / self.wall_area
+        if r > 0:
+            pair_i, pair_j = self.find_contact_pairs()
+            self._n_collisions = self.collide(pair_i, pair_j)
+
+    def max_stable_dt(self) -> float:
+        # free flight is exact for any dt, colliding spheres should not move
+        # more than a radius per step or contacts are missed
+        if self._particle_radius <= 0:
+            return np.inf
+        v_max = np.sqrt(np.einsum('ij,ij->i', self._vs, self._vs).max(initial=0.0))
+        return self._particle_radius / v_max if v_max > 0 else np.inf
+
+    def find_contact_pairs(self):
+        # sorted cell broad phase : cells of one diameter, so touching spheres are
+        # in the same or adjacent cells. Each pair is found once by looking at the
+        # particle's own cell (later particles only) and 13 of its 26 neighbor cells.
+        d = 2 * self._particle_radius
+        lo = np.array([self._xmin, self._ymin, self._zmin])
+        cells = ((self._ps - lo) // d).astype(np.int64)
+        # shift so that every cell and its neighbors has a non-negative index
+        cells -= cells.min(axis=0) - 1
+        grid_dims = cells.max(axis=0) + 2
+        cell_ids = (cells[:, 0]*grid_dims[1] + cells[:, 1])*grid_dims[2] + cells[:, 2]
+        order = np.argsort(cell_ids, kind='stable')
+        sorted_cell_ids = cell_ids[order]
+        # occupied cells and the range of sorted positions they hold
+        is_first = np.ones(self._n_particles, dtype=bool)
+        is_first[1:] = sorted_cell_ids[1:] != sorted_cell_ids[:-1]
+        cell_starts = np.flatnonzero(is_first)
+        cell_ends = np.append(cell_starts[1:], self._n_particles)
+        occupied_cells = sorted_cell_ids[cell_starts]
+        cell_index = np.cumsum(is_first) - 1  # occupied cell of each sorted particle
+
+        # half stencil : offsets lexicographically after (0, 0, 0)
+        o = np.array([-1, 0, 1])
+        dx, dy, dz = np.meshgrid(o, o, o, indexing='ij')
+        cell_offsets = ((dx*grid_dims[1] + dy)*grid_dims[2] + dz).ravel()[14:]
+
+        # pairs within one cell : each sorted particle with the ones sorted after it
+        sorted_ids = np.arange(self._n_particles)
+        counts = cell_ends[cell_index] - sorted_ids - 1
+        n_pairs = counts.sum()
+        sorted_i = np.repeat(sorted_ids, counts)
+        sorted_j = np.arange(n_pairs) - np.repeat(np.cumsum(counts) - counts - sorted_ids - 1, counts)
+
+        # pairs of neighboring occupied cells, mostly empty in a dilute gas : size=(n_occupied, 13)
+        neighbor_cells = occupied_cells.reshape(-1, 1) + cell_offsets.reshape(1, -1)
+        found = np.minimum(np.searchsorted(occupied_cells, neighbor_cells), len(occupied_cells)-1)
+        cell_a, offset_ids = np.nonzero(occupied_cells[found] == neighbor_cells)
+        cell_b = found[cell_a, offset_ids]
+        # every particle of cell a with every particle of cell b
+        n_a = (cell_ends - cell_starts)[cell_a]
+        n_b = (cell_ends - cell_starts)[cell_b]
+        counts = n_a * n_b
+        segments = np.repeat(np.arange(len(counts)), counts)
+        k = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        sorted_i = np.concatenate([sorted_i, cell_starts[cell_a][segments] + k // n_b[segments]])
+        sorted_j = np.concatenate([sorted_j, cell_starts[cell_b][segments] + k % n_b[segments]])
+        pair_i = order[sorted_i]
+        pair_j = order[sorted_j]
+
+        # narrow phase : overlapping spheres
+        rvs = np.take(self._ps, pair_i, axis=0) - np.take(self._ps, pair_j, axis=0)
+        touching = np.einsum('ij,ij->i', rvs, rvs) < d**2
+        return pair_i[touching], pair_j[touching]
+
+    def collide(self, pair_i: np.ndarray, pair_j: np.ndarray, max_rounds: int = 8) -> int:
+        # elastic collisions of equal mass spheres : exchange the normal velocity components.
+        # A particle touching several others is resolved one pair per round (the pairs
+        # of a round share no particle) so that every exchange conserves energy exactly.
+        n_collisions = 0
+        for _ in range(max_rounds):
+            rvs = np.take(self._ps, pair_i, axis=0) - np.take(self._ps, pair_j, axis=0)
+            dvs = np.take(self._vs, pair_i, axis=0) - np.take(self._vs, pair_j, axis=0)
+            approaching = np.einsum('ij,ij->i', rvs, dvs) < 0
+            pair_i = pair_i[approaching]
+            pair_j = pair_j[approaching]
+            if len(pair_i) == 0:
+                break
+            rvs = rvs[approaching]
+            dvs = dvs[approaching]
+            # keep the pairs that are the first pair of both their particles
+            pair_ids = np.arange(len(pair_i))
+            first_pair = np.full(self._n_particles, len(pair_i))
+            np.minimum.at(first_pair, pair_i, pair_ids)
+            np.minimum.at(first_pair, pair_j, pair_ids)
+            selected = (first_pair[pair_i] == pair_ids) & (first_pair[pair_j] == pair_ids)
+            rvs = rvs[selected]
+            r2 = np.einsum('ij,ij->i', rvs, rvs)
+            # coincident centers have no normal, leave them alone
+            r2 = np.where(r2 > 0, r2, np.inf)
+            impulses = (np.einsum('ij,ij->i', rvs, dvs[selected]) / r2).reshape(-1, 1) * rvs
+            self._vs[pair_i[selected]] -= impulses
+            self._vs[pair_j[selected]] += impulses
+            n_collisions += int(selected.sum())
+            pair_i = pair_i[~selected]
+            pair_j = pair_j[~selected]
+        return n_collisions
+
+    def checkpoint(self) -> bytes:
+        return save_checkpoint(
+            type(self).__name__,
+            {
+                'time': self._t, 'positions': self._ps, 'velocities': self._vs,
+                # cumulative diagnostics, so that pressure and collision counts carry on
+                'wall_momentum': self._wall_momentum, 'n_collisions': self._n_collisions,
+            },
+            self._rng,
+        )
+
+    def restore(self, blob: bytes) -> None:
+        states = load_checkpoint(blob, type(self).__name__, self._rng)
+        copy_state(self._ps, states['positions'], 'positions')
+        copy_state(self._vs, states['velocities'], 'velocities')
+        self._t = float(states['time'])
+        # absent from checkpoints made before they were saved
+        self._wall_momentum = float(states.get('wall_momentum', 0.0))
+        self._n_collisions = int(states.get('n_collisions', 0))
+
+    @property
+    def wall_area(self) -> float:
+        a, b, c = self._xmax - self._xmin, self._ymax - self._ymin, self._zmax - self._zmin
+        return 2 * (a*b + b*c + c*a)
+
+    def get_diagnostics(self) -> Dict:
+        # wall_momentum_total : its rate over time is the pressure on the walls
+        # temperature : mean kinetic energy per degree of freedom (k_B = 1)
+        m = self._particle_mass
+        kinetic_energy = 0.5 * m * float(np.einsum('ij,ij->', self._vs, self._vs))
+        return {
+            'time': self._t,
+            'kinetic_energy': kinetic_energy,
+            'temperature': kinetic_energy / (1.5 * self._n_particles),
+            'momentum': (m * self._vs.sum(axis=0)).tolist(),
+            'wall_momentum_total': self._wall_momentum,
+            'n_collisions': self._n_collisions,
+        }
 
     def get_states(self) -> Dict:
         return {
             'time': self._t,
             'positions': self._ps.tolist(),
             'velocities': self._vs.tolist(),
+            **self.get_diagnostics(),
         }
+
+    def get_state_arrays(self) -> Dict:
+        return {
+            'time': self._t,
+            'positions': self._ps,
+            'velocities': self._vs,
+        }
+
+    def get_static_states(self) -> Dict:
+        return {
+            'n_particles': self._n_particles,
+        }
+
+    def get_dynamic_state_arrays(self) -> Dict:
+        # velocities are not drawn by the frontend
+        return {
+            'time': self._t,
+            'positions': self._ps,
+        }
+
+    def get_field_bounds(self) -> Dict:
+        return {
+            'positions': (
+                np.array([self._xmin, self._ymin, self._zmin]),
+                np.array([self._xmax, self._ymax, self._zmax]),
+            ),
+        }
+
+
+class IdealGasBatch:
+    # many IdealGasSystem instances with the same particle count stepped together :
+    # states live in (capacity, n_particles, 3) arrays, one slot per instance.
+    # The instances' _ps / _vs are rebound to views of their slot, so their
+    # get_states() etc. keep working unchanged.
+
+    def __init__(self, n_particles: int, capacity: int = 16):
+        self._n_particles = n_particles
+        self._capacity = 0
+        self._ps = np.zeros((0, n_particles, 3))
+        self._vs = np.zeros((0, n_particles, 3))
+        self._lo = np.zeros((0, 1, 3))
+        self._hi = np.zeros((0, 1, 3))
+        self._t = np.zeros(0)
+        self._occupied = np.zeros(0, dtype=bool)
+        self._simulators: List[Optional[IdealGasSystem]] = []
+        self._free_slots: List[int] = []
+        self.grow(capacity)
+
+    def grow(self, capacity: int) -> None:
+        n_new = capacity - self._capacity
+        self._ps = np.concatenate([self._ps, np.zeros((n_new, self._n_particles, 3))])
+        self._vs = np.concatenate([self._vs, np.zeros((n_new, self._n_particles, 3))])
+        # empty slots get an infinite box so that they never reflect
+        self._lo = np.concatenate([self._lo, np.full((n_new, 1, 3), -np.inf)])
+        self._hi = np.concatenate([self._hi, np.full((n_new, 1, 3), np.inf)])
+        self._t = np.concatenate([self._t, np.zeros(n_new)])
+        self._occupied = np.concatenate([self._occupied, np.zeros(n_new, dtype=bool)])
+        self._simulators += [None] * n_new
+        self._free_slots += list(range(capacity-1, self._capacity-1, -1))
+        self._capacity = capacity
+        # arrays were reallocated : rebind the views of the instances
+        for slot, simulator in enumerate(self._simulators):
+            if simulator is not None:
+                self.bind(slot, simulator)
+
+    def bind(self, slot: int, simulator: IdealGasSystem) -> None:
+        simulator._ps = self._ps[slot]
+        simulator._vs = self._vs[slot]
+
+    def add(self, simulator: IdealGasSystem) -> int:
+        if simulator._n_particles != self._n_particles:
+            raise ValueError(f'expected {self._n_particles} particles, got {simulator._n_particles}')
+        if simulator._particle_radius > 0:
+            raise ValueError('colliding instances can not be batched')
+        if not self._free_slots:
+            self.grow(2 * self._capacity)
+        slot = self._free_slots.pop()
+        self._ps[slot] = simulator._ps
+        self._vs[slot] = simulator._vs
+        self._lo[slot, 0] = [simulator._xmin, simulator._ymin, simulator._zmin]
+        self._hi[slot, 0] = [simulator._xmax, simulator._ymax, simulator._zmax]
+        self._t[slot] = simulator._t
+        self._simulators[slot] = simulator
+        self._occupied[slot] = True
+        self.bind(slot, simulator)
+        return slot
+
+    def remove(self, slot: int) -> None:
+        simulator = self._simulators[slot]
+        # give the instance its own arrays back
+        simulator._ps = self._ps[slot].copy()
+        simulator._vs = self._vs[slot].copy()
+        self._simulators[slot] = None
+        self._occupied[slot] = False
+        self._ps[slot] = 0.0
+        self._vs[slot] = 0.0
+        self._lo[slot] = -np.inf
+        self._hi[slot] = np.inf
+        self._free_slots.append(slot)
+
+    def update(self, dts: np.ndarray) -> None:
+        # dts : (capacity,) time step per slot, 0 for slots that don't step this time
+        stepping = (dts > 0) & self._occupied
+        dts = np.where(stepping, dts, 0.0)
+        self._t += dts
+        self._ps += dts.reshape(-1, 1, 1) * self._vs
+        wall_momentum = reflect(self._ps, self._vs, self._lo, self._hi, stepping.reshape(-1, 1, 1))
+        for slot in np.flatnonzero(stepping):
+            simulator = self._simulators[slot]
+            simulator._t = float(self._t[slot])
+            simulator._wall_momentum += simulator._particle_mass * float(wall_momentum[slot]) / simulator.wall_area
+
+    @property
+    def capacity(self) -> int:
+        return self._capacity
+
+    @property
+    def n_instances(self) -> int:
+        return self._capacity - len(self._free_slots)
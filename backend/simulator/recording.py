@@ -0,0 +1,249 @@
+import json
+import os
+from typing import Dict, List, Optional, Sequence
+
+import numpy as np
+
+
+# Recording layout : a directory holding
+#   meta.json             : fields (shape, dtype), chunk size, frame count, static states, bounds
+#   <field>.<chunk>.npy   : (chunk_size, *shape) memory mapped .npy files, one per field and chunk
+# The recorded 'time' is stored as a field too and serves as the time index.
+
+META_FILE = 'meta.json'
+
+# extra per particle arrays that are not part of get_state_arrays()
+OPTIONAL_FIELDS = {
+    'velocities': '_vs',
+    'densities': '_densities',
+    'pressures': '_pressures',
+}
+
+
+def _chunk_path(path: str, field: str, chunk: int) -> str:
+    return os.path.join(path, f'{field}.{chunk:05d}.npy')
+
+
+def _to_json(value):
+    if isinstance(value, dict):
+        return {key: _to_json(v) for key, v in value.items()}
+    if isinstance(value, (np.ndarray, np.generic)):
+        return value.tolist()
+    if isinstance(value, (tuple, list)):
+        return [_to_json(v) for v in value]
+    return value
+
+
+class SimulationRecorder:
+    # appends the state arrays of a simulator after each step
+
+    def __init__(
+        self,
+        path: str,
+        simulator_type: str = '',
+        extra_fields: Sequence[str] = (),
+        chunk_size: int = 256,
+        dtype=np.float32,
+    ):
+        self._path = path
+        self._simulator_type = simulator_type
+        self._extra_fields = tuple(extra_fields)
+        self._chunk_size = chunk_size
+        self._dtype = np.dtype(dtype)
+        self._meta: Optional[Dict] = None
+        self._chunks: Dict[str, np.memmap] = {}
+        self._n_frames = 0
+
+    def collect(self, simulator) -> Dict:
+        arrays = {'time': np.asarray(simulator.get_state_arrays()['time'], dtype=np.float64)}
+        for getter in ('get_state_arrays', 'get_dynamic_state_arrays'):
+            for key, value in getattr(simulator, getter)().items():
+                if isinstance(value, np.ndarray):
+                    arrays[key] = value
+        for field in self._extra_fields:
+            arrays[field] = getattr(simulator, OPTIONAL_FIELDS[field])
+        return arrays
+
+    def start(self, simulator, arrays: Dict) -> None:
+        os.makedirs(self._path, exist_ok=True)
+        self._meta = {
+            'simulator_type': self._simulator_type,
+            'chunk_size': self._chunk_size,
+            'n_frames': 0,
+            'fields': {
+                key: {
+                    'shape': list(value.shape),
+                    # time stays float64, floating point states are stored as dtype
+                    'dtype': (self._dtype if value.dtype.kind == 'f' and key != 'time' else value.dtype).str,
+                }
+                for key, value in arrays.items()
+            },
+            'state_fields': [k for k, v in simulator.get_state_arrays().items() if isinstance(v, np.ndarray)],
+            'dynamic_fields': [k for k, v in simulator.get_dynamic_state_arrays().items() if isinstance(v, np.ndarray)],
+            'static_states': _to_json(simulator.get_static_states()),
+            'field_bounds': _to_json(simulator.get_field_bounds()),
+        }
+
+    def record(self, simulator) -> None:
+        arrays = self.collect(simulator)
+        if self._meta is None:
+            self.start(simulator, arrays)
+        chunk, row = divmod(self._n_frames, self._chunk_size)
+        if row == 0:
+            self.open_chunks(chunk)
+        for key, value in arrays.items():
+            self._chunks[key][row] = value
+        self._n_frames += 1
+        if row == self._chunk_size - 1:
+            self.flush()
+
+    def open_chunks(self, chunk: int) -> None:
+        self.flush()
+        self._chunks = {
+            key: np.lib.format.open_memmap(
+                _chunk_path(self._path, key, chunk), mode='w+',
+                dtype=np.dtype(spec['dtype']), shape=(self._chunk_size, *spec['shape']),
+            )
+            for key, spec in self._meta['fields'].items()
+        }
+
+    def flush(self) -> None:
+        for chunk in self._chunks.values():
+            chunk.flush()
+        if self._meta is None:
+            return
+        # readers only trust frames counted in meta.json, write it atomically
+        self._meta['n_frames'] = self._n_frames
+        tmp_path = os.path.join(self._path, META_FILE + '.tmp')
+        with open(tmp_path, 'w') as f:
+            json.dump(self._meta, f)
+        os.replace(tmp_path, os.path.join(self._path, META_FILE))
+
+    def close(self) -> None:
+        self.flush()
+        self._chunks = {}
+
+    @property
+    def n_frames(self) -> int:
+        return self._n_frames
+
+
+class ReplaySystem:
+    # plays a recording back as a simulator : states are views into the
+    # memory mapped chunks, update() only moves the playback time
+
+    def __init__(self, path: str, speed: float = 1.0, start_time: float = 0.0, loop: bool = True):
+        with open(os.path.join(path, META_FILE)) as f:
+            self._meta = json.load(f)
+        self._path = path
+        self._chunk_size = self._meta['chunk_size']
+        self._n_frames = self._meta['n_frames']
+        if self._n_frames == 0:
+            raise ValueError(f'empty recording : {path}')
+        self._chunks: Dict[tuple, np.memmap] = {}
+        # time index
+        self._times = np.concatenate([
+            self.chunk('time', chunk)
+            for chunk in range((self._n_frames - 1) // self._chunk_size + 1)
+        ])[:self._n_frames]
+        self._speed = speed
+        self._loop = loop
+        self.seek(start_time)
+
+    def chunk(self, field: str, chunk: int) -> np.memmap:
+        if (field, chunk) not in self._chunks:
+            self._chunks[(field, chunk)] = np.load(_chunk_path(self._path, field, chunk), mmap_mode='r')
+        return self._chunks[(field, chunk)]
+
+    def seek(self, t: float) -> None:
+        # playback time in recording time, clamped to (or wrapped into) the recording
+        start, end = self._times[0], self._times[-1]
+        if self._loop and end > start and not start <= t <= end:
+            t = start + (t - start) % (end - start)
+        self._playback_time = float(np.clip(t, start, end))
+        self._frame = int(np.clip(np.searchsorted(self._times, self._playback_time, side='right') - 1, 0, self._n_frames - 1))
+
+    def update(self, dt: float) -> None:
+        self.seek(self._playback_time + self._speed * dt)
+
+    def control(self, command: str, value: float) -> None:
+        # playback controls clients send while streaming : 'seek' to a recorded time,
+        # 'speed' of the playback (negative plays backwards)
+        if command == 'seek':
+            self.seek(value)
+        elif command == 'speed':
+            self.speed = value
+        else:
+            raise ValueError(f'unknown playback control : {command}')
+
+    def max_stable_dt(self) -> float:
+        return np.inf
+
+    def get_frame(self, fields: List[str]) -> Dict:
+        chunk, row = divmod(self._frame, self._chunk_size)
+        states = {'time': float(self._times[self._frame])}
+        for field in fields:
+            states[field] = self.chunk(field, chunk)[row]
+        return states
+
+    def get_diagnostics(self) -> Dict:
+        # what the recorded fields allow (kinetic energy per unit mass from velocities, ...)
+        fields = [field for field in ('velocities', 'densities', 'pressures') if field in self._meta['fields']]
+        frame = self.get_frame(fields)
+        diagnostics = {'time': frame['time']}
+        if 'velocities' in frame:
+            velocities = np.asarray(frame['velocities'], dtype=np.float64)
+            diagnostics['kinetic_energy'] = 0.5 * float(np.einsum('ij,ij->', velocities, velocities))
+        for field, name in (('densities', 'density'), ('pressures', 'pressure')):
+            if field in frame:
+                diagnostics[f'{name}_mean'] = float(frame[field].mean())
+                diagnostics[f'{name}_max'] = float(frame[field].max())
+        return diagnostics
+
+    def get_states(self) -> Dict:
+        return {
+            key: value.tolist() if isinstance(value, np.ndarray) else value
+            for key, value in self.get_state_arrays().items()
+        }
+
+    def get_state_arrays(self) -> Dict:
+        extra_fields = [
+            key for key in self._meta['fields']
+            if key != 'time' and key not in self._meta['state_fields'] and key not in self._meta['dynamic_fields']
+        ]
+        return self.get_frame(self._meta['state_fields'] + extra_fields)
+
+    def get_static_states(self) -> Dict:
+        return {
+            key: np.asarray(value) if isinstance(value, list) else value
+            for key, value in self._meta['static_states'].items()
+        }
+
+    def get_dynamic_state_arrays(self) -> Dict:
+        return self.get_frame(self._meta['dynamic_fields'])
+
+    def get_field_bounds(self) -> Dict:
+        return {
+            key: None if value is None else (np.asarray(value[0]), np.asarray(value[1]))
+            for key, value in self._meta['field_bounds'].items()
+        }
+
+    @property
+    def speed(self) -> float:
+        return self._speed
+
+    @speed.setter
+    def speed(self, speed: float) -> None:
+        self._speed = speed
+
+    @property
+    def playback_time(self) -> float:
+        return self._playback_time
+
+    @property
+    def simulator_type(self) -> str:
+        return self._meta['simulator_type']
+
+    @property
+    def duration(self) -> float:
+        return float(self._times[-1] - self._times[0])
@@ -0,0 +1,133 @@
+import importlib
+from typing import Any, Callable, Dict, Mapping, NamedTuple, Optional, Tuple, Union
+
+
+# Simulators declare a name, a parameter schema and a factory. String factories
+# ('module:attribute') are only imported when the simulator is first created,
+# so registering a simulator costs nothing at startup.
+
+
+class Param(NamedTuple):
+    type: type
+    default: Any = None
+    min: Optional[float] = None
+    max: Optional[float] = None
+
+
+class SimulatorSpec(NamedTuple):
+    name: str
+    factory: Union[str, Callable]
+    params: Dict[str, Param] = {}
+    # pooled : instances can be reset with init() and handed out again
+    pooled: bool = True
+    checkpointable: bool = True
+    step_executor: str = 'thread'
+
+
+SIMULATORS: Dict[str, SimulatorSpec] = {}
+_factories: Dict[str, Callable] = {}
+
+
+def register(spec: SimulatorSpec) -> SimulatorSpec:
+    SIMULATORS[spec.name] = spec
+    _factories.pop(spec.name, None)
+    return spec
+
+
+def get_spec(name: str) -> SimulatorSpec:
+    if name not in SIMULATORS:
+        raise ValueError(f'unknown simulator : {name} (choose from {list(SIMULATORS)})')
+    return SIMULATORS[name]
+
+
+def load_factory(spec: SimulatorSpec) -> Callable:
+    if spec.name not in _factories:
+        factory = spec.factory
+        if isinstance(factory, str):
+            module_name, attribute = factory.split(':')
+            factory = getattr(importlib.import_module(module_name), attribute)
+        _factories[spec.name] = factory
+    return _factories[spec.name]
+
+
+def int_pair(value) -> Tuple[int, int]:
+    # 'i,j' in queries (e.g. a grid index)
+    if isinstance(value, str):
+        value = value.split(',')
+    i, j = (int(v) for v in value)
+    return (i, j)
+
+
+def parse_config(spec: SimulatorSpec, values: Mapping[str, str]) -> Dict:
+    # schema parameters found in values (e.g. query parameters), on top of the defaults
+    config = {}
+    for name, param in spec.params.items():
+        if name not in values:
+            config[name] = param.default
+            continue
+        try:
+            value = param.type(values[name])
+        except ValueError:
+            raise ValueError(f'{spec.name} parameter {name} must be a {param.type.__name__} : {values[name]}')
+        if (param.min is not None and value < param.min) or (param.max is not None and value > param.max):
+            raise ValueError(f'{spec.name} parameter {name} must be in [{param.min}, {param.max}] : {value}')
+        config[name] = value
+    return config
+
+
+def create_simulator(name: str, config: Optional[Dict] = None):
+    spec = get_spec(name)
+    config = {**{key: param.default for key, param in spec.params.items()}, **(config or {})}
+    return load_factory(spec)(**config)
+
+
+SEED = Param(int, None, 0, 2**32 - 1)
+
+register(SimulatorSpec(
+    'ideal_gas_system',
+    'simulator.ideal_gas:IdealGasSystem',
+    {
+        'n_particles': Param(int, 100, 1, 1_000_000),
+        'xmin': Param(float, -10.0), 'xmax': Param(float, 10.0),
+        'ymin': Param(float, -10.0), 'ymax': Param(float, 10.0),
+        'zmin': Param(float, -10.0), 'zmax': Param(float, 10.0),
+        'particle_radius': Param(float, 0.0, 0.0),
+        'particle_mass': Param(float, 1.0, 1e-6),
+        'seed': SEED,
+    },
+    # all ideal gas sessions are stepped together by one vectorized update per tick
+    step_executor='batch',
+))
+register(SimulatorSpec(
+    'wave_2d_system',
+    'simulator.wave:Wave2DSystem',
+    {
+        'n_grid_x': Param(int, 50, 2, 4000),
+        'n_grid_z': Param(int, 50, 2, 4000),
+        'dx': Param(float, 0.25, 1e-6),
+        'dz': Param(float, 0.25, 1e-6),
+        # grid index of the source, e.g. source_position=10,30 (checked against the grid size)
+        'source_position': Param(int_pair, (20, 20)),
+        'wave_speed': Param(float, 10 ** 0.5, 1e-6),
+        'seed': SEED,
+    },
+))
+register(SimulatorSpec(
+    'sph_system',
+    'simulator.sph:SPHSystem',
+    {
+        'n_particles': Param(int, 500, 1, 200_000),
+        'seed': SEED,
+        'x_min': Param(float, -1.0), 'x_max': Param(float, 1.0),
+        'y_min': Param(float, 0.0), 'y_max': Param(float, 3.0),
+        'z_min': Param(float, -1.0), 'z_max': Param(float, 1.0),
+        'spawn_height': Param(float, 5.0),
+        # the cell grid covers the domain, keep cell_size from getting tiny
+        'cell_size': Param(float, 0.1, 0.01),
+        'kernel_radius': Param(float, None, 1e-3),
+        # particles at rest (slower than sleep_velocity with the same neighbors for sleep_steps)
+        # are skipped, 0 : no sleeping particles, default : 2*|gravity|*dt
+        'sleep_velocity': Param(float, None, 0.0),
+        'sleep_steps': Param(int, 20, 1),
+    },
+))
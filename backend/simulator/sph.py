@@ -1,8 +1,10 @@
-from copy import copy
-from typing import Dict, List
+import math
+from typing import Dict, List, Optional
 
 import numpy as np
 
+from simulator.checkpoint import copy_state, load_checkpoint, save_checkpoint
+
 
 class Poly6Kernel:
 
@@ -10,47 +12,109 @@ class Poly6Kernel:
         self._h = h
         self._alpha = 4.0 / (np.pi * np.power(h, 8))
     
-    def kernel(self, distances: np.ndarray):
-        ks = np.zeros(len(distances))
-        filt = np.where(distances < self._h)[0]
-        if len(filt) > 0:
-            ks[filt] = self._alpha * np.power(self._h**2 - distances[filt]**2, 3)
-        return ks
-
-    def gradient(self, rvs: np.ndarray):
-        grad_vecs = np.zeros_like(rvs)
-        distances = np.sqrt((rvs**2).sum(axis=1))
-        filt = np.where(distances < self._h)[0]
-        if len(filt) > 0:
-            c = -6.0 * self._alpha * np.power(self._h**2 - distances[filt]**2, 2)
-            grad_vecs[filt] = c.reshape(-1, 1) * rvs[filt]
-        return grad_vecs
+    def kernel(self, r2: np.ndarray):
+        # of the squared distances, h^2 - r^2 is <= 0 outside the support radius, so those entries are zeroed
+        q = np.maximum(self._h**2 - r2, 0.0)
+        return self._alpha * (q * q * q)
+
+    def gradient_factor(self, r2: np.ndarray):
+        # the gradient is gradient_factor(r^2) * rv, a scalar per pair
+        q = np.maximum(self._h**2 - r2, 0.0)
+        return (-6.0 * self._alpha) * (q * q)
+
+    def gradient(self, rvs: np.ndarray, r2: Optional[np.ndarray] = None):
+        if r2 is None:
+            r2 = np.einsum('ij,ij->i', rvs, rvs)
+        return self.gradient_factor(r2).reshape(-1, 1) * rvs
+
+
+def histogram(values: np.ndarray, lo: float, hi: float, n_bins: int) -> np.ndarray:
+    # counts over n_bins equal bins of [lo, hi], values outside are counted in the edge bins
+    bins = ((values - lo) * (n_bins / (hi - lo))).astype(np.int64)
+    return np.bincount(np.clip(bins, 0, n_bins - 1), minlength=n_bins)
+
+
+# cell keys are int64 linear indices on the domain grid, only occupied cells are stored
+MAX_GRID_CELLS = 2**62
+# default sleep velocity, in |gravity|*dt
+SLEEP_GRAVITY_STEPS = 2.0
 
 
 class SPHSystem:
 
-    def __init__(self, n_particles: int):
+    def __init__(
+        self,
+        n_particles: int,
+        seed: Optional[int] = None,
+        x_min: float = -1.0,
+        x_max: float = 1.0,
+        y_min: float = 0.0,
+        y_max: float = 3.0,
+        z_min: float = -1.0,
+        z_max: float = 1.0,
+        spawn_height: float = 5.0,
+        cell_size: float = 0.1,
+        kernel_radius: Optional[float] = None,
+        sleep_velocity: Optional[float] = None,
+        sleep_steps: int = 20,
+    ):
+        # particles bounce inside [x_min, x_max] x [y_min, y_max] x [z_min, z_max], they start
+        # in the x < center, z < center quarter below spawn_height
+        # cell_size : neighbor search cells, kernel_radius : support of the kernel (3.5 cell_size)
+        # sleep_velocity (0 : off) : particles slower than it, in the same cell and with the same
+        # neighbors for sleep_steps steps are calm. Cells whose particles are all calm fall asleep :
+        # their particles are skipped (frozen, not rebinned, still neighbors of the others) until
+        # a particle moving (not slow or changing cell) in an adjacent cell wakes the cell.
+        # None : SLEEP_GRAVITY_STEPS*|gravity|*dt, resting particles pick up |gravity|*dt of speed
+        # every step before the floor or their neighbors push them back
+        if not (x_min < x_max and y_min < y_max and z_min < z_max):
+            raise ValueError(f'empty domain : [{x_min}, {x_max}] x [{y_min}, {y_max}] x [{z_min}, {z_max}]')
         self._n_particles = n_particles
-        self._x_min = -1
-        self._x_max = 1
-        self._z_min = -1
-        self._z_max = 1
-        self._y_min = 0
-        self._effective_r = 0.1
-        self._poly6kernel = Poly6Kernel(h=self._effective_r*3.5)
+        self._x_min = x_min
+        self._x_max = x_max
+        self._z_min = z_min
+        self._z_max = z_max
+        self._y_min = y_min
+        self._y_max = y_max
+        self._spawn_height = spawn_height
+        self._grid_origin = np.array([self._x_min, self._y_min, self._z_min])
+        self._effective_r = cell_size
+        self._kernel_radius = kernel_radius if kernel_radius is not None else self._effective_r*3.5
+        self._poly6kernel = Poly6Kernel(h=self._kernel_radius)
+        # cell grid over the domain (and the spawn region), plus a border of empty cells
+        # so that every cell has 26 neighbors. Only its occupied cells are stored.
+        extent = np.array([x_max - x_min, max(y_max, spawn_height) - y_min, z_max - z_min])
+        self._domain_cells = np.floor(extent / cell_size).astype(np.int64) + 1
+        self._grid_dims = self._domain_cells + 2
+        n_grid_cells = math.prod(int(n) for n in self._grid_dims)
+        if n_grid_cells > MAX_GRID_CELLS:
+            raise ValueError(f'{n_grid_cells} grid cells, at most {MAX_GRID_CELLS} : use a larger cell_size')
+        d = np.array([-1, 0, 1])
+        dx, dy, dz = np.meshgrid(d, d, d, indexing='ij')
+        # linear index offsets of the 27 surrounding cells, in (dx, dy, dz) loop order : 9 rows
+        # of 3 consecutive keys
+        self._cell_offsets = ((dx*self._grid_dims[1] + dy)*self._grid_dims[2] + dz).ravel()
+        self._row_offsets = self._cell_offsets[::3]
         self._density_base = 300
         self._stiffness = 100.0
+        # p = stiffness*(density - density_base) : dp/d(density) = c^2
+        self._sound_speed = np.sqrt(self._stiffness)
         self._viscosity = 1
         self._gravity = np.array([0.0, -9.8, 0.0])
+        self._sleep_velocity = sleep_velocity
+        self._sleep_steps = sleep_steps
+        self._rng = np.random.default_rng(seed)
         self.init()
 
     def init(self):
         self._t = 0.0
         # positions
+        x_center = 0.5 * (self._x_min + self._x_max)
+        z_center = 0.5 * (self._z_min + self._z_max)
         self._ps = np.zeros((self._n_particles, 3))
-        self._ps[:, 0] = np.random.uniform(self._x_min, high=0, size=self._n_particles)  # x
-        self._ps[:, 1] = np.random.uniform(self._y_min, high=5, size=self._n_particles)  # y
-        self._ps[:, 2] = np.random.uniform(self._z_min, high=0, size=self._n_particles)  # z
+        self._ps[:, 0] = self._rng.uniform(self._x_min, high=x_center, size=self._n_particles)  # x
+        self._ps[:, 1] = self._rng.uniform(self._y_min, high=self._spawn_height, size=self._n_particles)  # y
+        self._ps[:, 2] = self._rng.uniform(self._z_min, high=z_center, size=self._n_particles)  # z
         # velocities
         self._vs = np.zeros((self._n_particles, 3))
         self._vs2 = np.zeros((self._n_particles, 3))
@@ -62,134 +126,368 @@ class SPHSystem:
         self._masses = np.ones(self._n_particles)
         # force
         self._forces = np.zeros((self._n_particles, 3))
+        self.reset_activity()
+
+    def reset_activity(self) -> None:
+        # everyone awake, steps each particle has been calm for
+        self._asleep = np.zeros(self._n_particles, dtype=bool)
+        self._calm_steps = np.zeros(self._n_particles, dtype=np.int64)
+        # cell key of each particle (-1 : not binned yet), sleeping particles keep theirs
+        self._cell_ids = np.full(self._n_particles, -1, dtype=np.int64)
+        # sleeping particles sorted by cell key, kept between steps
+        self._sleeping_ids = np.zeros(0, dtype=np.int64)
+        self._sleeping_cell_ids = np.zeros(0, dtype=np.int64)
+        # neighbor set signature of each particle at its last step, -1 : unknown
+        self._neighbor_signatures = np.full((self._n_particles, 3), -1.0)
 
     def update(self, dt: float) -> None:
         self._t += dt
-        gridid_particle_mappings = self.split_particles_to_grids()
+        # only awake particles are stepped, sleeping ones still count as their neighbors
+        active = np.flatnonzero(~self._asleep)
+        self.build_cell_list(active)
+        pair_k, pair_i, pair_j = self.find_neighbor_pairs(active)
+        # per axis 1D arrays of the pair offsets and their squared lengths, no (n_pairs, 3) arrays
+        rvs = []
+        for xs in self._ps.T:
+            xs = np.ascontiguousarray(xs)
+            rvs.append(np.repeat(xs[active], self._n_neighbors) - np.take(xs, pair_j))
+        r2 = rvs[0] * rvs[0] + rvs[1] * rvs[1] + rvs[2] * rvs[2]
         # update density and pressure
-        for (x_grid_idx, y_grid_idx, z_gird_idx), particle_ids in gridid_particle_mappings.items():
-            for particle_id in particle_ids:
-                neighboring_particle_ids = self.get_neighboring_particles(
-                    particle_id, x_grid_idx, y_grid_idx, z_gird_idx, gridid_particle_mappings
-                )
-                # print(f'{particle_id} : {neighboring_particle_ids}')
-                rvs = - self._ps[neighboring_particle_ids] + self._ps[particle_id]
-                distances = np.sqrt((rvs**2).sum(axis=1))
-                density, pressure = self.calc_density_pressure(particle_id, neighboring_particle_ids, distances)
-                self._densities[particle_id] = density
-                self._pressures[particle_id] = pressure
+        self.calc_density_pressure(active, pair_k, pair_j, r2)
         # update force
-        for (x_grid_idx, y_grid_idx, z_gird_idx), particle_ids in gridid_particle_mappings.items():
-            for particle_id in particle_ids:
-                neighboring_particle_ids = self.get_neighboring_particles(
-                    particle_id, x_grid_idx, y_grid_idx, z_gird_idx, gridid_particle_mappings
-                )
-                if len(neighboring_particle_ids) > 0:
-                    rvs = - self._ps[neighboring_particle_ids] + self._ps[particle_id]
-                    distances = np.sqrt((rvs**2).sum(axis=1))
-                    f = self.calc_interactive_force(particle_id, neighboring_particle_ids, rvs, distances)
-                    f += self.calc_external_force(particle_id)
-                else:
-                    f = self.calc_external_force(particle_id)
-                self._forces[particle_id] = f
-        self._forces = np.clip(self._forces, -50, 50)
+        forces = self.calc_interactive_force(active, pair_k, pair_i, pair_j, rvs, r2)
+        forces += self.calc_external_force()
+        forces = np.clip(forces, -50, 50)
+        self._forces[active] = forces
         # self._forces -= 0.2 * np.clip(self._vs, -100000, 100000) ** 2
 
         # update velocity and positions
-        self._vs2 += dt * self._forces
-        self._ps += dt * self._vs2
-        self._vs = self._vs2 + 0.5 * dt * self._forces
+        ps = self._ps[active]
+        vs2 = self._vs2[active] + dt * forces
+        ps += dt * vs2
+        vs = vs2 + 0.5 * dt * forces
         ref_coef = 0.7
-        y_filt = np.where((self._ps[:, 1] < self._y_min) | (self._ps[:, 1] > 3))[0]
+        y_filt = np.where((ps[:, 1] < self._y_min) | (ps[:, 1] > self._y_max))[0]
         if len(y_filt) > 0:
-            self._vs[y_filt, 1] = -ref_coef*self._vs[y_filt, 1]
-            self._vs2[y_filt, 1] = -ref_coef*self._vs2[y_filt, 1]
-        x_filt = np.where((self._ps[:, 0] < self._x_min) | (self._ps[:, 0] > self._x_max))[0]
+            vs[y_filt, 1] = -ref_coef*vs[y_filt, 1]
+            vs2[y_filt, 1] = -ref_coef*vs2[y_filt, 1]
+        x_filt = np.where((ps[:, 0] < self._x_min) | (ps[:, 0] > self._x_max))[0]
         if len(x_filt) > 0:
-            self._vs[x_filt, 0] = -ref_coef*self._vs[x_filt, 0]
-            self._vs2[x_filt, 0] = -ref_coef*self._vs2[x_filt, 0]
-        z_filt = np.where((self._ps[:, 2] < self._z_min) | (self._ps[:, 2] > self._z_max))[0]
+            vs[x_filt, 0] = -ref_coef*vs[x_filt, 0]
+            vs2[x_filt, 0] = -ref_coef*vs2[x_filt, 0]
+        z_filt = np.where((ps[:, 2] < self._z_min) | (ps[:, 2] > self._z_max))[0]
         if len(z_filt) > 0:
-            self._vs[z_filt, 2] = -ref_coef*self._vs[z_filt, 2]
-            self._vs2[z_filt, 2] = -ref_coef*self._vs2[z_filt, 2]
-        self._vs += 0.00001*np.random.randn(self._n_particles, 3)
-        self._ps[:, 0] = np.clip(self._ps[:, 0], self._x_min, self._x_max)
-        self._ps[:, 1] = np.clip(self._ps[:, 1], self._y_min, 3)
-        self._ps[:, 2] = np.clip(self._ps[:, 2], self._z_min, self._z_max)
-
-    def split_particles_to_grids(self):
-        self._gridid_particle_mappings = {}
-        x_grid_indices = (self._ps[:, 0] - self._x_min) // self._effective_r
-        y_grid_indices = (self._ps[:, 1] - self._y_min) // self._effective_r
-        z_grid_indices = (self._ps[:, 2] - self._z_min) // self._effective_r
-        for particle_id, (x_grid_idx, y_grid_idx, z_gird_idx) in enumerate(zip(x_grid_indices, y_grid_indices, z_grid_indices)):
-            if (x_grid_idx, y_grid_idx, z_gird_idx) not in self._gridid_particle_mappings:
-                self._gridid_particle_mappings[(x_grid_idx, y_grid_idx, z_gird_idx)] = [particle_id]
-            else:
-                self._gridid_particle_mappings[(x_grid_idx, y_grid_idx, z_gird_idx)].append(particle_id)
-        return self._gridid_particle_mappings
-
-    def get_neighboring_particles(self, particle_id, x_grid_idx, y_grid_idx, z_gird_idx, gridid_particle_mappings):
-        particles = []
-        for dx in (-1, 0, 1):
-            for dy in (-1, 0, 1):
-                for dz in (-1, 0, 1):
-                    if (x_grid_idx+dx, y_grid_idx+dy, z_gird_idx+dz) in gridid_particle_mappings:
-                        particles += gridid_particle_mappings[(x_grid_idx+dx, y_grid_idx+dy, z_gird_idx+dz)]
-        particles.remove(particle_id)
-        return particles
+            vs[z_filt, 2] = -ref_coef*vs[z_filt, 2]
+            vs2[z_filt, 2] = -ref_coef*vs2[z_filt, 2]
+        vs += 0.00001*self._rng.standard_normal((len(active), 3))
+        ps[:, 0] = np.clip(ps[:, 0], self._x_min, self._x_max)
+        ps[:, 1] = np.clip(ps[:, 1], self._y_min, self._y_max)
+        ps[:, 2] = np.clip(ps[:, 2], self._z_min, self._z_max)
+        self._ps[active] = ps
+        self._vs[active] = vs
+        self._vs2[active] = vs2
+        if self._sleep_velocity is None:
+            self.update_activity(active, pair_j, r2, SLEEP_GRAVITY_STEPS * np.linalg.norm(self._gravity) * dt)
+        elif self._sleep_velocity > 0:
+            self.update_activity(active, pair_j, r2, self._sleep_velocity)
+
+    def update_activity(self, active: np.ndarray, pair_j: np.ndarray, r2: np.ndarray, sleep_velocity: float) -> None:
+        # calm : slower than sleep_velocity, in the same cell and with the same neighbors as the step before
+        speeds2 = np.einsum('ij,ij->i', self._vs[active], self._vs[active])
+        moving = (speeds2 >= sleep_velocity**2) | self._rebinned
+        calm = ~moving
+        # neighbor set signature (count, sum of ids, sum of squared ids of the neighbors within
+        # kernel_radius) of the particles that may be calm, from their CSR neighbor lists
+        signatures = np.full((len(active), 3), -1.0)
+        candidates = np.flatnonzero(calm)
+        counts = self._n_neighbors[candidates]
+        pair_ids = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts - self._neighbor_offsets[candidates], counts)
+        segments = np.repeat(np.arange(len(candidates)), counts)
+        near = (r2[pair_ids] < self._kernel_radius**2).astype(np.float64)
+        near_j = near * pair_j[pair_ids]
+        signatures[candidates] = np.stack([
+            np.bincount(segments, weights=near, minlength=len(candidates)),
+            np.bincount(segments, weights=near_j, minlength=len(candidates)),
+            np.bincount(segments, weights=near_j * pair_j[pair_ids], minlength=len(candidates)),
+        ], axis=1)
+        calm &= (signatures == self._neighbor_signatures[active]).all(axis=1)
+        self._neighbor_signatures[active] = signatures
+        self._calm_steps[active] = np.where(calm, self._calm_steps[active] + 1, 0)
+        # cells fall asleep as a whole, once all their awake particles have been calm for sleep_steps
+        ready = self._calm_steps[active] >= self._sleep_steps
+        n_not_ready = np.bincount(self._particle_cells[active[~ready]], minlength=len(self._occupied_cells))
+        falling_asleep = active[ready & (n_not_ready[self._particle_cells[active]] == 0)]
+        self._asleep[falling_asleep] = True
+        self._vs[falling_asleep] = 0.0
+        self._vs2[falling_asleep] = 0.0
+        self._forces[falling_asleep] = 0.0
+        # moving particles wake the sleeping cells around them, slow ones whose neighbors
+        # changed don't
+        moving = active[moving]
+        if len(moving) > 0 and self._asleep.any():
+            # plus a slot for the empty cells (-1)
+            hot_cells = np.zeros(len(self._occupied_cells) + 1, dtype=bool)
+            hot_cells[self.find_cells(np.unique(self._particle_cells[moving]))] = True
+            sleeping = np.flatnonzero(self._asleep)
+            waking = sleeping[hot_cells[self._particle_cells[sleeping]]]
+            self._asleep[waking] = False
+            self._calm_steps[waking] = 0
+            self._neighbor_signatures[waking] = -1.0
+        self.update_sleeping_cells(falling_asleep)
+
+    def update_sleeping_cells(self, falling_asleep: np.ndarray) -> None:
+        # drops the woken particles from the sorted sleeping ones and merges in the ones falling asleep
+        still_asleep = self._asleep[self._sleeping_ids]
+        if not still_asleep.all():
+            self._sleeping_ids = self._sleeping_ids[still_asleep]
+            self._sleeping_cell_ids = self._sleeping_cell_ids[still_asleep]
+        falling_asleep = falling_asleep[self._asleep[falling_asleep]]
+        if len(falling_asleep) == 0:
+            return
+        # binned once more at the positions they sleep at
+        self._cell_ids[falling_asleep] = self.cell_keys(self._ps[falling_asleep])
+        order = np.argsort(self._cell_ids[falling_asleep], kind='stable')
+        new_ids = falling_asleep[order]
+        new_cell_ids = self._cell_ids[new_ids]
+        positions = np.searchsorted(self._sleeping_cell_ids, new_cell_ids, side='right')
+        self._sleeping_ids = np.insert(self._sleeping_ids, positions, new_ids)
+        self._sleeping_cell_ids = np.insert(self._sleeping_cell_ids, positions, new_cell_ids)
+
+    def max_stable_dt(self) -> float:
+        # CFL condition on the sound speed plus the fastest particle, and the force
+        # condition dt < sqrt(h/|f|), from the current state
+        h = self._kernel_radius
+        v_max = np.sqrt(np.einsum('ij,ij->i', self._vs2, self._vs2).max(initial=0.0))
+        f_max = max(
+            np.sqrt(np.einsum('ij,ij->i', self._forces, self._forces).max(initial=0.0)),
+            np.linalg.norm(self._gravity),
+        )
+        return float(min(0.4 * h / (self._sound_speed + v_max), 0.25 * np.sqrt(h / f_max)))
+
+    def cell_keys(self, ps: np.ndarray) -> np.ndarray:
+        # linear index of the cells on the domain grid (same binning as the original dict
+        # based grid), shifted by the border cell
+        cells = ((ps - self._grid_origin) // self._effective_r).astype(np.int64)
+        np.clip(cells, 0, self._domain_cells - 1, out=cells)
+        cells += 1
+        return (cells[:, 0]*self._grid_dims[1] + cells[:, 1])*self._grid_dims[2] + cells[:, 2]
+
+    def build_cell_list(self, active: np.ndarray):
+        # cell keys of the awake particles. Sleeping particles don't move, they keep their
+        # keys and their place in the sorted sleeping ones.
+        cell_ids = self.cell_keys(self._ps[active])
+        self._rebinned = cell_ids != self._cell_ids[active]
+        self._cell_ids[active] = cell_ids
+        # particles sorted by cell key (stable, so particle ids stay ascending within a cell),
+        # the awake ones merged into the sleeping ones
+        order = np.argsort(cell_ids, kind='stable')
+        sorted_cell_ids = cell_ids[order]
+        sorted_particle_ids = active[order]
+        if len(self._sleeping_ids) > 0:
+            positions = np.searchsorted(self._sleeping_cell_ids, sorted_cell_ids, side='right')
+            sorted_cell_ids = np.insert(self._sleeping_cell_ids, positions, sorted_cell_ids)
+            sorted_particle_ids = np.insert(self._sleeping_ids, positions, sorted_particle_ids)
+        self._sorted_particle_ids = sorted_particle_ids
+        # occupied cells and the range of sorted positions they hold, plus an empty cell at
+        # the end, index -1 of the missing ones
+        is_first = np.ones(len(sorted_cell_ids), dtype=bool)
+        is_first[1:] = sorted_cell_ids[1:] != sorted_cell_ids[:-1]
+        self._cell_starts = np.append(np.flatnonzero(is_first), len(sorted_cell_ids))
+        self._cell_counts = np.append(np.diff(self._cell_starts), 0)
+        self._occupied_cells = sorted_cell_ids[self._cell_starts[:-1]]
+        # occupied cell of each particle
+        self._particle_cells = np.empty(self._n_particles, dtype=np.int64)
+        self._particle_cells[sorted_particle_ids] = np.cumsum(is_first) - 1
+
+    def find_cells(self, cells: np.ndarray) -> np.ndarray:
+        # occupied cells around the given occupied cells : size=(n_cells, 27), -1 for empty ones
+        n_occupied = len(self._occupied_cells)
+        # the first key of each of the 9 rows is searched, the next two are the next occupied
+        # cells when present
+        keys = self._row_offsets.reshape(-1, 1) + self._occupied_cells[cells]  # size=(9, n_cells)
+        positions = np.searchsorted(self._occupied_cells, keys)
+        found = np.empty((len(cells), 9, 3), dtype=np.int64)
+        for dz in range(3):
+            clipped = np.minimum(positions, n_occupied - 1)
+            is_occupied = self._occupied_cells[clipped] == keys
+            found[:, :, dz] = np.where(is_occupied, clipped, -1).T
+            positions += is_occupied
+            keys += 1
+        return found.reshape(len(cells), 27)
+
+    def find_neighbor_pairs(self, active: np.ndarray):
+        # pairs (i, j) for every particle i of active and every j of its 27 surrounding cells,
+        # pair_k is the index of i in active
+        n_active = len(active)
+        # the 27 surrounding cells of each occupied cell holding awake particles
+        particle_cells = self._particle_cells[active]
+        has_active = np.zeros(len(self._occupied_cells), dtype=bool)
+        has_active[particle_cells] = True
+        active_cells = np.flatnonzero(has_active)
+        active_cell_ids = np.cumsum(has_active) - 1
+        neighbor_cells = self.find_cells(active_cells)[active_cell_ids[particle_cells]]  # size=(n_active, 27)
+        counts = self._cell_counts[neighbor_cells].ravel()
+        starts = self._cell_starts[neighbor_cells].ravel()
+        # expand every (particle, cell) segment into the ids of the particles it holds
+        n_pairs = counts.sum()
+        seg_starts = np.cumsum(counts) - counts
+        sorted_idx = np.arange(n_pairs) - np.repeat(seg_starts - starts, counts)
+        pair_j = self._sorted_particle_ids[sorted_idx]
+        # drop self pairs
+        pair_j = pair_j[pair_j != np.repeat(active.repeat(27), counts)]
+        # neighbor lists in CSR form : neighbors of particle active[k] are pair_j[offsets[k]:offsets[k+1]],
+        # so gathers by pair_k / pair_i are repeats of per particle values
+        self._n_neighbors = counts.reshape(n_active, 27).sum(axis=1) - 1
+        pair_k = np.repeat(np.arange(n_active), self._n_neighbors)
+        pair_i = np.repeat(active, self._n_neighbors)
+        self._neighbor_offsets = np.zeros(n_active+1, dtype=np.int64)
+        np.cumsum(self._n_neighbors, out=self._neighbor_offsets[1:])
+        self._neighbor_ids = pair_j
+        return pair_k, pair_i, pair_j
 
     def calc_density_pressure(
         self,
-        tartget_particle_id: int,
-        neighboring_particle_ids: List[int],
-        # rvs: np.ndarray,
-        distances: np.ndarray,
+        active: np.ndarray,
+        pair_k: np.ndarray,
+        pair_j: np.ndarray,
+        r2: np.ndarray,
     ):
-        if len(neighboring_particle_ids) == 0:
-            # density = pressure = 0.0
-            density = self._density_base
-            pressure = 0.0
-        else:
-            density = (self._poly6kernel.kernel(distances) * self._masses[neighboring_particle_ids]).sum()
-            pressure = max(0, self._stiffness * (density - self._density_base))
-        return density, pressure
+        densities = np.bincount(
+            pair_k,
+            weights=self._poly6kernel.kernel(r2) * np.take(self._masses, pair_j),
+            minlength=len(active),
+        )
+        pressures = np.maximum(0, self._stiffness * (densities - self._density_base))
+        # particles without neighbors (or none within a kernel_radius smaller than the cells)
+        isolated = (self._n_neighbors == 0) | (densities <= 0)
+        densities[isolated] = self._density_base
+        pressures[isolated] = 0.0
+        # sleeping particles keep theirs
+        self._densities[active] = densities
+        self._pressures[active] = pressures
+        return densities, pressures
 
     def calc_interactive_force(
         self,
-        tartget_particle_id: int,
-        neighboring_particle_ids: List[int],
-        rvs: np.ndarray,
-        distances: np.ndarray,
+        active: np.ndarray,
+        pair_k: np.ndarray,
+        pair_i: np.ndarray,
+        pair_j: np.ndarray,
+        rvs: List[np.ndarray],
+        r2: np.ndarray,
     ):
-        npi = neighboring_particle_ids
-        tpi = tartget_particle_id
+        # both terms reduce to scalars per pair, the pressure along rv and the viscosity along dv :
+        #   f_k = sum_j (fp * rv + fv * v_j) - v_k * sum_j fv
+        # so each axis is a single scatter of 1D weights
+        # (pair_k is sorted, per particle values are repeated over its neighbors rather than gathered)
+        n_active = len(active)
+        n_neighbors = self._n_neighbors
+        densities_j = np.take(self._densities, pair_j)  # size=(n_pairs)
+
         # pressure
-        grads = self._poly6kernel.gradient(rvs)  # size=(n_neighboring_particles, 3)
-        # print(f'{self._densities[npi]**2} : {self._densities[tpi]**2}')
-        f = -self._masses[npi] * (self._pressures[npi] / (self._densities[npi]**2) + self._pressures[tpi] / (self._densities[tpi]**2))  # (n_particles)
-        f = grads * f.reshape(-1, 1)  # size=(n_neighboring_particles, 3)
+        p_rho2 = self._pressures / (self._densities**2)  # size=(n_particles)
+        fp = np.take(p_rho2, pair_j)  # size=(n_pairs)
+        fp += np.repeat(p_rho2[active], n_neighbors)
+        fp *= np.take(self._masses, pair_j)
+        fp *= -self._poly6kernel.gradient_factor(r2)
 
         # viscosity
-        r2 = distances**2  # size=(n_neighboring_particles)
-        dv = self._vs[tpi] - self._vs[npi]  # size=(n_neighboring_particles, 3)
-        fv = self._masses[tpi] * 2 * self._viscosity  / (self._densities[npi] * self._densities[tpi]) / np.clip(r2, 0.0001, None)  # size=(n_neighboring_particles)
-        f += fv.reshape(-1, 1) * dv  # size=(n_neighboring_particles, 3)
-        
-        # # gravity
-        # f += self._gravity.reshape(1, 3)  # size=(n_neighboring_particles, 3)
+        fv = (2 * self._viscosity) * self._masses[active] / self._densities[active]  # size=(n_active)
+        fv = np.repeat(fv, n_neighbors)  # size=(n_pairs)
+        fv /= densities_j
+        fv /= np.maximum(r2, 0.0001)
 
-        f = f.sum(axis=0)  # size=(n_neighboring_particles, 3) => (3)
+        # sum over neighbors : size=(n_pairs) => (n_active) per axis
+        fv_sum = np.bincount(pair_k, weights=fv, minlength=n_active)
+        forces = np.empty((n_active, 3))
+        for axis, vs in enumerate(self._vs.T):
+            vs = np.ascontiguousarray(vs)
+            weights = fp * rvs[axis]
+            weights += fv * np.take(vs, pair_j)
+            forces[:, axis] = np.bincount(pair_k, weights=weights, minlength=n_active)
+            forces[:, axis] -= vs[active] * fv_sum
 
-        return f
+        return forces
 
-    def calc_external_force(self, tartget_particle_id):
+    def calc_external_force(self):
         f = self._gravity
         return f
 
+    # bins of the density / pressure distributions sent as diagnostics
+    N_HISTOGRAM_BINS = 32
+
+    def get_diagnostics(self) -> Dict:
+        # densities are binned over [0, 2*density_base], pressures over the matching
+        # [0, stiffness*density_base] (values outside fall in the first / last bin)
+        density_range = (0.0, 2.0 * self._density_base)
+        pressure_range = (0.0, self._stiffness * self._density_base)
+        return {
+            'time': self._t,
+            'kinetic_energy': 0.5 * float(np.einsum('i,ij,ij->', self._masses, self._vs, self._vs)),
+            'potential_energy': -float(self._masses @ (self._ps @ self._gravity)),
+            'density_mean': float(self._densities.mean()),
+            'density_max': float(self._densities.max()),
+            'pressure_mean': float(self._pressures.mean()),
+            'pressure_max': float(self._pressures.max()),
+            'density_range': density_range,
+            'density_histogram': histogram(self._densities, *density_range, self.N_HISTOGRAM_BINS),
+            'pressure_range': pressure_range,
+            'pressure_histogram': histogram(self._pressures, *pressure_range, self.N_HISTOGRAM_BINS),
+        }
+
+    # arrays that carry over between steps
+    CHECKPOINT_ARRAYS = {
+        'positions': '_ps',
+        'velocities': '_vs',
+        'half_step_velocities': '_vs2',
+        'densities': '_densities',
+        'pressures': '_pressures',
+        'masses': '_masses',
+        'forces': '_forces',
+    }
+
+    def checkpoint(self) -> bytes:
+        states = {name: getattr(self, attr) for name, attr in self.CHECKPOINT_ARRAYS.items()}
+        states['time'] = self._t
+        return save_checkpoint(type(self).__name__, states, self._rng)
+
+    def restore(self, blob: bytes) -> None:
+        states = load_checkpoint(blob, type(self).__name__, self._rng)
+        for name, attr in self.CHECKPOINT_ARRAYS.items():
+            copy_state(getattr(self, attr), states[name], name)
+        self._t = float(states['time'])
+        # not part of checkpoints : restored particles start awake and fall asleep again
+        self.reset_activity()
+
     def get_states(self) -> Dict:
         return {
             'time': self._t,
             'positions': self._ps.reshape((-1, 3)).tolist(),
             # 'velocities': self._vs.tolist(),
         }
+
+    def get_state_arrays(self) -> Dict:
+        return {
+            'time': self._t,
+            'positions': self._ps,
+        }
+
+    def get_static_states(self) -> Dict:
+        return {
+            'n_particles': self._n_particles,
+        }
+
+    def get_dynamic_state_arrays(self) -> Dict:
+        return {
+            'time': self._t,
+            'positions': self._ps,
+        }
+
+    def get_field_bounds(self) -> Dict:
+        # particles start below spawn_height and are kept below y_max once stepping starts
+        return {
+            'positions': (
+                np.array([self._x_min, self._y_min, self._z_min]),
+                np.array([self._x_max, max(self._y_max, self._spawn_height), self._z_max]),
+            ),
+        }
@@ -1,7 +1,9 @@
-from typing import Dict
+from typing import Dict, Optional, Tuple
 
 import numpy as np
 
+from simulator.checkpoint import copy_state, load_checkpoint, save_checkpoint
+
 
 class Wave2DSystem:
 
@@ -11,7 +13,16 @@ class Wave2DSystem:
         n_grid_z: int,
         dx: float,
         dz: float,
+        source_position: Tuple[int, int] = (20, 20),
+        seed: Optional[int] = None,
+        wave_speed: float = np.sqrt(10.0),
     ):
+        # the source oscillates inside the grid, the boundary heights stay 0
+        if not (1 <= source_position[0] < n_grid_x and 1 <= source_position[1] < n_grid_z):
+            raise ValueError(
+                f'source_position {tuple(source_position)} must be inside the grid : '
+                f'[1, {n_grid_x - 1}] x [1, {n_grid_z - 1}]'
+            )
         self._n_grid_x = n_grid_x
         self._n_grid_z = n_grid_z
         self._dx = dx
@@ -20,48 +31,130 @@ class Wave2DSystem:
         self._x_min = -0.5 * n_grid_x * dx
         self._z_max = 0.5 * n_grid_z * dz
         self._z_min = -0.5 * n_grid_z * dz
+        self._wave_speed = wave_speed
+        # grid index of the oscillating source
+        self._source_position = tuple(source_position)
+        # the wave has no random terms, the generator keeps the interface of the other simulators
+        self._rng = np.random.default_rng(seed)
         self.init()
 
     def init(self):
-        # time
+        # time, and the last step's dt (for the surface velocity of the diagnostics)
         self._t = 0.0
-        # positions
-        self._ps = np.zeros((self._n_grid_x+1, self._n_grid_z+1, 3))
-        for x_idx in range(self._n_grid_x+1):
-            for z_idx in range(self._n_grid_z+1):
-                self._ps[x_idx, z_idx, 0] = self._x_min + self._dx*x_idx
-                self._ps[x_idx, z_idx, 1] = 3.0*np.sin(0.2*self._t+0.03*x_idx + 0.07*z_idx)
-                self._ps[x_idx, z_idx, 2] = self._z_min + self._dx*z_idx
-        self._ps[0, :, 1] = 0
-        self._ps[-1, :, 1] = 0
-        self._ps[:, 0, 1] = 0
-        self._ps[:, -1, 1] = 0
-        self._prev_ps = self._ps.copy()
-        # velocities
-        self._vs = np.zeros((self._n_grid_x+1, self._n_grid_z+1, 3))
+        self._dt = 0.0
+        shape = (self._n_grid_x+1, self._n_grid_z+1)
+        x_indices = np.arange(self._n_grid_x+1).reshape(-1, 1)
+        z_indices = np.arange(self._n_grid_z+1).reshape(1, -1)
+        # heights (y) : current, previous and next step buffers, rotated every step
+        self._heights = np.empty(shape)
+        self._heights[:] = 3.0*np.sin(0.2*self._t + 0.03*x_indices + 0.07*z_indices)
+        self._heights[0, :] = 0
+        self._heights[-1, :] = 0
+        self._heights[:, 0] = 0
+        self._heights[:, -1] = 0
+        self._prev_heights = self._heights.copy()
+        self._next_heights = np.zeros(shape)
+        # scratch buffer for the laplacian terms
+        self._scratch = np.empty((self._n_grid_x-1, self._n_grid_z-1))
+        # positions, the y column is filled from the heights when states are requested
+        self._ps = np.zeros(shape + (3,))
+        self._ps[:, :, 0] = self._x_min + self._dx*x_indices
+        self._ps[:, :, 2] = self._z_min + self._dz*z_indices
+        self._ps[:, :, 1] = self._heights
 
     def update(self, dt: float) -> None:
         self._t += dt
-        # self._ps += dt * self._vs
-        # for x_idx in range(self._n_grid_x+1):
-        #     for z_idx in range(self._n_grid_z+1):
-        #         self._ps[x_idx, z_idx, 1] = 3.0*np.sin(0.2*self._t+0.03*x_idx + 0.07*z_idx)
-        x_coef = 10*dt**2/self._dx**2
-        z_coef = 10*dt**2/self._dz**2
-        self._ps[1:-1, 1:-1, 1] = 2.0*self._ps[1:-1, 1:-1, 1] - self._prev_ps[1:-1, 1:-1, 1] \
-            + x_coef * (self._ps[:-2, 1:-1, 1] - 2.0*self._ps[1:-1, 1:-1, 1] + self._ps[2:, 1:-1, 1]) \
-            + z_coef * (self._ps[1:-1, :-2, 1] - 2.0*self._ps[1:-1, 1:-1, 1] + self._ps[1:-1, 2:, 1])
-        self._ps[0, :, 1] = 0
-        self._ps[-1, :, 1] = 0
-        self._ps[:, 0, 1] = 0
-        self._ps[:, -1, 1] = 0
-        self._ps[20, 20, 1] = 3.0*np.sin(0.8*self._t)
-        self._prev_ps = self._ps.copy()
+        self._dt = dt
+        x_coef = self._wave_speed**2*dt**2/self._dx**2
+        z_coef = self._wave_speed**2*dt**2/self._dz**2
+        cur = self._heights
+        nxt = self._next_heights[1:-1, 1:-1]
+        scratch = self._scratch
+        # next = 2*cur - prev + x_coef*(left - 2*cur + right) + z_coef*(down - 2*cur + up)
+        np.multiply(cur[1:-1, 1:-1], 2.0 - 2.0*x_coef - 2.0*z_coef, out=nxt)
+        nxt -= self._prev_heights[1:-1, 1:-1]
+        np.add(cur[:-2, 1:-1], cur[2:, 1:-1], out=scratch)
+        scratch *= x_coef
+        nxt += scratch
+        np.add(cur[1:-1, :-2], cur[1:-1, 2:], out=scratch)
+        scratch *= z_coef
+        nxt += scratch
+        # boundaries of every buffer stay 0
+        self._next_heights[self._source_position] = 3.0*np.sin(0.8*self._t)
+        # rotate buffers instead of copying : prev <- cur <- next
+        self._prev_heights, self._heights, self._next_heights = \
+            self._heights, self._next_heights, self._prev_heights
+
+    def max_stable_dt(self) -> float:
+        # CFL limit of the explicit scheme : c*dt*sqrt(1/dx^2 + 1/dz^2) <= 1, with some margin
+        return 0.9 / (self._wave_speed * np.sqrt(1.0/self._dx**2 + 1.0/self._dz**2))
+
+    def checkpoint(self) -> bytes:
+        return save_checkpoint(
+            type(self).__name__,
+            {'time': self._t, 'heights': self._heights, 'prev_heights': self._prev_heights},
+            self._rng,
+        )
+
+    def restore(self, blob: bytes) -> None:
+        states = load_checkpoint(blob, type(self).__name__, self._rng)
+        copy_state(self._heights, states['heights'], 'heights')
+        copy_state(self._prev_heights, states['prev_heights'], 'prev_heights')
+        self._t = float(states['time'])
+
+    def get_diagnostics(self) -> Dict:
+        # energy of the membrane : kinetic 1/2 (dh/dt)^2 and potential 1/2 c^2 |grad h|^2
+        # integrated over the grid (per unit density). The source keeps adding energy.
+        cell_area = self._dx * self._dz
+        gradient_x = np.diff(self._heights, axis=0) / self._dx
+        gradient_z = np.diff(self._heights, axis=1) / self._dz
+        potential_energy = 0.5 * self._wave_speed**2 * cell_area * float(
+            np.einsum('ij,ij->', gradient_x, gradient_x) + np.einsum('ij,ij->', gradient_z, gradient_z)
+        )
+        kinetic_energy = 0.0
+        if self._dt > 0:
+            velocities = (self._heights - self._prev_heights) / self._dt
+            kinetic_energy = 0.5 * cell_area * float(np.einsum('ij,ij->', velocities, velocities))
+        return {
+            'time': self._t,
+            'kinetic_energy': kinetic_energy,
+            'potential_energy': potential_energy,
+            'energy': kinetic_energy + potential_energy,
+            'max_amplitude': float(np.abs(self._heights).max()),
+        }
 
     def get_states(self) -> Dict:
+        self._ps[:, :, 1] = self._heights
         return {
             'time': self._t,
             'positions': self._ps.reshape((-1, 3)).tolist(),
             # 'velocities': self._vs.tolist(),
         }
 
+    def get_state_arrays(self) -> Dict:
+        self._ps[:, :, 1] = self._heights
+        return {
+            'time': self._t,
+            'positions': self._ps.reshape((-1, 3)),
+        }
+
+    def get_static_states(self) -> Dict:
+        # x/z coordinates of the grid never change, only the heights (y) move
+        return {
+            'n_grid_x': self._n_grid_x,
+            'n_grid_z': self._n_grid_z,
+            'grid_x': self._ps[:, 0, 0],
+            'grid_z': self._ps[0, :, 2],
+        }
+
+    def get_dynamic_state_arrays(self) -> Dict:
+        return {
+            'time': self._t,
+            'heights': self._heights,
+        }
+
+    def get_field_bounds(self) -> Dict:
+        # heights have no fixed range, the encoder derives it from the data
+        return {
+            'heights': None,
+        }
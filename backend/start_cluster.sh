@@ -0,0 +1,16 @@
+# N_SIMULATION_WORKERS simulation workers (worker.py) own and step the sessions,
+# N_FRONTS stateless uvicorn workers (run_server.py) accept the websockets, subscribe to
+# the sessions of the workers and fan their frames out
+N_SIMULATION_WORKERS=${N_SIMULATION_WORKERS:-2}
+N_FRONTS=${N_FRONTS:-2}
+SOCKET_DIR=${SOCKET_DIR:-/tmp}
+
+SIMULATION_WORKERS=""
+for i in $(seq 0 $((N_SIMULATION_WORKERS - 1))); do
+    python worker.py --socket $SOCKET_DIR/simulation-$i.sock --index $i --n-workers $N_SIMULATION_WORKERS &
+    SIMULATION_WORKERS=$SIMULATION_WORKERS${SIMULATION_WORKERS:+,}$SOCKET_DIR/simulation-$i.sock
+done
+trap 'kill $(jobs -p)' EXIT
+
+# the fronts deflate (WS_DEFLATE_* settings, see streaming/deflate.py), the workers never do
+SIMULATION_WORKERS=$SIMULATION_WORKERS python run_server.py --host 0.0.0.0 --workers $N_FRONTS
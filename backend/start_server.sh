@@ -1 +1 @@
-uvicorn server:app --reload --host 0.0.0.0
+python run_server.py --reload --host 0.0.0.0
@@ -0,0 +1,406 @@
+import asyncio
+import itertools
+import json
+import struct
+import time
+import zlib
+from typing import Dict, Hashable, List, Optional, Tuple
+
+from fastapi import WebSocketDisconnect
+
+from streaming.session import Subscriber
+
+
+# Local broker between websocket front processes and simulation worker processes
+# (worker.py). Workers own the sessions : stepping and encoding happen there. A front
+# keeps no simulation state, it subscribes to a session through a feed : one unix socket
+# stream per (worker, session, encoding) shared by all the clients of this front with the
+# same session and encoding. The worker publishes each frame once per feed, the front
+# fans it out to its clients, each with its own send queue, frame rate and flow control.
+#
+# Stream messages : uint8 kind, uint32 payload length, payload
+#   HELLO   front -> worker, json {"type": "subscribe", "simulator", "options", "query"}
+#           or a request answered with one TEXT json message :
+#           {"type": "sessions"}, {"type": "metrics"}, {"type": "expire", "session_id"}
+#   TEXT    worker -> front : a json frame, front -> worker : a control message
+#           ("min_dt <seconds>" of the feed, replay controls of the clients)
+#   BYTES   worker -> front, a binary frame
+#   SYNC    worker -> front, the frames a new client needs before the current one
+#           (static fields, keyframe), sent whenever they change, see pack_sync_frames
+#   CLOSE   uint16 websocket close code, either way
+
+HELLO = ord('H')
+TEXT = ord('T')
+BYTES = ord('B')
+SYNC = ord('S')
+CLOSE = ord('C')
+
+MESSAGE_HEADER_FORMAT = '<BI'
+MESSAGE_HEADER_SIZE = struct.calcsize(MESSAGE_HEADER_FORMAT)
+CLOSE_FORMAT = '<H'
+# seconds a worker has to answer a request (sessions, metrics, expire)
+REQUEST_TIMEOUT = 5.0
+SYNC_HEADER_LEN_FORMAT = '<I'
+SYNC_HEADER_LEN_SIZE = struct.calcsize(SYNC_HEADER_LEN_FORMAT)
+
+
+def pack_message(kind: int, payload: bytes) -> bytes:
+    return struct.pack(MESSAGE_HEADER_FORMAT, kind, len(payload)) + payload
+
+
+async def read_message(reader: asyncio.StreamReader) -> Tuple[Optional[int], bytes]:
+    # (None, b'') once the other side is gone
+    try:
+        header = await reader.readexactly(MESSAGE_HEADER_SIZE)
+        kind, length = struct.unpack(MESSAGE_HEADER_FORMAT, header)
+        return kind, await reader.readexactly(length)
+    except (asyncio.IncompleteReadError, ConnectionError):
+        return None, b''
+
+
+def close_code(payload: bytes) -> int:
+    return struct.unpack(CLOSE_FORMAT, payload)[0] if len(payload) >= 2 else 1000
+
+
+def pack_sync_frames(frames: List, sync_token) -> bytes:
+    # uint32 header length, json header {"sync_token", "frames": [[is_text, nbytes], ...]}, frames
+    buffers = [f.encode('utf-8') if isinstance(f, str) else f for f in frames]
+    header = json.dumps({
+        'sync_token': sync_token,
+        'frames': [[isinstance(f, str), len(b)] for f, b in zip(frames, buffers)],
+    }).encode('utf-8')
+    return b''.join([struct.pack(SYNC_HEADER_LEN_FORMAT, len(header)), header, *buffers])
+
+
+def unpack_sync_frames(payload: bytes) -> Tuple[List, object]:
+    header_len, = struct.unpack_from(SYNC_HEADER_LEN_FORMAT, payload, 0)
+    header = json.loads(payload[SYNC_HEADER_LEN_SIZE:SYNC_HEADER_LEN_SIZE+header_len])
+    frames = []
+    offset = SYNC_HEADER_LEN_SIZE + header_len
+    for is_text, nbytes in header['frames']:
+        frame = payload[offset:offset+nbytes]
+        frames.append(frame.decode('utf-8') if is_text else frame)
+        offset += nbytes
+    return frames, header['sync_token']
+
+
+class SyncMessage(bytes):
+    # packed SYNC payload queued by a FeedSubscriber among its frames
+    pass
+
+
+class BrokerConnection:
+    # worker side of a feed, with the part of the WebSocket interface
+    # the connection handler and Subscriber use
+
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter, query_params: Dict[str, str]):
+        self._reader = reader
+        self._writer = writer
+        self.query_params = query_params
+        self._is_closed = False
+
+    async def accept(self) -> None:
+        # the front accepted the websockets already
+        pass
+
+    async def send(self, kind: int, payload: bytes) -> None:
+        if self._is_closed:
+            raise WebSocketDisconnect(1006)
+        # one write per message : messages of concurrent senders never interleave
+        self._writer.write(pack_message(kind, payload))
+        try:
+            await self._writer.drain()
+        except ConnectionError:
+            raise WebSocketDisconnect(1006)
+
+    async def send_text(self, data: str) -> None:
+        await self.send(TEXT, data.encode('utf-8'))
+
+    async def send_bytes(self, data: bytes) -> None:
+        await self.send(BYTES, data)
+
+    async def receive_text(self) -> str:
+        kind, payload = await read_message(self._reader)
+        if kind is None or kind == CLOSE:
+            raise WebSocketDisconnect(close_code(payload) if kind == CLOSE else 1006)
+        return payload.decode('utf-8')
+
+    async def close(self, code: int = 1000) -> None:
+        if self._is_closed:
+            return
+        self._is_closed = True
+        try:
+            self._writer.write(pack_message(CLOSE, struct.pack(CLOSE_FORMAT, code)))
+            await self._writer.drain()
+        except ConnectionError:
+            pass
+        self._writer.close()
+
+
+class FeedSubscriber(Subscriber):
+    # worker side subscriber of a feed : publishes every frame due to the front, preceded
+    # by the sync frames a new client of the front needs whenever they changed
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # (sync token, ids of the sync frames) the front has
+        self._published_sync = None
+
+    @property
+    def sync_token(self):
+        # the session hands over what a new subscriber needs, every time
+        return None
+
+    def push(self, frame, now: float, frame_version: int, sync_frames: Optional[List] = None, sync_token=None) -> None:
+        if self._is_closed:
+            return
+        self._last_frame_version = frame_version
+        self._next_frame_time = max(now, self._next_frame_time + self.frame_interval())
+        # slow front : drop the oldest frame, the sync frames it carried are published again
+        if self._queue.full() and isinstance(self.drop_oldest(), list):
+            self._published_sync = None
+        published = (sync_token, [id(f) for f in sync_frames or []])
+        if published != self._published_sync:
+            self._published_sync = published
+            frame = [SyncMessage(pack_sync_frames(sync_frames or [], sync_token)), frame]
+        self.enqueue(frame)
+
+    async def send_frame(self, frame) -> None:
+        if isinstance(frame, SyncMessage):
+            await self._ws.send(SYNC, frame)
+        else:
+            await super().send_frame(frame)
+
+
+class RelayedFrameEncoder:
+    # front side copy of the sync frames of a feed, handing them out to the clients the
+    # same way CompactFrameEncoder.sync_frames does : everything to a new client, all
+    # but the first (static) frame to a client holding another sync token
+
+    def __init__(self):
+        self._frames: List = []
+        self._sync_token = None
+
+    def update(self, frames: List, sync_token) -> None:
+        self._frames = frames
+        self._sync_token = sync_token
+
+    def sync_frames(self, sync_token):
+        if sync_token is None:
+            return list(self._frames), self._sync_token
+        if sync_token != self._sync_token:
+            return self._frames[1:], self._sync_token
+        return [], self._sync_token
+
+
+class Feed:
+    # front side of a feed
+
+    def __init__(self, client: 'BrokerClient', key: Hashable, socket_path: str, hello: Dict):
+        self._client = client
+        self._key = key
+        self._socket_path = socket_path
+        self._hello = hello
+        self._subscribers: List[Subscriber] = []
+        self._encoder = RelayedFrameEncoder()
+        self._frame_version = 0
+        self._n_frames = 0
+        self._min_dt: Optional[float] = None
+        self._writer: Optional[asyncio.StreamWriter] = None
+        # control messages waiting for the connection
+        self._pending: List[str] = []
+        self._close_code: Optional[int] = None
+        self._task = asyncio.create_task(self.run())
+
+    def subscribe(self, subscriber: Subscriber) -> None:
+        if self.is_closed:
+            subscriber.close()
+            return
+        self._subscribers.append(subscriber)
+        self.update_min_dt()
+
+    def unsubscribe(self, subscriber: Subscriber) -> None:
+        if subscriber in self._subscribers:
+            self._subscribers.remove(subscriber)
+        subscriber.close()
+        if self._subscribers:
+            self.update_min_dt()
+
+    def update_min_dt(self) -> None:
+        # the worker publishes at the rate of the fastest client
+        min_dt = min(subscriber.min_dt for subscriber in self._subscribers)
+        if min_dt != self._min_dt:
+            self._min_dt = min_dt
+            self.send_text(f'min_dt {min_dt}')
+
+    def control(self, command: str, value: float) -> None:
+        # client controls (replay seek / speed) go to the session in the worker
+        self.send_text(f'{command} {value}')
+
+    def send_text(self, text: str) -> None:
+        if self._writer is None:
+            self._pending.append(text)
+            return
+        self._writer.write(pack_message(TEXT, text.encode('utf-8')))
+
+    async def run(self) -> None:
+        try:
+            reader, self._writer = await asyncio.open_unix_connection(self._socket_path)
+        except OSError as e:
+            print(f'simulation worker {self._socket_path} unreachable : {e}')
+            # try again later
+            self.close(1013)
+            return
+        try:
+            # the hello already asks for the current min_dt
+            self._pending = [text for text in self._pending if not text.startswith('min_dt ')]
+            options = {**self._hello['options'], 'min_dt': self._min_dt}
+            self._writer.write(pack_message(HELLO, json.dumps({**self._hello, 'options': options}).encode('utf-8')))
+            for text in self._pending:
+                self.send_text(text)
+            self._pending = []
+            while True:
+                kind, payload = await read_message(reader)
+                if kind == SYNC:
+                    self._encoder.update(*unpack_sync_frames(payload))
+                elif kind == TEXT:
+                    self.broadcast(payload.decode('utf-8'))
+                elif kind == BYTES:
+                    self.broadcast(payload)
+                else:
+                    # closed by the worker (or the worker is gone)
+                    self.close(close_code(payload) if kind == CLOSE else 1011)
+                    return
+        finally:
+            self._writer.close()
+
+    def broadcast(self, frame) -> None:
+        # fan out : each client gets the frame if it is due for one
+        now = time.perf_counter()
+        self._frame_version += 1
+        self._n_frames += 1
+        for subscriber in self._subscribers:
+            if not subscriber.is_frame_due(now, self._frame_version):
+                continue
+            sync_frames, sync_token = self._encoder.sync_frames(subscriber.sync_token)
+            subscriber.push(frame, now, self._frame_version, sync_frames, sync_token)
+
+    def close(self, code: int = 1000) -> None:
+        # the clients' connections end with the worker's close code
+        if self._close_code is None:
+            self._close_code = code
+        for subscriber in self._subscribers:
+            subscriber.close()
+        self._subscribers = []
+        self._client.forget(self)
+
+    async def stop(self) -> None:
+        # last client gone : unsubscribe from the session
+        self.close()
+        if self._writer is not None and not self._writer.is_closing():
+            self._writer.write(pack_message(CLOSE, struct.pack(CLOSE_FORMAT, 1000)))
+        self._task.cancel()
+        await asyncio.wait([self._task])
+
+    def stats(self) -> Dict:
+        return {
+            'socket': self._socket_path,
+            'simulator': self._hello['simulator'],
+            'n_subscribers': len(self._subscribers),
+            'n_frames': self._n_frames,
+            'min_dt': self._min_dt,
+        }
+
+    @property
+    def key(self) -> Hashable:
+        return self._key
+
+    @property
+    def n_subscribers(self) -> int:
+        return len(self._subscribers)
+
+    @property
+    def is_closed(self) -> bool:
+        return self._close_code is not None
+
+    @property
+    def close_code(self) -> Optional[int]:
+        return self._close_code
+
+
+class BrokerClient:
+    # front side : picks the worker of a session and keeps the feeds of this front
+
+    def __init__(self, socket_paths: List[str]):
+        self._socket_paths = socket_paths
+        self._next_worker = itertools.count()
+        self._feeds: Dict[Hashable, Feed] = {}
+        # private sessions get a feed of their own
+        self._private_ids = itertools.count(1)
+
+    def socket_path(self, session_key: Optional[Tuple]) -> str:
+        # shared sessions : same key, same worker, whichever front the client landed on
+        # (crc32 of the key, python's hash() differs between processes).
+        # Private sessions go round robin.
+        if session_key is None:
+            index = next(self._next_worker)
+        else:
+            index = zlib.crc32(repr(session_key).encode('utf-8'))
+        return self._socket_paths[index % len(self._socket_paths)]
+
+    def worker_socket_path(self, session_id: int) -> str:
+        # worker i of n gives its sessions the ids i + k*n (worker.py --index, --n-workers)
+        return self._socket_paths[session_id % len(self._socket_paths)]
+
+    def subscribe(self, session_key: Optional[Tuple], subscriber: Subscriber, hello: Dict) -> Feed:
+        # feed of the session for the subscriber's encoding, opened first if there is none
+        if session_key is None:
+            key = ('private', next(self._private_ids))
+        else:
+            key = (session_key, subscriber.encoding)
+        feed = self._feeds.get(key)
+        if feed is None:
+            feed = self._feeds[key] = Feed(self, key, self.socket_path(session_key), hello)
+        feed.subscribe(subscriber)
+        return feed
+
+    async def unsubscribe(self, feed: Feed, subscriber: Subscriber) -> None:
+        feed.unsubscribe(subscriber)
+        if feed.n_subscribers == 0:
+            await feed.stop()
+
+    def forget(self, feed: Feed) -> None:
+        if self._feeds.get(feed.key) is feed:
+            del self._feeds[feed.key]
+
+    async def close(self) -> None:
+        for feed in list(self._feeds.values()):
+            await feed.stop()
+
+    async def request(self, socket_path: str, hello: Dict, timeout: float = REQUEST_TIMEOUT):
+        # one json answer (e.g. {"type": "sessions"}). A worker that does not answer in time
+        # raises TimeoutError, an OSError like an unreachable one
+        try:
+            return await asyncio.wait_for(self.round_trip(socket_path, hello), timeout)
+        except asyncio.TimeoutError:
+            raise TimeoutError(f'simulation worker {socket_path} did not answer within {timeout} s') from None
+
+    async def round_trip(self, socket_path: str, hello: Dict):
+        reader, writer = await asyncio.open_unix_connection(socket_path)
+        try:
+            writer.write(pack_message(HELLO, json.dumps(hello).encode('utf-8')))
+            await writer.drain()
+            kind, payload = await read_message(reader)
+            return json.loads(payload) if kind == TEXT else None
+        finally:
+            writer.close()
+
+    def stats(self) -> Dict:
+        return {
+            'n_feeds': len(self._feeds),
+            'feeds': [feed.stats() for feed in self._feeds.values()],
+        }
+
+    @property
+    def socket_paths(self) -> List[str]:
+        return self._socket_paths
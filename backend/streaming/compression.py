@@ -0,0 +1,138 @@
+import time
+import zlib
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from streaming.metrics import COMPRESS_SECONDS, COMPRESSED_BYTES, NULL_TIMER, UNCOMPRESSED_BYTES
+
+try:
+    import lz4.frame
+except ImportError:  # optional : lz4 codecs are only offered when installed
+    lz4 = None
+
+
+# Application level compression of whole frames. A compressed frame is always
+# sent as a binary message holding only the codec output; the client knows the
+# codec from the compression / compression_level query parameters it connected with.
+#
+# shuffle-* codecs transpose the frame bytes as 4 byte elements before compressing
+# (all bytes 0 of every float, then all bytes 1, ...). Exponents and high mantissa
+# bytes of coherent float data then form long similar runs. Binary frames are a
+# multiple of 4 bytes long (see streaming/frame.py), so these need a binary format.
+
+SHUFFLE_ITEMSIZE = 4
+
+
+def shuffle(data: bytes) -> bytes:
+    return np.frombuffer(data, dtype=np.uint8).reshape(-1, SHUFFLE_ITEMSIZE).T.tobytes()
+
+
+def unshuffle(data: bytes) -> bytes:
+    return np.frombuffer(data, dtype=np.uint8).reshape(SHUFFLE_ITEMSIZE, -1).T.tobytes()
+
+
+class ZlibCodec:
+    name = 'zlib'
+    default_level = 6
+    levels = range(0, 10)
+
+    def __init__(self, level: int):
+        self.level = level
+
+    def compress(self, data: bytes) -> bytes:
+        return zlib.compress(data, self.level)
+
+    def decompress(self, data: bytes) -> bytes:
+        return zlib.decompress(data)
+
+
+class LZ4Codec(ZlibCodec):
+    name = 'lz4'
+    default_level = 0
+    levels = range(0, 17)
+
+    def compress(self, data: bytes) -> bytes:
+        return lz4.frame.compress(data, compression_level=self.level)
+
+    def decompress(self, data: bytes) -> bytes:
+        return lz4.frame.decompress(data)
+
+
+class ShuffleCodec:
+
+    def __init__(self, codec):
+        self._codec = codec
+        self.name = 'shuffle-' + codec.name
+        self.level = codec.level
+
+    def compress(self, data: bytes) -> bytes:
+        return self._codec.compress(shuffle(data))
+
+    def decompress(self, data: bytes) -> bytes:
+        return unshuffle(self._codec.decompress(data))
+
+
+CODECS = {'zlib': ZlibCodec}
+if lz4 is not None:
+    CODECS['lz4'] = LZ4Codec
+
+
+def create_codec(name: Optional[str], level: Optional[int] = None):
+    # name : None / 'none', a codec of CODECS, or 'shuffle-<codec>'
+    if not name or name == 'none':
+        return None
+    base_name = name[len('shuffle-'):] if name.startswith('shuffle-') else name
+    if base_name not in CODECS:
+        choices = ['none'] + [prefix + n for n in CODECS for prefix in ('', 'shuffle-')]
+        raise ValueError(f'unknown compression : {name} (choose from {choices})')
+    codec_class = CODECS[base_name]
+    if level is None:
+        level = codec_class.default_level
+    if level not in codec_class.levels:
+        raise ValueError(f'{base_name} compression level must be in [{codec_class.levels.start}, {codec_class.levels.stop - 1}]')
+    codec = codec_class(level)
+    return ShuffleCodec(codec) if base_name != name else codec
+
+
+class CompressedFrameEncoder:
+    # wraps a frame encoder and compresses everything it produces
+
+    def __init__(self, encoder, codec, simulator_type: str = ''):
+        self._encoder = encoder
+        self._codec = codec
+        self._metric_labels = (simulator_type, codec.name, str(codec.level))
+        # the stateful encoders resend the same static / keyframe objects, compress those once
+        self._sync_cache: Dict[int, Tuple[bytes, bytes]] = {}
+
+    @property
+    def encoder(self):
+        return self._encoder
+
+    def compress(self, frame) -> bytes:
+        raw = frame.encode('utf-8') if isinstance(frame, str) else frame
+        start = time.perf_counter()
+        compressed = self._codec.compress(raw)
+        COMPRESS_SECONDS.observe(self._metric_labels, time.perf_counter() - start)
+        UNCOMPRESSED_BYTES.inc(self._metric_labels, len(raw))
+        COMPRESSED_BYTES.inc(self._metric_labels, len(compressed))
+        return compressed
+
+    def encode(self, simulator, simulator_id: int, timer=NULL_TIMER) -> bytes:
+        frame = self._encoder.encode(simulator, simulator_id, timer)
+        with timer.span('compress'):
+            return self.compress(frame)
+
+    def sync_frames(self, sync_token) -> Tuple[List[bytes], object]:
+        frames, sync_token = self._encoder.sync_frames(sync_token)
+        compressed_frames = []
+        for frame in frames:
+            cached = self._sync_cache.get(id(frame))
+            # keep the raw frame referenced so that its id stays unique
+            if cached is None or cached[0] is not frame:
+                cached = self._sync_cache[id(frame)] = (frame, self.compress(frame))
+            compressed_frames.append(cached[1])
+        # only the latest static frame and keyframe are ever resent
+        if len(self._sync_cache) > 8:
+            self._sync_cache = {key: value for key, value in self._sync_cache.items() if any(value[0] is f for f in frames)}
+        return compressed_frames, sync_token
@@ -0,0 +1,57 @@
+import os
+from typing import Optional
+from urllib.parse import parse_qs, urlparse
+
+from uvicorn.protocols.websockets.websockets_impl import WebSocketProtocol
+from websockets.extensions.permessage_deflate import ServerPerMessageDeflateFactory
+
+
+# Server side permessage-deflate settings of the websocket connections, for the
+# websockets based uvicorn protocol below (run_server.py starts uvicorn with it) :
+#   WS_DEFLATE                      0 : never negotiate permessage-deflate
+#   WS_DEFLATE_LEVEL                zlib level of the frames the server sends (1 fast .. 9 small, default 6)
+#   WS_DEFLATE_MEM_LEVEL            zlib memLevel (1 .. 9, default 8)
+#   WS_DEFLATE_WINDOW_BITS          server_max_window_bits (9 .. 15, default 15) : a smaller window
+#                                   holds less memory per connection and finds fewer matches
+#   WS_DEFLATE_NO_CONTEXT_TAKEOVER  1 : reset the compressor after every message, less memory per
+#                                   connection but no matches against the previous frames
+# Each connection keeps its own compressor : with many clients, the window and memLevel
+# decide most of the per connection memory, the level most of the CPU time.
+#
+# Frames compressed by an application level codec (compression query parameter, see
+# streaming/compression.py) don't shrink when deflated once more, connections asking
+# for one are never offered permessage-deflate, whatever the client proposes.
+#
+# uvicorn has no setting for the deflate parameters or a per connection choice, so this
+# subclasses its websockets implementation (websockets' legacy server protocol), which is
+# not a public API : pyproject.toml pins uvicorn and websockets to the versions checked.
+
+
+def create_deflate_factory() -> Optional[ServerPerMessageDeflateFactory]:
+    if os.environ.get('WS_DEFLATE', '1') == '0':
+        return None
+    window_bits = os.environ.get('WS_DEFLATE_WINDOW_BITS')
+    return ServerPerMessageDeflateFactory(
+        server_no_context_takeover=os.environ.get('WS_DEFLATE_NO_CONTEXT_TAKEOVER', '0') == '1',
+        server_max_window_bits=int(window_bits) if window_bits else None,
+        compress_settings={
+            'level': int(os.environ.get('WS_DEFLATE_LEVEL', 6)),
+            'memLevel': int(os.environ.get('WS_DEFLATE_MEM_LEVEL', 8)),
+        },
+    )
+
+
+DEFLATE_FACTORY = create_deflate_factory()
+
+
+class DeflateWebSocketProtocol(WebSocketProtocol):
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.available_extensions = [DEFLATE_FACTORY] if DEFLATE_FACTORY is not None else []
+
+    def process_extensions(self, headers, available_extensions):
+        # self.path : request target, read before the extensions are negotiated
+        if 'compression' in parse_qs(urlparse(self.path).query):
+            available_extensions = []
+        return super().process_extensions(headers, available_extensions)
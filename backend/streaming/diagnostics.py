@@ -0,0 +1,170 @@
+import collections
+import json
+import time
+from typing import Deque, Dict, Tuple
+
+import numpy as np
+
+from streaming.metrics import NULL_TIMER
+
+
+# Diagnostics stream mode (frame_format=diagnostics) : instead of the state arrays,
+# subscribers get small JSON summaries of the reductions each simulator computes in
+# get_diagnostics(). The session samples them once per loop iteration (after the
+# steps it ran) into a DiagnosticsAccumulator :
+#   scalars        latest value, mean / std / min / max over the whole run and
+#                  mean / std over the last `window` samples
+#   arrays         latest value and mean over the window (histograms, momentum, ...)
+#   <name>_total   cumulative quantities, also reported as '<name>_rate', their
+#                  change per simulated time unit over the window
+#                  (e.g. wall_momentum_total -> wall_momentum_rate, the gas pressure)
+# Windows keep running sums, a sample costs O(number of diagnostics), not O(window).
+
+TOTAL_SUFFIX = '_total'
+
+
+class RunningStats:
+    # mean / variance (Welford), min and max of every sample
+
+    def __init__(self):
+        self.n = 0
+        self.mean = 0.0
+        self._m2 = 0.0
+        self.min = np.inf
+        self.max = -np.inf
+
+    def add(self, value: float) -> None:
+        self.n += 1
+        delta = value - self.mean
+        self.mean += delta / self.n
+        self._m2 += delta * (value - self.mean)
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+
+    @property
+    def std(self) -> float:
+        return float(np.sqrt(self._m2 / self.n)) if self.n > 1 else 0.0
+
+
+class WindowStats:
+    # mean / std of the last `size` samples (scalars or arrays of a fixed shape)
+
+    def __init__(self, size: int):
+        self._size = size
+        self.clear()
+
+    def clear(self) -> None:
+        self._values: Deque = collections.deque()
+        self._sum = 0.0
+        self._sum2 = 0.0
+
+    def add(self, value) -> None:
+        if self._values and np.shape(value) != np.shape(self._values[0]):
+            # the shape changed, start over
+            self.clear()
+        self._values.append(value)
+        self._sum = self._sum + value
+        self._sum2 = self._sum2 + np.square(value)
+        if len(self._values) > self._size:
+            evicted = self._values.popleft()
+            self._sum = self._sum - evicted
+            self._sum2 = self._sum2 - np.square(evicted)
+
+    @property
+    def mean(self):
+        return self._sum / len(self._values)
+
+    @property
+    def std(self):
+        # running sums lose precision, clip the rounding below 0
+        return np.sqrt(np.maximum(self._sum2 / len(self._values) - np.square(self.mean), 0.0))
+
+
+class DiagnosticsAccumulator:
+
+    def __init__(self, window: int = 64):
+        self._window = window
+        self._n_samples = 0
+        self._latest: Dict = {}
+        self._running: Dict[str, RunningStats] = {}
+        self._windows: Dict[str, WindowStats] = {}
+        # (time, value) of the totals, oldest first
+        self._totals: Dict[str, Deque[Tuple[float, float]]] = {}
+
+    def add(self, diagnostics: Dict) -> None:
+        t = float(diagnostics.get('time', self._n_samples))
+        self._n_samples += 1
+        for name, value in diagnostics.items():
+            if name == 'time':
+                continue
+            if name.endswith(TOTAL_SUFFIX):
+                totals = self._totals.setdefault(name, collections.deque(maxlen=self._window + 1))
+                if totals and t <= totals[-1][0]:
+                    # simulator reset (pool reuse, restore) : rates start over
+                    totals.clear()
+                totals.append((t, float(value)))
+                self._latest[name] = float(value)
+                continue
+            if name not in self._windows:
+                self._windows[name] = WindowStats(self._window)
+            if isinstance(value, (list, tuple, np.ndarray)):
+                # copied : the process backend hands out views of shared memory
+                value = np.array(value, dtype=np.float64)
+            else:
+                value = float(value)
+                self._running.setdefault(name, RunningStats()).add(value)
+            self._windows[name].add(value)
+            self._latest[name] = value
+        self._latest['time'] = t
+
+    def summary(self) -> Dict:
+        summary = {}
+        for name, value in self._latest.items():
+            if name == 'time':
+                continue
+            if name.endswith(TOTAL_SUFFIX):
+                summary[name] = {'value': value}
+                totals = self._totals[name]
+                (t0, v0), (t1, v1) = totals[0], totals[-1]
+                summary[name[:-len(TOTAL_SUFFIX)] + '_rate'] = {'value': (v1 - v0) / (t1 - t0) if t1 > t0 else 0.0}
+            elif isinstance(value, np.ndarray):
+                summary[name] = {'value': value.tolist(), 'window_mean': self._windows[name].mean.tolist()}
+            else:
+                running = self._running[name]
+                window = self._windows[name]
+                summary[name] = {
+                    'value': value,
+                    'mean': running.mean,
+                    'std': running.std,
+                    'min': running.min,
+                    'max': running.max,
+                    'window_mean': float(window.mean),
+                    'window_std': float(window.std),
+                }
+        return {
+            'time': self._latest.get('time'),
+            'n_samples': self._n_samples,
+            'window': self._window,
+            'diagnostics': summary,
+        }
+
+    @property
+    def n_samples(self) -> int:
+        return self._n_samples
+
+
+class DiagnosticsFrameEncoder:
+    # JSON frames with the accumulator's summary, whatever the simulator argument
+
+    def __init__(self, accumulator: DiagnosticsAccumulator):
+        self._accumulator = accumulator
+
+    def encode(self, simulator, simulator_id: int, timer=NULL_TIMER) -> str:
+        with timer.span('encode'):
+            summary = self._accumulator.summary()
+            summary['simulator_id'] = simulator_id
+            summary['timestamp'] = time.time()
+            return json.dumps(summary, separators=(',', ':'))
+
+    def sync_frames(self, sync_token):
+        return [], sync_token
@@ -0,0 +1,380 @@
+import asyncio
+import itertools
+import multiprocessing
+import os
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from multiprocessing.shared_memory import SharedMemory
+from typing import TYPE_CHECKING, Dict, List, Optional
+
+import numpy as np
+
+if TYPE_CHECKING:
+    from simulator.ideal_gas import IdealGasBatch
+
+
+# cap on the substeps one step is split into, for simulators that blew up
+MAX_STABLE_SUBSTEPS = 64
+
+
+def _run_steps(simulator, dt: float, n_steps: int) -> None:
+    for _ in range(n_steps):
+        # split the step into equal substeps within the simulator's stability limit
+        max_stable_dt = simulator.max_stable_dt()
+        n_substeps = 1
+        if 0 < max_stable_dt < dt:
+            n_substeps = min(MAX_STABLE_SUBSTEPS, int(np.ceil(dt / max_stable_dt)))
+        for _ in range(n_substeps):
+            simulator.update(dt=dt / n_substeps)
+
+
+class InlineSimulatorHandle:
+    # steps in the event loop thread
+
+    def __init__(self, simulator):
+        self._simulator = simulator
+
+    async def update(self, dt: float, n_steps: int = 1) -> None:
+        _run_steps(self._simulator, dt, n_steps)
+
+    def get_states(self) -> Dict:
+        return self._simulator.get_states()
+
+    def get_state_arrays(self) -> Dict:
+        return self._simulator.get_state_arrays()
+
+    def get_static_states(self) -> Dict:
+        return self._simulator.get_static_states()
+
+    def get_dynamic_state_arrays(self) -> Dict:
+        return self._simulator.get_dynamic_state_arrays()
+
+    def get_field_bounds(self) -> Dict:
+        return self._simulator.get_field_bounds()
+
+    def get_diagnostics(self) -> Dict:
+        return self._simulator.get_diagnostics()
+
+    async def control(self, command: str, value: float) -> None:
+        # only called between two updates, never while a step runs
+        self._simulator.control(command, value)
+
+    async def close(self) -> None:
+        pass
+
+    @property
+    def simulator(self):
+        return self._simulator
+
+
+class ThreadSimulatorHandle(InlineSimulatorHandle):
+    # steps in a worker thread, numpy releases the GIL for the heavy array ops
+
+    def __init__(self, simulator, pool: ThreadPoolExecutor):
+        super().__init__(simulator)
+        self._pool = pool
+        self._step_future: Optional[Future] = None
+
+    async def update(self, dt: float, n_steps: int = 1) -> None:
+        self._step_future = self._pool.submit(_run_steps, self._simulator, dt, n_steps)
+        await asyncio.wrap_future(self._step_future)
+
+    async def close(self) -> None:
+        # a cancelled update keeps running in its thread : wait for it before
+        # the simulator is handed to anyone else (e.g. reset by the pool)
+        if self._step_future is not None and not self._step_future.done():
+            await asyncio.wait([asyncio.wrap_future(self._step_future)])
+        self._step_future = None
+
+
+# state getters whose arrays are mirrored into shared memory by the process backend
+# (diagnostics are reduced in the worker too, right after its steps)
+SHARED_STATE_GETTERS = ('get_state_arrays', 'get_dynamic_state_arrays', 'get_diagnostics')
+
+# worker process side of ProcessSimulatorHandle
+_worker_simulators: Dict[int, tuple] = {}
+
+
+def _worker_copy_states(simulator, views: Dict[tuple, np.ndarray]) -> Dict:
+    scalars = {}
+    for getter in SHARED_STATE_GETTERS:
+        for key, value in getattr(simulator, getter)().items():
+            if (getter, key) in views:
+                np.copyto(views[(getter, key)], value)
+            else:
+                scalars[(getter, key)] = value
+    return scalars
+
+
+def _worker_create(key: int, simulator, shm_specs: Dict[tuple, tuple]) -> Dict:
+    shms = {}
+    views = {}
+    for name, (shm_name, shape, dtype) in shm_specs.items():
+        shms[name] = SharedMemory(name=shm_name)
+        views[name] = np.ndarray(shape, dtype=dtype, buffer=shms[name].buf)
+    _worker_simulators[key] = (simulator, shms, views)
+    return _worker_copy_states(simulator, views)
+
+
+def _worker_step(key: int, dt: float, n_steps: int) -> Dict:
+    simulator, _, views = _worker_simulators[key]
+    _run_steps(simulator, dt, n_steps)
+    return _worker_copy_states(simulator, views)
+
+
+def _worker_control(key: int, command: str, value: float) -> Dict:
+    simulator, _, views = _worker_simulators[key]
+    simulator.control(command, value)
+    return _worker_copy_states(simulator, views)
+
+
+def _worker_remove(key: int) -> None:
+    _, shms, views = _worker_simulators.pop(key)
+    views.clear()
+    for shm in shms.values():
+        shm.close()
+
+
+class ProcessSimulatorHandle:
+    # the simulator lives in a worker process and writes its state arrays
+    # into shared memory after every step, so reading them here costs no pickling
+
+    def __init__(self, key: int, simulator, pool: ProcessPoolExecutor):
+        self._key = key
+        self._simulator = simulator
+        self._pool = pool
+        self._shms: Dict[tuple, SharedMemory] = {}
+        self._views: Dict[tuple, np.ndarray] = {}
+        self._scalars: Dict = {}
+        self._is_created = False
+        # static fields and bounds don't change, keep them from the local copy
+        self._static_states = simulator.get_static_states()
+        self._field_bounds = simulator.get_field_bounds()
+
+    async def create(self) -> None:
+        shm_specs = {}
+        for getter in SHARED_STATE_GETTERS:
+            for key, value in getattr(self._simulator, getter)().items():
+                if not isinstance(value, np.ndarray):
+                    continue
+                shm = SharedMemory(create=True, size=max(1, value.nbytes))
+                self._shms[(getter, key)] = shm
+                self._views[(getter, key)] = np.ndarray(value.shape, dtype=value.dtype, buffer=shm.buf)
+                shm_specs[(getter, key)] = (shm.name, value.shape, value.dtype.str)
+        loop = asyncio.get_running_loop()
+        self._scalars = await loop.run_in_executor(
+            self._pool, _worker_create, self._key, self._simulator, shm_specs,
+        )
+        self._is_created = True
+
+    async def update(self, dt: float, n_steps: int = 1) -> None:
+        if not self._is_created:
+            await self.create()
+        loop = asyncio.get_running_loop()
+        self._scalars = await loop.run_in_executor(self._pool, _worker_step, self._key, dt, n_steps)
+
+    async def control(self, command: str, value: float) -> None:
+        if not self._is_created:
+            self._simulator.control(command, value)
+            return
+        loop = asyncio.get_running_loop()
+        self._scalars = await loop.run_in_executor(self._pool, _worker_control, self._key, command, value)
+
+    def get_states(self) -> Dict:
+        # built from the state arrays, plus the diagnostics scalars (energies, momentum, ...)
+        # that a simulator's get_states() may add to them
+        states = {**self.get_diagnostics(), **self.get_state_arrays()}
+        return {
+            key: value.tolist() if isinstance(value, np.ndarray) else value
+            for key, value in states.items()
+        }
+
+    def get_state_arrays(self) -> Dict:
+        return self.get_shared_states('get_state_arrays')
+
+    def get_static_states(self) -> Dict:
+        return dict(self._static_states)
+
+    def get_dynamic_state_arrays(self) -> Dict:
+        return self.get_shared_states('get_dynamic_state_arrays')
+
+    def get_field_bounds(self) -> Dict:
+        return self._field_bounds
+
+    def get_diagnostics(self) -> Dict:
+        return self.get_shared_states('get_diagnostics')
+
+    def get_shared_states(self, getter: str) -> Dict:
+        if not self._is_created:
+            return getattr(self._simulator, getter)()
+        states = {key: value for (g, key), value in self._scalars.items() if g == getter}
+        states.update({key: value for (g, key), value in self._views.items() if g == getter})
+        return states
+
+    async def close(self) -> None:
+        try:
+            if self._is_created:
+                self._is_created = False
+                loop = asyncio.get_running_loop()
+                await loop.run_in_executor(self._pool, _worker_remove, self._key)
+        finally:
+            # release the blocks even if the close was cancelled, the worker
+            # mapping stays valid until it detaches
+            self._views.clear()
+            for shm in self._shms.values():
+                shm.close()
+                shm.unlink()
+            self._shms.clear()
+
+    @property
+    def simulator(self):
+        # state of the local copy is only valid until the first step
+        return self._simulator
+
+
+class InlineStepExecutor:
+
+    def attach(self, simulator) -> InlineSimulatorHandle:
+        return InlineSimulatorHandle(simulator)
+
+    def shutdown(self) -> None:
+        pass
+
+
+class ThreadStepExecutor:
+
+    def __init__(self, max_workers: Optional[int] = None):
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='simulator')
+
+    def attach(self, simulator) -> ThreadSimulatorHandle:
+        return ThreadSimulatorHandle(simulator, self._pool)
+
+    def shutdown(self) -> None:
+        self._pool.shutdown(wait=False)
+
+
+class ProcessStepExecutor:
+
+    def __init__(self, max_workers: Optional[int] = None):
+        # one single-process pool per worker so that a simulator stays pinned
+        # to the process holding its state
+        n_workers = max_workers or os.cpu_count() or 1
+        mp_context = multiprocessing.get_context('spawn')
+        self._pools: List[ProcessPoolExecutor] = [
+            ProcessPoolExecutor(max_workers=1, mp_context=mp_context) for _ in range(n_workers)
+        ]
+        self._keys = itertools.count(1)
+
+    def attach(self, simulator) -> ProcessSimulatorHandle:
+        key = next(self._keys)
+        return ProcessSimulatorHandle(key, simulator, self._pools[key % len(self._pools)])
+
+    def shutdown(self) -> None:
+        for pool in self._pools:
+            pool.shutdown(wait=False)
+
+
+class BatchSimulatorHandle(InlineSimulatorHandle):
+    # ideal gas instance living in a slot of an IdealGasBatch, steps are
+    # queued on the executor and run together with the other slots
+
+    def __init__(self, simulator, executor: 'BatchStepExecutor', engine, slot: int):
+        super().__init__(simulator)
+        self._executor = executor
+        self._engine = engine
+        self._slot = slot
+        self._is_closed = False
+
+    async def update(self, dt: float, n_steps: int = 1) -> None:
+        # the substeps of one loop iteration are merged into a single dt*n_steps step,
+        # the motion is ballistic between walls so this only changes multiple bounces
+        await self._executor.request_step(self._engine, self._slot, dt * n_steps)
+
+    async def close(self) -> None:
+        if not self._is_closed:
+            self._is_closed = True
+            self._executor.detach(self._engine, self._slot)
+
+
+class BatchStepExecutor:
+    # steps every attached ideal gas instance with one vectorized update per tick
+    # (one IdealGasBatch per particle count), in the event loop thread.
+    # Other simulators and colliding ideal gases fall back to inline stepping.
+
+    def __init__(self, tick: float = 0.005):
+        self._tick = tick
+        self._engines: Dict[int, 'IdealGasBatch'] = {}
+        # engine -> {slot: dt accumulated since the last flush}
+        self._pending_dts: Dict['IdealGasBatch', Dict[int, float]] = {}
+        self._waiters: List[asyncio.Future] = []
+        self._flush_handle: Optional[asyncio.TimerHandle] = None
+
+    def attach(self, simulator) -> InlineSimulatorHandle:
+        # imported on first use like the simulator modules themselves (simulator/registry.py)
+        from simulator.ideal_gas import IdealGasBatch, IdealGasSystem
+        if not isinstance(simulator, IdealGasSystem) or simulator._particle_radius > 0:
+            # the batched engine only does wall reflections
+            return InlineSimulatorHandle(simulator)
+        engine = self._engines.get(simulator._n_particles)
+        if engine is None:
+            engine = self._engines[simulator._n_particles] = IdealGasBatch(simulator._n_particles)
+            self._pending_dts[engine] = {}
+        slot = engine.add(simulator)
+        return BatchSimulatorHandle(simulator, self, engine, slot)
+
+    def detach(self, engine: 'IdealGasBatch', slot: int) -> None:
+        self._pending_dts[engine].pop(slot, None)
+        engine.remove(slot)
+        if engine.n_instances == 0:
+            # don't keep batches of particle counts nobody streams anymore
+            self._engines = {n: e for n, e in self._engines.items() if e is not engine}
+            del self._pending_dts[engine]
+
+    async def request_step(self, engine: 'IdealGasBatch', slot: int, dt: float) -> None:
+        pending_dts = self._pending_dts[engine]
+        pending_dts[slot] = pending_dts.get(slot, 0.0) + dt
+        loop = asyncio.get_running_loop()
+        waiter = loop.create_future()
+        self._waiters.append(waiter)
+        if self._flush_handle is None:
+            # flush on tick boundaries so that sessions waking up at different times
+            # still end up in the same batch
+            delay = self._tick - loop.time() % self._tick
+            self._flush_handle = loop.call_later(delay, self.flush)
+        await waiter
+
+    def flush(self) -> None:
+        self._flush_handle = None
+        for engine, pending_dts in self._pending_dts.items():
+            if not pending_dts:
+                continue
+            dts = np.zeros(engine.capacity)
+            for slot, dt in pending_dts.items():
+                dts[slot] = dt
+            pending_dts.clear()
+            engine.update(dts)
+        waiters, self._waiters = self._waiters, []
+        for waiter in waiters:
+            if not waiter.done():
+                waiter.set_result(None)
+
+    def shutdown(self) -> None:
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+
+
+STEP_EXECUTORS = {
+    'inline': InlineStepExecutor,
+    'thread': ThreadStepExecutor,
+    'process': ProcessStepExecutor,
+    'batch': BatchStepExecutor,
+}
+
+
+def create_step_executor(name: str, max_workers: Optional[int] = None):
+    if name not in STEP_EXECUTORS:
+        raise ValueError(f'unknown step executor : {name} (choose from {list(STEP_EXECUTORS)})')
+    if name in ('inline', 'batch'):
+        # no worker pool
+        return STEP_EXECUTORS[name]()
+    return STEP_EXECUTORS[name](max_workers=max_workers)
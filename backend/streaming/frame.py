@@ -0,0 +1,275 @@
+import json
+import struct
+import time
+from enum import Enum
+from typing import Dict, Tuple
+
+import numpy as np
+
+from streaming.metrics import NULL_TIMER
+
+
+# Binary frame layout (little endian):
+#   uint32        header length in bytes (H)
+#   H bytes       utf-8 json header, space padded to a multiple of 4 bytes
+#   field data    raw buffers, each starting at header['fields'][i]['offset']
+#                 (relative to the start of the data section, 4 byte aligned)
+#
+# The header holds every scalar state entry (time, simulator_id, timestamp, ...) and
+# for each array entry its name, dtype, shape, offset and nbytes.
+#
+# The compact format uses the same layout with a 'frame_type' header entry:
+#   static     sent once to every subscriber, fields that never change
+#              (particle count, wave grid x/z coordinates, ...)
+#   keyframe   changing fields quantized to int16,
+#              value = (q + 32768) * quantization[name]['scale'] + quantization[name]['min']
+#   delta      int8 differences to the quantized fields of keyframe 'keyframe_id', in units
+#              of 2**delta_shift[name] quantization steps (shift <= 4 : 8 steps of error at most).
+#              The few elements that don't fit hold -128 and are patched from '<name>.patch_index'
+#              (uint32 flat indices) and '<name>.patch_delta' (exact int16 differences). Fields
+#              with many such elements are sent as exact int16 differences instead.
+
+HEADER_LEN_FORMAT = '<I'
+HEADER_LEN_SIZE = struct.calcsize(HEADER_LEN_FORMAT)
+ALIGNMENT = 4
+
+
+class FrameFormat(Enum):
+    JSON = 'json'
+    BINARY = 'binary'
+    COMPACT = 'compact'
+    # json summaries of the simulator's diagnostics only (streaming/diagnostics.py)
+    DIAGNOSTICS = 'diagnostics'
+
+
+def _pad(n: int) -> int:
+    return (-n) % ALIGNMENT
+
+
+def encode_binary_frame(states: Dict, dtype=np.float32) -> bytes:
+    header = {}
+    fields = []
+    buffers = []
+    offset = 0
+    for key, value in states.items():
+        if not isinstance(value, np.ndarray):
+            header[key] = value
+            continue
+        # floating point fields are sent as dtype, integer (quantized) fields as they are
+        buf = np.ascontiguousarray(value, dtype=dtype if value.dtype.kind == 'f' else None)
+        fields.append({
+            'name': key,
+            'dtype': buf.dtype.str,
+            'shape': list(buf.shape),
+            'offset': offset,
+            'nbytes': buf.nbytes,
+        })
+        buffers.append(memoryview(buf).cast('B'))
+        offset += buf.nbytes
+        if _pad(buf.nbytes):
+            buffers.append(b'\x00' * _pad(buf.nbytes))
+            offset += _pad(buf.nbytes)
+    header['fields'] = fields
+    header_bytes = json.dumps(header, separators=(',', ':')).encode('utf-8')
+    header_bytes += b' ' * _pad(HEADER_LEN_SIZE + len(header_bytes))
+    return b''.join([struct.pack(HEADER_LEN_FORMAT, len(header_bytes)), header_bytes, *buffers])
+
+
+def decode_binary_frame(frame: bytes) -> Tuple[Dict, Dict[str, np.ndarray]]:
+    header_len, = struct.unpack_from(HEADER_LEN_FORMAT, frame, 0)
+    header = json.loads(frame[HEADER_LEN_SIZE:HEADER_LEN_SIZE+header_len])
+    data_start = HEADER_LEN_SIZE + header_len
+    arrays = {}
+    for field in header['fields']:
+        arrays[field['name']] = np.frombuffer(
+            frame,
+            dtype=np.dtype(field['dtype']),
+            count=int(np.prod(field['shape'])),
+            offset=data_start+field['offset'],
+        ).reshape(field['shape'])
+    return header, arrays
+
+
+
+class JSONFrameEncoder:
+
+    def encode(self, simulator, simulator_id: int, timer=NULL_TIMER) -> str:
+        with timer.span('get_states'):
+            states = simulator.get_states()
+        states['simulator_id'] = simulator_id
+        # wall clock time of encoding, lets clients measure frame latency
+        states['timestamp'] = time.time()
+        with timer.span('encode'):
+            return json.dumps(states, separators=(',', ':'))
+
+    def sync_frames(self, sync_token):
+        # frames a subscriber needs before the current one, and its new sync token
+        return [], sync_token
+
+
+class BinaryFrameEncoder(JSONFrameEncoder):
+
+    def encode(self, simulator, simulator_id: int, timer=NULL_TIMER) -> bytes:
+        with timer.span('get_states'):
+            states = simulator.get_state_arrays()
+        states['simulator_id'] = simulator_id
+        states['timestamp'] = time.time()
+        with timer.span('encode'):
+            return encode_binary_frame(states)
+
+
+QUANTIZED_MIN = -32768
+QUANTIZED_RANGE = 65535
+INT8_MAX = 127
+# int8 delta of the elements patched from the patch list
+DELTA_ESCAPE = -128
+PATCH_SUFFIXES = ('.patch_index', '.patch_delta')
+# deltas are coarsened by up to 2**MAX_DELTA_SHIFT quantization steps so that all but
+# 1/PATCH_FRACTION of the elements fit in an int8
+MAX_DELTA_SHIFT = 4
+PATCH_FRACTION = 16
+INT16_MAX = 32767
+
+
+def quantization_params(value: np.ndarray, bounds) -> Tuple[np.ndarray, np.ndarray]:
+    if bounds is None:
+        # no known bounds : use the current range of the data with some headroom
+        lo, hi = float(value.min()), float(value.max())
+        margin = 0.25 * (hi - lo) + 1e-6
+        lo, hi = np.array(lo - margin), np.array(hi + margin)
+    else:
+        lo, hi = np.asarray(bounds[0], dtype=np.float64), np.asarray(bounds[1], dtype=np.float64)
+    scale = np.maximum(hi - lo, 1e-12) / QUANTIZED_RANGE
+    return lo, scale
+
+
+def quantize(value: np.ndarray, lo: np.ndarray, scale: np.ndarray) -> np.ndarray:
+    q = np.rint((value - lo) / scale)
+    np.clip(q, 0, QUANTIZED_RANGE, out=q)
+    return (q + QUANTIZED_MIN).astype(np.int16)
+
+
+def dequantize(q: np.ndarray, lo, scale) -> np.ndarray:
+    return (q.astype(np.float64) - QUANTIZED_MIN) * np.asarray(scale) + np.asarray(lo)
+
+
+class CompactFrameEncoder:
+    # static fields once, then int16 quantized changing fields, optionally as
+    # keyframe + deltas (keyframe_interval > 0 : one keyframe every keyframe_interval frames)
+
+    def __init__(self, keyframe_interval: int = 0):
+        self._keyframe_interval = keyframe_interval
+        self._static_frame = None
+        self._keyframe_id = 0
+        self._keyframe_frame = None
+        self._keyframe_qs: Dict[str, np.ndarray] = {}
+        self._quantization: Dict[str, Tuple[np.ndarray, np.ndarray]] = {}
+        self._n_deltas = 0
+        self._is_delta = False
+
+    def encode(self, simulator, simulator_id: int, timer=NULL_TIMER) -> bytes:
+        with timer.span('get_states'):
+            states = simulator.get_dynamic_state_arrays()
+        with timer.span('encode'):
+            return self.encode_states(simulator, simulator_id, states)
+
+    def encode_states(self, simulator, simulator_id: int, states: Dict) -> bytes:
+        if self._static_frame is None:
+            static_states = simulator.get_static_states()
+            static_states['simulator_id'] = simulator_id
+            static_states['frame_type'] = 'static'
+            self._static_frame = encode_binary_frame(static_states)
+        arrays = {key: value for key, value in states.items() if isinstance(value, np.ndarray)}
+        header = {key: value for key, value in states.items() if not isinstance(value, np.ndarray)}
+        header['simulator_id'] = simulator_id
+        header['timestamp'] = time.time()
+        if self._keyframe_interval > 0 and self._keyframe_frame is not None \
+                and self._n_deltas < self._keyframe_interval - 1:
+            deltas = self.encode_deltas(arrays)
+            if deltas is not None:
+                self._n_deltas += 1
+                self._is_delta = True
+                return encode_binary_frame({
+                    **header,
+                    'frame_type': 'delta',
+                    'keyframe_id': self._keyframe_id,
+                    **deltas,
+                })
+        return self.encode_keyframe(simulator, header, arrays)
+
+    def encode_keyframe(self, simulator, header: Dict, arrays: Dict[str, np.ndarray]) -> bytes:
+        bounds = simulator.get_field_bounds()
+        self._keyframe_id += 1
+        self._n_deltas = 0
+        self._is_delta = False
+        self._quantization = {}
+        self._keyframe_qs = {}
+        for key, value in arrays.items():
+            self._quantization[key] = quantization_params(value, bounds.get(key))
+            self._keyframe_qs[key] = quantize(value, *self._quantization[key])
+        self._keyframe_frame = encode_binary_frame({
+            **header,
+            'frame_type': 'keyframe',
+            'keyframe_id': self._keyframe_id,
+            'quantization': {
+                key: {'min': lo.tolist(), 'scale': scale.tolist()}
+                for key, (lo, scale) in self._quantization.items()
+            },
+            **self._keyframe_qs,
+        })
+        return self._keyframe_frame
+
+    def encode_deltas(self, arrays: Dict[str, np.ndarray]):
+        deltas = {}
+        shifts = {}
+        for key, value in arrays.items():
+            lo, scale = self._quantization[key]
+            q = np.rint((value - lo) / scale) + QUANTIZED_MIN
+            d = q - self._keyframe_qs[key]
+            max_d = np.abs(d).max() if d.size > 0 else 0
+            if not max_d <= INT16_MAX or (q < QUANTIZED_MIN).any() or (q > QUANTIZED_MIN + QUANTIZED_RANGE).any():
+                # out of the keyframe range : a new keyframe is needed
+                return None
+            if max_d <= INT8_MAX:
+                deltas[key] = d.astype(np.int8)
+                continue
+            # smallest shift fitting all but the largest 1/PATCH_FRACTION of the deltas
+            # (estimated on a sample of about 4096 of them)
+            sample = np.abs(d.ravel()[::max(1, d.size // 4096)])
+            typical = np.partition(sample, len(sample) - 1 - len(sample) // PATCH_FRACTION)[len(sample) - 1 - len(sample) // PATCH_FRACTION]
+            shift = 0
+            while shift < MAX_DELTA_SHIFT and typical > INT8_MAX << shift:
+                shift += 1
+            d_shifted = np.rint(d / (1 << shift)) if shift > 0 else d
+            # the outliers (e.g. the driven wave source) go to a patch list, 6 bytes each
+            is_outlier = np.abs(d_shifted) > INT8_MAX
+            patch_index = np.flatnonzero(is_outlier)
+            if 6 * len(patch_index) >= d.size:
+                deltas[key] = d.astype(np.int16)
+                continue
+            deltas[key] = np.where(is_outlier, DELTA_ESCAPE, d_shifted).astype(np.int8)
+            if shift > 0:
+                shifts[key] = shift
+            if len(patch_index) > 0:
+                deltas[key + PATCH_SUFFIXES[0]] = patch_index.astype(np.uint32)
+                deltas[key + PATCH_SUFFIXES[1]] = d.ravel()[patch_index].astype(np.int16)
+        if shifts:
+            deltas['delta_shift'] = shifts
+        return deltas
+
+    def sync_frames(self, sync_token):
+        # sync_token : keyframe id the subscriber has, None for a new subscriber
+        frames = []
+        if sync_token is None:
+            frames.append(self._static_frame)
+        if self._is_delta and sync_token != self._keyframe_id:
+            frames.append(self._keyframe_frame)
+        return frames, self._keyframe_id
+
+
+def create_frame_encoder(frame_format: FrameFormat, keyframe_interval: int = 0):
+    if frame_format == FrameFormat.BINARY:
+        return BinaryFrameEncoder()
+    if frame_format == FrameFormat.COMPACT:
+        return CompactFrameEncoder(keyframe_interval)
+    return JSONFrameEncoder()
@@ -0,0 +1,274 @@
+import bisect
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+
+# Minimal in-process metrics with Prometheus text exposition.
+# Everything is updated from the event loop thread, so no locking.
+
+DEFAULT_TIME_BUCKETS = (
+    0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5,
+)
+
+
+def _format_labels(labelnames: Sequence[str], labelvalues: Sequence, extra: str = '') -> str:
+    pairs = [f'{name}="{value}"' for name, value in zip(labelnames, labelvalues)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _format_value(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+
+class Counter:
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self._name = name
+        self._documentation = documentation
+        self._labelnames = tuple(labelnames)
+        self._values: Dict[Tuple, float] = {}
+
+    def inc(self, labelvalues: Tuple = (), value: float = 1.0) -> None:
+        self._values[labelvalues] = self._values.get(labelvalues, 0.0) + value
+
+    def value(self, labelvalues: Tuple = ()) -> float:
+        return self._values.get(labelvalues, 0.0)
+
+    def items(self):
+        return self._values.items()
+
+    def render(self) -> List[str]:
+        lines = [f'# HELP {self._name} {self._documentation}', f'# TYPE {self._name} counter']
+        for labelvalues, value in self._values.items():
+            lines.append(f'{self._name}{_format_labels(self._labelnames, labelvalues)} {_format_value(value)}')
+        return lines
+
+
+class Gauge:
+    # value computed by a callback at scrape time : {labelvalues: value}
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (), callback: Optional[Callable] = None):
+        self._name = name
+        self._documentation = documentation
+        self._labelnames = tuple(labelnames)
+        self._callback = callback
+
+    def set_callback(self, callback: Callable) -> None:
+        self._callback = callback
+
+    def render(self) -> List[str]:
+        lines = [f'# HELP {self._name} {self._documentation}', f'# TYPE {self._name} gauge']
+        values = self._callback() if self._callback is not None else {}
+        for labelvalues, value in values.items():
+            lines.append(f'{self._name}{_format_labels(self._labelnames, labelvalues)} {_format_value(value)}')
+        return lines
+
+
+class Histogram:
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Sequence[str] = (),
+        buckets: Sequence[float] = DEFAULT_TIME_BUCKETS,
+    ):
+        self._name = name
+        self._documentation = documentation
+        self._labelnames = tuple(labelnames)
+        self._buckets = tuple(sorted(buckets))
+        # labelvalues -> [bucket counts (non cumulative, last one is +Inf), sum]
+        self._values: Dict[Tuple, list] = {}
+
+    def observe(self, labelvalues: Tuple, value: float) -> None:
+        entry = self._values.get(labelvalues)
+        if entry is None:
+            entry = self._values[labelvalues] = [[0] * (len(self._buckets)+1), 0.0]
+        entry[0][bisect.bisect_left(self._buckets, value)] += 1
+        entry[1] += value
+
+    @contextmanager
+    def time(self, labelvalues: Tuple):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(labelvalues, time.perf_counter() - start)
+
+    def count(self, labelvalues: Tuple) -> int:
+        entry = self._values.get(labelvalues)
+        return sum(entry[0]) if entry is not None else 0
+
+    def render(self) -> List[str]:
+        lines = [f'# HELP {self._name} {self._documentation}', f'# TYPE {self._name} histogram']
+        for labelvalues, (counts, total) in self._values.items():
+            cumulative = 0
+            for upper, count in zip(self._buckets + (float('inf'),), counts):
+                cumulative += count
+                labels = _format_labels(self._labelnames, labelvalues, f'le="{_format_value(upper)}"')
+                lines.append(f'{self._name}_bucket{labels} {cumulative}')
+            labels = _format_labels(self._labelnames, labelvalues)
+            lines.append(f'{self._name}_sum{labels} {_format_value(total)}')
+            lines.append(f'{self._name}_count{labels} {cumulative}')
+        return lines
+
+
+class MetricsRegistry:
+
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics:
+            lines += metric.render()
+        return '\n'.join(lines) + '\n'
+
+
+def _label_sample(line: str, label: str) -> str:
+    # 'name{a="x"} 1.0' -> 'name{label,a="x"} 1.0', 'name 1.0' -> 'name{label} 1.0'
+    name, sep, rest = line.partition('{')
+    if sep and ' ' not in name:
+        return f'{name}{{{label},{rest}'
+    name, _, value = line.partition(' ')
+    return f'{name}{{{label}}} {value}'
+
+
+def merge_expositions(expositions: Dict[str, str], labelname: str = 'process') -> str:
+    # one exposition out of the ones of several processes (websocket fronts and simulation
+    # workers) : HELP / TYPE once per metric, every sample labelled with its process
+    families: Dict[str, Tuple[List[str], List[str]]] = {}
+    for process, text in expositions.items():
+        label = f'{labelname}="{process}"'
+        family = None
+        for line in text.splitlines():
+            if line.startswith('# HELP ') or line.startswith('# TYPE '):
+                family = families.setdefault(line.split()[2], ([], []))
+                if line not in family[0]:
+                    family[0].append(line)
+            elif line and family is not None:
+                family[1].append(_label_sample(line, label))
+    lines = []
+    for meta, samples in families.values():
+        lines += meta + samples
+    return '\n'.join(lines) + '\n'
+
+
+REGISTRY = MetricsRegistry()
+
+PHASE_SECONDS = REGISTRY.register(Histogram(
+    'simulation_phase_seconds',
+    'Time spent per streaming phase (update, diagnostics, get_states, encode, compress, send).',
+    ('simulator', 'phase'),
+))
+LOOP_LAG_RATIO = REGISTRY.register(Histogram(
+    'simulation_loop_lag_ratio',
+    'Session loop wake-up lag divided by the shortest subscriber min_dt.',
+    ('simulator',),
+    buckets=(0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.0, 5.0, 10.0),
+))
+ACK_RTT_SECONDS = REGISTRY.register(Histogram(
+    'simulation_ack_rtt_seconds',
+    'Time from sending a frame to receiving its client ack (flow control mode).',
+    ('simulator',),
+))
+STEPS = REGISTRY.register(Counter(
+    'simulation_steps_total',
+    'Simulator steps taken.',
+    ('simulator',),
+))
+SKIPPED_STEPS = REGISTRY.register(Counter(
+    'simulation_skipped_steps_total',
+    'Steps dropped because a loop iteration hit max_substeps.',
+    ('simulator',),
+))
+FRAMES_SENT = REGISTRY.register(Counter(
+    'simulation_frames_sent_total',
+    'Frames sent to subscribers.',
+    ('simulator', 'frame_format'),
+))
+FRAMES_DROPPED = REGISTRY.register(Counter(
+    'simulation_frames_dropped_total',
+    'Frames dropped from full subscriber send queues.',
+    ('simulator', 'frame_format'),
+))
+BYTES_SENT = REGISTRY.register(Counter(
+    'simulation_bytes_sent_total',
+    'Payload bytes sent to subscribers.',
+    ('simulator', 'frame_format'),
+))
+COMPRESS_SECONDS = REGISTRY.register(Histogram(
+    'simulation_compress_seconds',
+    'Time spent compressing one frame.',
+    ('simulator', 'codec', 'level'),
+))
+UNCOMPRESSED_BYTES = REGISTRY.register(Counter(
+    'simulation_compress_input_bytes_total',
+    'Frame bytes before compression.',
+    ('simulator', 'codec', 'level'),
+))
+COMPRESSED_BYTES = REGISTRY.register(Counter(
+    'simulation_compress_output_bytes_total',
+    'Frame bytes after compression.',
+    ('simulator', 'codec', 'level'),
+))
+
+
+def compression_ratios():
+    return {
+        labelvalues: UNCOMPRESSED_BYTES.value(labelvalues) / value
+        for labelvalues, value in COMPRESSED_BYTES.items() if value > 0
+    }
+
+
+COMPRESSION_RATIO = REGISTRY.register(Gauge(
+    'simulation_compression_ratio',
+    'Uncompressed / compressed frame bytes since start.',
+    ('simulator', 'codec', 'level'),
+    callback=compression_ratios,
+))
+ACTIVE_SESSIONS = REGISTRY.register(Gauge(
+    'simulation_active_sessions',
+    'Running simulation sessions.',
+    ('simulator',),
+))
+ACTIVE_SUBSCRIBERS = REGISTRY.register(Gauge(
+    'simulation_active_subscribers',
+    'Websocket subscribers attached to a session.',
+    ('simulator',),
+))
+
+
+class PhaseTimer:
+    # times the phases of one session, labelled by simulator type
+
+    def __init__(self, simulator_type: str):
+        self._simulator_type = simulator_type
+
+    def span(self, phase: str):
+        return PHASE_SECONDS.time((self._simulator_type, phase))
+
+    def observe(self, phase: str, seconds: float) -> None:
+        PHASE_SECONDS.observe((self._simulator_type, phase), seconds)
+
+
+class NullPhaseTimer:
+
+    @contextmanager
+    def span(self, phase: str):
+        yield
+
+    def observe(self, phase: str, seconds: float) -> None:
+        pass
+
+
+NULL_TIMER = NullPhaseTimer()
@@ -0,0 +1,65 @@
+import asyncio
+import collections
+from typing import Deque, Dict, Hashable, Optional, Tuple
+
+from simulator.registry import create_simulator, get_spec
+
+
+class SimulatorPool:
+    # warm, already initialized simulator instances per (simulator, config).
+    # acquire() hands one out on connect, release() resets it with init() in a
+    # worker thread and keeps it for the next connection.
+
+    def __init__(self, max_idle: int = 2):
+        self._max_idle = max_idle
+        self._idle: Dict[Hashable, Deque] = collections.defaultdict(collections.deque)
+        self._n_created = 0
+        self._n_reused = 0
+
+    @staticmethod
+    def key(name: str, config: Dict) -> Tuple:
+        return (name, tuple(sorted(config.items())))
+
+    def is_poolable(self, name: str, config: Dict) -> bool:
+        # a seeded run has to start from its own seed
+        return self._max_idle > 0 and get_spec(name).pooled and config.get('seed') is None
+
+    def acquire(self, name: str, config: Dict):
+        idle = self._idle.get(self.key(name, config))
+        if idle:
+            self._n_reused += 1
+            return idle.popleft()
+        self._n_created += 1
+        return create_simulator(name, config)
+
+    async def release(self, name: str, config: Dict, simulator) -> None:
+        if not self.is_poolable(name, config):
+            return
+        idle = self._idle[self.key(name, config)]
+        if len(idle) >= self._max_idle:
+            return
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, simulator.init)
+        if len(idle) < self._max_idle:
+            idle.append(simulator)
+
+    async def prefill(self, name: str, config: Dict, n: Optional[int] = None) -> None:
+        # builds instances in a worker thread, the first import of the module happens there too
+        n = self._max_idle if n is None else n
+        loop = asyncio.get_running_loop()
+        idle = self._idle[self.key(name, config)]
+        while len(idle) < min(n, self._max_idle):
+            simulator = await loop.run_in_executor(None, create_simulator, name, config)
+            self._n_created += 1
+            idle.append(simulator)
+
+    def stats(self) -> Dict:
+        return {
+            'max_idle': self._max_idle,
+            'n_created': self._n_created,
+            'n_reused': self._n_reused,
+            'idle': [
+                {'simulator': name, 'config': dict(config), 'n_idle': len(idle)}
+                for (name, config), idle in self._idle.items() if idle
+            ],
+        }
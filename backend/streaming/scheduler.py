@@ -0,0 +1,75 @@
+import time
+from typing import Optional
+
+
+class RateCounter:
+    # event count with a rate over the last completed window
+
+    def __init__(self, window: float = 1.0):
+        self._window = window
+        self._count = 0
+        self._window_start = time.perf_counter()
+        self._window_start_count = 0
+        self._rate = 0.0
+
+    def add(self, n: int = 1) -> None:
+        self._count += n
+        now = time.perf_counter()
+        if now - self._window_start >= self._window:
+            self._rate = (self._count - self._window_start_count) / (now - self._window_start)
+            self._window_start = now
+            self._window_start_count = self._count
+
+    @property
+    def count(self) -> int:
+        return self._count
+
+    @property
+    def rate(self) -> float:
+        return self._rate
+
+
+class FixedStepScheduler:
+    # accumulates wall clock time and converts it into a number of fixed dt steps
+
+    def __init__(self, step_dt: float, max_substeps: int, max_dt: Optional[float] = None):
+        self._step_dt = step_dt
+        self._max_substeps = max(1, max_substeps)
+        self._max_dt = max_dt
+        self._accumulator = 0.0
+        self._n_skipped_steps = 0
+        self._step_counter = RateCounter()
+
+    def advance(self, elapsed: float) -> int:
+        if self._max_dt is not None:
+            elapsed = min(self._max_dt, elapsed)
+        self._accumulator += elapsed
+        n_steps = int(self._accumulator // self._step_dt)
+        if n_steps > self._max_substeps:
+            # can't keep up : run the capped number of steps and drop the backlog
+            self._n_skipped_steps += n_steps - self._max_substeps
+            n_steps = self._max_substeps
+            self._accumulator = 0.0
+        else:
+            self._accumulator -= n_steps * self._step_dt
+        self._step_counter.add(n_steps)
+        return n_steps
+
+    def time_to_next_step(self) -> float:
+        return max(0.0, self._step_dt - self._accumulator)
+
+    @property
+    def step_dt(self) -> float:
+        return self._step_dt
+
+    @property
+    def n_steps(self) -> int:
+        return self._step_counter.count
+
+    @property
+    def n_skipped_steps(self) -> int:
+        return self._n_skipped_steps
+
+    @property
+    def step_rate(self) -> float:
+        return self._step_counter.rate
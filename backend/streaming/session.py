@@ -0,0 +1,595 @@
+import asyncio
+import collections
+import itertools
+import time
+from typing import Callable, Dict, Hashable, List, Optional, Tuple
+
+import numpy as np
+from fastapi import WebSocket
+
+from streaming.compression import CompressedFrameEncoder, create_codec
+from streaming.diagnostics import DiagnosticsAccumulator, DiagnosticsFrameEncoder
+from streaming.frame import FrameFormat, create_frame_encoder
+from streaming.metrics import (
+    ACK_RTT_SECONDS, BYTES_SENT, FRAMES_DROPPED, FRAMES_SENT, LOOP_LAG_RATIO, SKIPPED_STEPS, STEPS,
+    PhaseTimer,
+)
+from streaming.scheduler import FixedStepScheduler, RateCounter
+from streaming.view import StreamView, ViewedSimulator
+
+
+def frame_nbytes(frame) -> int:
+    # size of a queued frame, or of a list of frames sent together
+    if frame is None:
+        return 0
+    if isinstance(frame, list):
+        return sum(len(f) for f in frame)
+    return len(frame)
+
+
+def value_nbytes(value, seen: set) -> int:
+    if id(value) in seen:
+        return 0
+    seen.add(id(value))
+    if isinstance(value, np.ndarray):
+        # views count their own size
+        return value.nbytes
+    if isinstance(value, (bytes, bytearray)):
+        return len(value)
+    if isinstance(value, (list, tuple)):
+        return sum(value_nbytes(v, seen) for v in value)
+    if isinstance(value, dict):
+        return sum(value_nbytes(v, seen) for v in value.values())
+    return 0
+
+
+def held_nbytes(obj) -> int:
+    # memory held by the arrays and bytes among the attributes of obj (and in lists / dicts of them)
+    seen = set()
+    return sum(value_nbytes(value, seen) for value in vars(obj).values())
+
+
+class Subscriber:
+
+    def __init__(
+        self,
+        websocket: WebSocket,
+        frame_format: FrameFormat,
+        max_queue_size: int,
+        min_dt: float,
+        keyframe_interval: int = 0,
+        simulator_type: str = '',
+        ack_window: int = 0,
+        view: StreamView = StreamView(),
+        compression: Optional[Tuple[str, int]] = None,
+    ):
+        # min_dt : minimum interval between two frames sent to this subscriber
+        # ack_window : flow control, max number of sent but unacknowledged messages (0 : off)
+        # view : level of detail / region of interest of the frames
+        # compression : (codec name, level) of streaming/compression.py, None : uncompressed
+        self._ws = websocket
+        self._frame_format = frame_format
+        self._keyframe_interval = keyframe_interval if frame_format == FrameFormat.COMPACT else 0
+        self._view = view
+        self._compression = compression
+        # what the client already has from the stateful encoders (static fields, keyframe)
+        self._sync_token = None
+        self._queue = asyncio.Queue(maxsize=max_queue_size)
+        self._queued_bytes = 0
+        self._min_dt = min_dt
+        self._next_frame_time = time.perf_counter()
+        self._last_frame_version = -1
+        self._n_dropped_frames = 0
+        self._send_counter = RateCounter()
+        self._is_closed = False
+        self._metric_labels = (simulator_type, frame_format.value)
+        self._timer = PhaseTimer(simulator_type)
+        self._ack_window = ack_window
+        self._send_times = collections.deque()
+        self._smoothed_rtt = None
+        self._on_ack = None
+
+    def set_ack_callback(self, on_ack) -> None:
+        self._on_ack = on_ack
+
+    def ack(self) -> None:
+        # acks arrive in order, one per message sent
+        if not self._send_times:
+            return
+        rtt = time.perf_counter() - self._send_times.popleft()
+        ACK_RTT_SECONDS.observe(self._metric_labels[:1], rtt)
+        self._smoothed_rtt = rtt if self._smoothed_rtt is None else 0.875*self._smoothed_rtt + 0.125*rtt
+        if self._on_ack is not None:
+            self._on_ack()
+
+    @property
+    def can_send(self) -> bool:
+        if self._ack_window <= 0:
+            return True
+        return self._queue.qsize() + len(self._send_times) < self._ack_window
+
+    def frame_interval(self) -> float:
+        # with a full window in flight per round trip, pace frames at rtt / window
+        if self._ack_window > 0 and self._smoothed_rtt is not None:
+            return max(self._min_dt, self._smoothed_rtt / self._ack_window)
+        return self._min_dt
+
+    def is_frame_due(self, now: float, frame_version: int) -> bool:
+        # window full : skip frames until acks arrive, the next one pushed is the latest state
+        return now >= self._next_frame_time and frame_version > self._last_frame_version and self.can_send
+
+    def push(self, frame, now: float, frame_version: int, sync_frames: Optional[List] = None, sync_token=None) -> None:
+        if self._is_closed:
+            return
+        self._last_frame_version = frame_version
+        self._next_frame_time = max(now, self._next_frame_time + self.frame_interval())
+        self._sync_token = sync_token
+        # slow client : drop the oldest queued frame instead of blocking the session
+        if self._queue.full():
+            dropped = self.drop_oldest()
+            # the client may miss static fields (list) or a keyframe : resend them
+            self._sync_token = None if isinstance(dropped, list) else -1
+        self.enqueue([*sync_frames, frame] if sync_frames else frame)
+
+    def drop_oldest(self):
+        dropped = self._queue.get_nowait()
+        self._queued_bytes -= frame_nbytes(dropped)
+        self._n_dropped_frames += 1
+        FRAMES_DROPPED.inc(self._metric_labels)
+        return dropped
+
+    def enqueue(self, frame) -> None:
+        self._queued_bytes += frame_nbytes(frame)
+        self._queue.put_nowait(frame)
+
+    def close(self) -> None:
+        if self._is_closed:
+            return
+        self._is_closed = True
+        if self._queue.full():
+            self._queued_bytes -= frame_nbytes(self._queue.get_nowait())
+        self._queue.put_nowait(None)
+
+    async def send_task(self) -> None:
+        while True:
+            frame = await self._queue.get()
+            if frame is None:
+                break
+            self._queued_bytes -= frame_nbytes(frame)
+            start = time.perf_counter()
+            n_bytes = 0
+            for f in (frame if isinstance(frame, list) else [frame]):
+                if self._ack_window > 0:
+                    self._send_times.append(time.perf_counter())
+                await self.send_frame(f)
+                n_bytes += len(f)
+            self._timer.observe('send', time.perf_counter() - start)
+            self._send_counter.add()
+            FRAMES_SENT.inc(self._metric_labels)
+            BYTES_SENT.inc(self._metric_labels, n_bytes)
+
+    async def send_frame(self, frame) -> None:
+        if isinstance(frame, bytes):
+            await self._ws.send_bytes(frame)
+        else:
+            await self._ws.send_text(frame)
+
+    @property
+    def frame_format(self) -> FrameFormat:
+        return self._frame_format
+
+    @property
+    def min_dt(self) -> float:
+        return self._min_dt
+
+    @min_dt.setter
+    def min_dt(self, min_dt: float) -> None:
+        self._min_dt = min_dt
+
+    @property
+    def encoding(self) -> Tuple[FrameFormat, int, StreamView, Optional[Tuple[str, int]]]:
+        return self._frame_format, self._keyframe_interval, self._view, self._compression
+
+    @property
+    def sync_token(self):
+        return self._sync_token
+
+    @property
+    def next_frame_time(self) -> float:
+        return self._next_frame_time
+
+    @property
+    def n_dropped_frames(self) -> int:
+        return self._n_dropped_frames
+
+    @property
+    def queued_bytes(self) -> int:
+        return self._queued_bytes
+
+    @property
+    def n_sent_frames(self) -> int:
+        return self._send_counter.count
+
+    @property
+    def smoothed_rtt(self) -> Optional[float]:
+        return self._smoothed_rtt
+
+    @property
+    def send_rate(self) -> float:
+        return self._send_counter.rate
+
+
+class SimulationSession:
+
+    def __init__(
+        self,
+        session_id: int,
+        simulator_type: str,
+        simulator,
+        step_dt: float,
+        max_substeps: int,
+        max_dt: float,
+        release: Optional[Callable] = None,
+    ):
+        # simulator : handle returned by a step executor (streaming/executor.py)
+        # release : coroutine function given the simulator back once the session stopped
+        self._session_id = session_id
+        self._simulator_type = simulator_type
+        self._simulator = simulator
+        self._release = release
+        # set by the first stop(), later ones (expiry racing a remove, close) do nothing,
+        # so the simulator is closed and released once
+        self._stopped = False
+        self._timer = PhaseTimer(simulator_type)
+        # physics advances by fixed step_dt steps, independently of the frame rates
+        self._scheduler = FixedStepScheduler(step_dt, max_substeps, max_dt)
+        self._frame_version = 0
+        self._frame_counter = RateCounter()
+        self._encoders = {}
+        self._viewed_simulators: Dict[StreamView, ViewedSimulator] = {}
+        # sampled after every update while a subscriber streams diagnostics
+        self._diagnostics: Optional[DiagnosticsAccumulator] = None
+        self._subscribers: List[Subscriber] = []
+        self._task: Optional[asyncio.Task] = None
+        self._created_at = time.perf_counter()
+        # perf_counter time the last subscriber left, None while subscribed
+        self._idle_since: Optional[float] = None
+        # set when an ack reopens a subscriber's flow control window
+        self._wakeup = asyncio.Event()
+        # (command, value) playback controls waiting for the next loop iteration
+        self._controls: List[Tuple[str, float]] = []
+
+    def subscribe(self, subscriber: Subscriber) -> None:
+        subscriber.set_ack_callback(self._wakeup.set)
+        self._subscribers.append(subscriber)
+        self._idle_since = None
+        if subscriber.frame_format == FrameFormat.DIAGNOSTICS and self._diagnostics is None:
+            self._diagnostics = DiagnosticsAccumulator()
+            self._diagnostics.add(self._simulator.get_diagnostics())
+        # (re)started when the first subscriber joins, run() returns once the last one left
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self.run())
+
+    def unsubscribe(self, subscriber: Subscriber) -> None:
+        if subscriber in self._subscribers:
+            self._subscribers.remove(subscriber)
+        subscriber.close()
+        # encoders and views nobody asks for anymore
+        encodings = {s.encoding for s in self._subscribers}
+        self._encoders = {e: encoder for e, encoder in self._encoders.items() if e in encodings}
+        views = {encoding[2] for encoding in encodings}
+        self._viewed_simulators = {v: s for v, s in self._viewed_simulators.items() if v in views}
+        if all(s.frame_format != FrameFormat.DIAGNOSTICS for s in self._subscribers):
+            self._diagnostics = None
+        if not self._subscribers and self._idle_since is None:
+            self._idle_since = time.perf_counter()
+
+    async def stop(self) -> None:
+        if self._stopped:
+            return
+        self._stopped = True
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        for subscriber in self._subscribers:
+            subscriber.close()
+        self._subscribers = []
+        await self._simulator.close()
+        if self._release is not None:
+            await self._release(self._simulator.simulator)
+
+    async def run(self) -> None:
+        try:
+            await self.run_loop()
+        except Exception as e:
+            # the subscribers' connections end and detach from the session
+            print(f'session {self._session_id} ({self._simulator_type}) failed : {e!r}')
+            for subscriber in self._subscribers:
+                subscriber.close()
+
+    async def run_loop(self) -> None:
+        labels = (self._simulator_type,)
+        prev_time = time.perf_counter()
+        while self._subscribers:
+            cur_time = time.perf_counter()
+            n_skipped_steps = self._scheduler.n_skipped_steps
+            n_steps = self._scheduler.advance(cur_time - prev_time)
+            prev_time = cur_time
+            if self._controls:
+                # applied between two updates, the next frame shows their effect
+                controls, self._controls = self._controls, []
+                for command, value in controls:
+                    await self._simulator.control(command, value)
+                self._frame_version += 1
+            if n_steps > 0:
+                # stepping runs in the executor, the event loop only encodes and sends
+                with self._timer.span('update'):
+                    await self._simulator.update(self._scheduler.step_dt, n_steps)
+                if self._diagnostics is not None:
+                    with self._timer.span('diagnostics'):
+                        self._diagnostics.add(self._simulator.get_diagnostics())
+                self._frame_version += 1
+                STEPS.inc(labels, n_steps)
+            if self._scheduler.n_skipped_steps > n_skipped_steps:
+                SKIPPED_STEPS.inc(labels, self._scheduler.n_skipped_steps - n_skipped_steps)
+            self.broadcast(time.perf_counter())
+            # sleep until the next frame is due and there is a new step to show
+            if not self._subscribers:
+                break
+            next_step_time = cur_time + self._scheduler.time_to_next_step()
+            # subscribers with a full flow control window are woken up by their acks
+            next_frame_times = [s.next_frame_time for s in self._subscribers if s.can_send]
+            wake_time = max(min(next_frame_times), next_step_time) if next_frame_times else next_step_time
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), max(0, wake_time - time.perf_counter()))
+            except asyncio.TimeoutError:
+                pass
+            # how late the loop woke up, relative to the fastest requested frame interval
+            if self._subscribers:
+                min_dt = min(subscriber.min_dt for subscriber in self._subscribers)
+                lag = max(0.0, time.perf_counter() - wake_time)
+                LOOP_LAG_RATIO.observe(labels, lag / min_dt if min_dt > 0 else lag)
+
+    def control(self, command: str, value: float) -> None:
+        # runtime controls of simulators that support them (replay : seek, speed)
+        if not self.is_controllable:
+            raise ValueError(f'{self._simulator_type} sessions take no {command} control')
+        self._controls.append((command, value))
+        self._wakeup.set()
+
+    def broadcast(self, now: float) -> None:
+        # encode once per requested encoding, then fan out to the subscribers whose frame is due
+        frames = {}
+        for subscriber in self._subscribers:
+            if not subscriber.is_frame_due(now, self._frame_version):
+                continue
+            encoding = subscriber.encoding
+            frame_format, keyframe_interval, view, compression = encoding
+            simulator = self.viewed_simulator(view)
+            if encoding not in self._encoders:
+                if not getattr(simulator, 'has_fixed_layout', True):
+                    keyframe_interval = 0
+                if frame_format == FrameFormat.DIAGNOSTICS:
+                    encoder = DiagnosticsFrameEncoder(self._diagnostics)
+                else:
+                    encoder = create_frame_encoder(frame_format, keyframe_interval)
+                if compression is not None:
+                    encoder = CompressedFrameEncoder(encoder, create_codec(*compression), self._simulator_type)
+                self._encoders[encoding] = encoder
+            encoder = self._encoders[encoding]
+            if encoding not in frames:
+                frames[encoding] = encoder.encode(simulator, self._session_id, self._timer)
+            sync_frames, sync_token = encoder.sync_frames(subscriber.sync_token)
+            subscriber.push(frames[encoding], now, self._frame_version, sync_frames, sync_token)
+        if frames:
+            self._frame_counter.add(len(frames))
+
+    def viewed_simulator(self, view: StreamView):
+        # states sliced for the clients with this view, the full simulator for the default view
+        if view.is_full:
+            return self._simulator
+        if view not in self._viewed_simulators:
+            self._viewed_simulators[view] = ViewedSimulator(self._simulator, view)
+        return self._viewed_simulators[view]
+
+    def stats(self) -> Dict:
+        return {
+            'session_id': self._session_id,
+            'simulator': self._simulator_type,
+            'n_subscribers': len(self._subscribers),
+            'step_dt': self._scheduler.step_dt,
+            'n_steps': self._scheduler.n_steps,
+            'n_skipped_steps': self._scheduler.n_skipped_steps,
+            'step_rate': self._scheduler.step_rate,
+            'n_encoded_frames': self._frame_counter.count,
+            'encode_rate': self._frame_counter.rate,
+            'n_sent_frames': sum(s.n_sent_frames for s in self._subscribers),
+            'send_rate': sum(s.send_rate for s in self._subscribers),
+            'n_dropped_frames': sum(s.n_dropped_frames for s in self._subscribers),
+            'ack_rtts': [s.smoothed_rtt for s in self._subscribers if s.smoothed_rtt is not None],
+            'age': time.perf_counter() - self._created_at,
+            'idle_time': self.idle_time,
+            'memory': self.memory_footprint(),
+        }
+
+    def memory_footprint(self) -> Dict[str, int]:
+        # bytes held by the simulator states, the encoders (static frames, keyframes) and the send queues
+        encoders = [getattr(encoder, 'encoder', None) for encoder in self._encoders.values()]
+        footprint = {
+            'simulator_bytes': held_nbytes(self._simulator.simulator),
+            'encoder_bytes': sum(held_nbytes(e) for e in [*self._encoders.values(), *filter(None, encoders)]),
+            'queued_bytes': sum(s.queued_bytes for s in self._subscribers),
+        }
+        footprint['total_bytes'] = sum(footprint.values())
+        return footprint
+
+    @property
+    def session_id(self) -> int:
+        return self._session_id
+
+    @property
+    def simulator_type(self) -> str:
+        return self._simulator_type
+
+    @property
+    def simulator(self):
+        return self._simulator
+
+    @property
+    def n_subscribers(self) -> int:
+        return len(self._subscribers)
+
+    @property
+    def is_controllable(self) -> bool:
+        return hasattr(self._simulator.simulator, 'control')
+
+    @property
+    def idle_time(self) -> float:
+        # seconds since the last subscriber left, 0 while subscribed
+        return 0.0 if self._idle_since is None else time.perf_counter() - self._idle_since
+
+
+class SessionLimitError(Exception):
+    # max_sessions reached and no idle session to evict
+    pass
+
+
+# key of the sessions nobody else can attach to
+PRIVATE = 'private'
+
+
+class SessionManager:
+    # Sessions are created for a key, subscribers attach to and detach from them.
+    # A shared session whose last subscriber detached is paused and kept for
+    # idle_timeout seconds so that reconnecting clients find it again, expire()
+    # (run periodically by run_expiry()) stops it after that. Private sessions stop
+    # right away.
+
+    def __init__(self, max_sessions: int = 0, idle_timeout: float = 0.0):
+        # max_sessions : admission limit on the number of sessions, 0 : no limit
+        self._max_sessions = max_sessions
+        self._idle_timeout = idle_timeout
+        self._sessions: Dict[Hashable, SimulationSession] = {}
+        self._session_ids = itertools.count(1)
+        self._n_rejected = 0
+        self._n_expired = 0
+
+    def set_session_ids(self, first: int, step: int = 1) -> None:
+        # ids of the sessions created from now on : first, first + step, ...
+        # (simulation workers take ids that tell which worker owns a session)
+        self._session_ids = itertools.count(first, step)
+
+    def get(self, key: Optional[Hashable]) -> Optional[SimulationSession]:
+        return self._sessions.get(key) if key is not None else None
+
+    async def create(
+        self,
+        key: Optional[Hashable],
+        simulator_type: str,
+        simulator_factory: Callable,
+        step_executor,
+        step_dt: float,
+        max_substeps: int,
+        max_dt: float,
+        release: Optional[Callable] = None,
+    ) -> SimulationSession:
+        # key=None : private session that nobody else can attach to
+        if self._max_sessions > 0 and len(self._sessions) >= self._max_sessions:
+            # make room by stopping the session idle for the longest time
+            idle_sessions = [session for session in self._sessions.values() if session.n_subscribers == 0]
+            if not idle_sessions:
+                self._n_rejected += 1
+                raise SessionLimitError(f'session limit reached : {self._max_sessions}')
+            await self.remove(max(idle_sessions, key=lambda session: session.idle_time))
+            # another client may have created this session in the meantime
+            if self.get(key) is not None:
+                return self.get(key)
+        session = SimulationSession(
+            next(self._session_ids), simulator_type, step_executor.attach(simulator_factory()),
+            step_dt, max_substeps, max_dt, release,
+        )
+        self._sessions[key if key is not None else (PRIVATE, session.session_id)] = session
+        return session
+
+    def attach(self, session: SimulationSession, subscriber: Subscriber) -> None:
+        session.subscribe(subscriber)
+
+    async def detach(self, session: SimulationSession, subscriber: Subscriber) -> None:
+        session.unsubscribe(subscriber)
+        key = self.key_of(session)
+        # key None : already removed (expired, evicted)
+        if session.n_subscribers > 0 or key is None:
+            return
+        if self._idle_timeout <= 0 or key[0] == PRIVATE:
+            await self.remove(session)
+
+    async def join(
+        self,
+        key: Optional[Hashable],
+        simulator_type: str,
+        simulator_factory: Callable,
+        step_executor,
+        subscriber: Subscriber,
+        step_dt: float,
+        max_substeps: int,
+        max_dt: float,
+        release: Optional[Callable] = None,
+    ) -> SimulationSession:
+        # attach to the session of key, created first if there is none
+        session = self.get(key)
+        if session is None:
+            session = await self.create(
+                key, simulator_type, simulator_factory, step_executor, step_dt, max_substeps, max_dt, release,
+            )
+        self.attach(session, subscriber)
+        return session
+
+    def key_of(self, session: SimulationSession) -> Optional[Hashable]:
+        for key, s in self._sessions.items():
+            if s is session:
+                return key
+        return None
+
+    async def remove(self, session: SimulationSession) -> None:
+        key = self.key_of(session)
+        if key is not None:
+            del self._sessions[key]
+        await session.stop()
+
+    async def expire(self) -> int:
+        # stops the sessions without subscribers for longer than idle_timeout
+        expired = [
+            session for session in self._sessions.values()
+            if session.n_subscribers == 0 and session.idle_time >= self._idle_timeout
+        ]
+        for session in expired:
+            await self.remove(session)
+        self._n_expired += len(expired)
+        return len(expired)
+
+    async def run_expiry(self, interval: float = 1.0) -> None:
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.expire()
+            except Exception as e:
+                print(f'session expiry failed : {e}')
+
+    async def close(self) -> None:
+        for session in list(self._sessions.values()):
+            await self.remove(session)
+
+    def stats(self) -> Dict:
+        return {
+            'n_sessions': len(self._sessions),
+            'max_sessions': self._max_sessions,
+            'idle_timeout': self._idle_timeout,
+            'n_idle': sum(session.n_subscribers == 0 for session in self._sessions.values()),
+            'n_rejected': self._n_rejected,
+            'n_expired': self._n_expired,
+        }
+
+    @property
+    def sessions(self) -> Dict[Hashable, SimulationSession]:
+        return self._sessions
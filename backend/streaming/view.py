@@ -0,0 +1,125 @@
+from typing import Dict, NamedTuple, Optional, Tuple
+
+import numpy as np
+
+
+class StreamView(NamedTuple):
+    # level of detail / region of interest of one client, applied at encode time
+    # max_particles : 0 for all, otherwise a fixed stride subsample of at most max_particles
+    # roi : (x_min, y_min, z_min, x_max, y_max, z_max) box, particles or grid points outside are left out
+    # grid_stride : keep every grid_stride-th grid point along x and z (wave)
+    max_particles: int = 0
+    roi: Optional[Tuple[float, float, float, float, float, float]] = None
+    grid_stride: int = 1
+
+    @property
+    def is_full(self) -> bool:
+        return self.max_particles <= 0 and self.roi is None and self.grid_stride <= 1
+
+
+def parse_roi(roi: Optional[str]) -> Optional[Tuple[float, ...]]:
+    # "x_min,y_min,z_min,x_max,y_max,z_max"
+    if not roi:
+        return None
+    values = tuple(float(v) for v in roi.split(','))
+    if len(values) != 6:
+        raise ValueError(f'roi needs 6 comma separated values, got {len(values)}')
+    if any(lo > hi for lo, hi in zip(values[:3], values[3:])):
+        raise ValueError(f'roi min is above max : {roi}')
+    return values
+
+
+class ViewedSimulator:
+    # simulator (handle) whose states are sliced down to a StreamView.
+    # Particle fields are the arrays of length n_particles, grid fields the
+    # arrays over the (n_grid_x+1, n_grid_z+1) wave grid (also when flattened).
+
+    def __init__(self, simulator, view: StreamView):
+        self._simulator = simulator
+        self._view = view
+        static_states = simulator.get_static_states()
+        self._n_particles = static_states.get('n_particles')
+        self._grid_shape = None
+        if 'n_grid_x' in static_states:
+            self._grid_shape = (static_states['n_grid_x'] + 1, static_states['n_grid_z'] + 1)
+            stride = max(1, view.grid_stride)
+            self._x_slice = self.grid_slice(static_states['grid_x'], 0, stride)
+            self._z_slice = self.grid_slice(static_states['grid_z'], 2, stride)
+
+    def grid_slice(self, coordinates: np.ndarray, axis: int, stride: int) -> slice:
+        # grid coordinates are ascending, the roi becomes a contiguous index range
+        start, stop = 0, len(coordinates)
+        if self._view.roi is not None:
+            start = int(np.searchsorted(coordinates, self._view.roi[axis], side='left'))
+            stop = int(np.searchsorted(coordinates, self._view.roi[axis + 3], side='right'))
+        return slice(start, stop, stride)
+
+    @property
+    def has_fixed_layout(self) -> bool:
+        # a particle roi selects different particles every frame, deltas between frames are meaningless
+        return self._view.roi is None or self._n_particles is None
+
+    def particle_stride(self, n: int) -> int:
+        if self._view.max_particles <= 0 or n <= self._view.max_particles:
+            return 1
+        return -(-n // self._view.max_particles)
+
+    def slice_arrays(self, states: Dict) -> Dict:
+        states = dict(states)
+        if self._n_particles is not None:
+            selected = None
+            positions = states.get('positions')
+            if self._view.roi is not None and isinstance(positions, np.ndarray):
+                lo, hi = np.array(self._view.roi[:3]), np.array(self._view.roi[3:])
+                selected = np.flatnonzero(((positions >= lo) & (positions <= hi)).all(axis=1))
+                selected = selected[::self.particle_stride(len(selected))]
+            step = self.particle_stride(self._n_particles)
+            for key, value in states.items():
+                if isinstance(value, np.ndarray) and value.ndim > 0 and value.shape[0] == self._n_particles:
+                    states[key] = value[selected] if selected is not None else value[::step]
+        if self._grid_shape is not None:
+            n_points = self._grid_shape[0] * self._grid_shape[1]
+            for key, value in states.items():
+                if not isinstance(value, np.ndarray):
+                    continue
+                if value.shape[:2] == self._grid_shape:
+                    states[key] = value[self._x_slice, self._z_slice]
+                elif value.ndim > 0 and value.shape[0] == n_points:
+                    grid = value.reshape(self._grid_shape + value.shape[1:])[self._x_slice, self._z_slice]
+                    states[key] = grid.reshape((-1,) + value.shape[1:])
+        return states
+
+    def get_states(self) -> Dict:
+        # built from the state arrays, plus the diagnostics scalars (energies, momentum, ...)
+        # that a simulator's get_states() may add to them
+        states = {**self.get_diagnostics(), **self.get_state_arrays()}
+        return {
+            key: value.tolist() if isinstance(value, np.ndarray) else value
+            for key, value in states.items()
+        }
+
+    def get_state_arrays(self) -> Dict:
+        return self.slice_arrays(self._simulator.get_state_arrays())
+
+    def get_dynamic_state_arrays(self) -> Dict:
+        return self.slice_arrays(self._simulator.get_dynamic_state_arrays())
+
+    def get_static_states(self) -> Dict:
+        static_states = self._simulator.get_static_states()
+        if self._n_particles is not None:
+            # upper bound when a roi is set
+            n = self._n_particles
+            static_states['n_particles'] = -(-n // self.particle_stride(n))
+        if self._grid_shape is not None:
+            static_states['grid_x'] = static_states['grid_x'][self._x_slice]
+            static_states['grid_z'] = static_states['grid_z'][self._z_slice]
+            static_states['n_grid_x'] = len(static_states['grid_x']) - 1
+            static_states['n_grid_z'] = len(static_states['grid_z']) - 1
+        return static_states
+
+    def get_field_bounds(self) -> Dict:
+        return self._simulator.get_field_bounds()
+
+    def get_diagnostics(self) -> Dict:
+        # reductions over the whole simulation, not only the view
+        return self._simulator.get_diagnostics()
@@ -0,0 +1,87 @@
+import argparse
+import asyncio
+import json
+import os
+import signal
+from typing import Dict
+
+import server
+from streaming.broker import HELLO, TEXT, BrokerConnection, pack_message, read_message
+from streaming.frame import FrameFormat
+
+
+# usage : python worker.py --socket /tmp/simulation-0.sock --index 0 --n-workers 2
+#
+# Simulation worker : owns sessions, steps and encodes them, and publishes the frames
+# to the websocket front processes (server.py started with SIMULATION_WORKERS) over
+# unix socket feeds, see streaming/broker.py. start_cluster.sh starts both.
+# Worker index of n_workers gives its sessions the ids index + k*n_workers, so that the
+# fronts find the worker owning a session from its id (DELETE /sessions/{session_id}).
+
+
+async def handle_connection(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+    kind, payload = await read_message(reader)
+    if kind != HELLO:
+        writer.close()
+        return
+    hello = json.loads(payload)
+    if hello.get('type') != 'subscribe':
+        writer.write(pack_message(TEXT, json.dumps(await answer_request(hello)).encode('utf-8')))
+        await writer.drain()
+        writer.close()
+        return
+    connection = BrokerConnection(reader, writer, hello['query'])
+    options = dict(hello['options'])
+    options['frame_format'] = FrameFormat(options['frame_format'])
+    try:
+        await server.serve_simulation(connection, hello['simulator'], options, feed=True)
+    finally:
+        # tells the front to close the websocket
+        await connection.close()
+
+
+async def answer_request(hello) -> Dict:
+    if hello.get('type') == 'sessions':
+        return server.sessions_stats()
+    if hello.get('type') == 'metrics':
+        return {'metrics': server.REGISTRY.render()}
+    if hello.get('type') == 'expire':
+        return await server.remove_session(int(hello['session_id']))
+    return {'error': f'unknown request : {hello.get("type")}'}
+
+
+async def run_worker(socket_path: str, index: int = 0, n_workers: int = 1) -> None:
+    server.session_manager.set_session_ids(n_workers + index, n_workers)
+    await server.prefill_simulator_pool()
+    await server.start_session_expiry()
+    if os.path.exists(socket_path):
+        os.remove(socket_path)
+    unix_server = await asyncio.start_unix_server(handle_connection, path=socket_path)
+    # stop serving on SIGTERM too (start_cluster.sh), the sessions are shut down cleanly
+    asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, asyncio.current_task().cancel)
+    print(f'simulation worker listening on {socket_path}')
+    try:
+        async with unix_server:
+            await unix_server.serve_forever()
+    finally:
+        await server.shutdown_sessions()
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='simulation worker behind websocket front processes')
+    parser.add_argument('--socket', required=True, help='unix socket path to listen on')
+    parser.add_argument('--index', type=int, default=0, help='position of --socket in the fronts\' SIMULATION_WORKERS')
+    parser.add_argument('--n-workers', type=int, default=1, help='number of simulation workers')
+    args = parser.parse_args(args)
+    if not 0 <= args.index < args.n_workers:
+        parser.error(f'--index must be in [0, {args.n_workers - 1}]')
+    try:
+        asyncio.run(run_worker(args.socket, args.index, args.n_workers))
+    except (KeyboardInterrupt, asyncio.CancelledError):
+        pass
+
+
+if __name__ == '__main__':
+    main()